@@ -0,0 +1,290 @@
+"""Drive the bot's real handlers with simulated Telegram traffic.
+
+Usage:
+    python benchmarks/load.py [--users 1000 100000 1000000] [--updates N]
+                              [--concurrency N] [--backend log|sqlite] [--api-latency MS]
+
+For each user-count tier, storage is filled with that many users and the
+bot loads it as it would at startup. Then --concurrency simulated players
+at a time, each picked at random from those users, play through /start,
+dice, number guessing, blackjack and the menu buttons until --updates
+updates have been handled. Updates are built from the same JSON Telegram
+sends and go through the application's update processor and handlers.
+Bot API calls are answered locally, after --api-latency milliseconds.
+
+Each tier runs in its own process and prints load time, throughput,
+p50/p99 latency per update, memory and the number of updates whose
+handler raised. Those errors are also logged to stderr, and the run exits
+with status 1 if there were any, since their latencies are counted with
+the rest. The 1M-user tier needs about 2GiB and two minutes with the log
+backend.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "tools")]
+
+from post_update import callback_update, message_update
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def rss_mib():
+    """Return the process's current resident memory in MiB"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return peak_rss_mib()
+
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def make_stub_request(latency):
+    from telegram.request import BaseRequest
+
+    class StubRequest(BaseRequest):
+        """Answers Bot API calls in memory, as Telegram would after latency seconds"""
+
+        def __init__(self):
+            self.calls = collections.Counter()
+            self.message_ids = itertools.count(1)
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            endpoint = url.rsplit("/", 1)[1]
+            self.calls[endpoint] += 1
+            if latency:
+                await asyncio.sleep(latency)
+            parameters = request_data.parameters if request_data else {}
+            if endpoint == "getMe":
+                result = BOT_USER
+            elif endpoint in ("sendMessage", "editMessageText"):
+                chat_id = parameters.get("chat_id", 0)
+                result = {
+                    "message_id": parameters.get("message_id") or next(self.message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": parameters.get("text", ""),
+                }
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return StubRequest()
+
+
+def populate(bot, count):
+    """Write count users to the bot's storage, one in ten premium"""
+    from records import UserRecord
+
+    bot.store.load()
+    batch = {}
+    for user_id in range(1, count + 1):
+        batch[str(user_id)] = UserRecord(
+            credits=100 + user_id % 500,
+            is_premium=user_id % 10 == 0,
+            games_played=user_id % 50,
+            games_won=user_id % 20,
+            total_earnings=user_id % 1000,
+            username=f"user{user_id}",
+        )
+        if len(batch) == 10000:
+            bot.store.save_many(batch, {})
+            batch = {}
+    bot.store.save_many(batch, {})
+    bot.store.checkpoint()
+    bot.store.close()
+
+
+# Each scenario is a list of (kind, payload) steps one player sends in order
+SCENARIOS = {
+    "start": lambda: [("message", "/start"), ("callback", "games"), ("callback", "credits"), ("callback", "menu")],
+    "dice": lambda: [("message", "/dice")] + [("callback", f"guess_{random.randint(1, 6)}") for _ in range(3)],
+    "number": lambda: [("message", "/number")] + [("message", str(random.randint(1, 100))) for _ in range(3)],
+    "blackjack": lambda: [("message", "/blackjack"), ("callback", "bj_hit"), ("callback", "bj_stand")],
+    "play_button": lambda: [("callback", "play_dice"), ("callback", f"guess_{random.randint(1, 6)}")],
+}
+
+
+async def run_tier(application, users, updates, concurrency):
+    """Send updates from concurrency players at once; return latencies by step"""
+    from telegram import Update
+
+    latencies = collections.defaultdict(list)
+    processor = application.update_processor
+    remaining = updates
+
+    async def player():
+        nonlocal remaining
+        while remaining > 0:
+            user_id = random.randint(1, users)
+            username = f"user{user_id}"
+            for kind, payload in random.choice(list(SCENARIOS.values()))():
+                if remaining <= 0:
+                    return
+                remaining -= 1
+                if kind == "message":
+                    data = message_update(user_id, username, payload)
+                    step = payload if payload.startswith("/") else "number guess"
+                else:
+                    data = callback_update(user_id, username, payload)
+                    step = "button " + payload.split("_")[0]
+                update = Update.de_json(data, application.bot)
+                start = time.perf_counter()
+                await processor.process_update(update, application.process_update(update))
+                latencies[step].append(time.perf_counter() - start)
+
+    await asyncio.gather(*(player() for _ in range(concurrency)))
+    return latencies
+
+
+async def measure(args, users):
+    import bot
+    from telegram.ext import Application
+
+    populate(bot, users)
+    started = time.perf_counter()
+    bot.load_data()
+    load_seconds = time.perf_counter() - started
+    loaded_rss = rss_mib()
+
+    request = make_stub_request(args.api_latency / 1000)
+    application = bot.create_application(
+        Application.builder().token("1:bench").request(request).get_updates_request(request)
+    )
+    # exception name -> updates and jobs whose handler raised it
+    errors = collections.Counter()
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+        logging.getLogger(__name__).error("Handler raised during the benchmark", exc_info=context.error)
+
+    application.add_error_handler(count_error)
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        started = time.perf_counter()
+        latencies = await run_tier(application, users, args.updates, args.concurrency)
+        elapsed = time.perf_counter() - started
+        await application.stop()
+    await application.post_shutdown(application)
+
+    everything = sorted(itertools.chain.from_iterable(latencies.values()))
+    result = {
+        "users": users,
+        "load_s": load_seconds,
+        "updates": len(everything),
+        "updates_per_s": len(everything) / elapsed,
+        "p50_ms": percentile(everything, 0.5) * 1000,
+        "p99_ms": percentile(everything, 0.99) * 1000,
+        "rss_loaded_mib": loaded_rss,
+        "rss_peak_mib": peak_rss_mib(),
+        "api_calls": sum(request.calls.values()),
+        "errors": dict(errors),
+        "steps": {},
+    }
+    for step, values in sorted(latencies.items()):
+        values.sort()
+        result["steps"][step] = (len(values), percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000)
+    bot.store.close()
+    return result
+
+
+def run_child(args):
+    """Measure one tier in this process and print the result as JSON"""
+    data_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "DATA_DIR": data_dir,
+        "STORAGE_BACKEND": args.backend,
+        "UPDATE_MODE": "polling",
+        "METRICS_PORT": "0",
+        # The stub answers at once, so Telegram's limits don't apply
+        "SEND_RATE": "0",
+    })
+    os.environ.setdefault("CONCURRENT_UPDATES", str(args.concurrency))
+    try:
+        result = asyncio.run(measure(args, args.users[0]))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="user-count tiers")
+    parser.add_argument("--updates", type=int, default=20000, help="updates to send per tier")
+    parser.add_argument("--concurrency", type=int, default=64, help="players sending at once")
+    parser.add_argument("--backend", choices=("log", "sqlite"), default="log")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="milliseconds per Bot API call")
+    parser.add_argument("--steps", action="store_true", help="also print latency for each kind of update")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        logging.disable(logging.INFO)
+        run_child(args)
+        return
+
+    print(f"backend={args.backend} updates={args.updates} concurrency={args.concurrency} "
+          f"api_latency={args.api_latency}ms")
+    print(f"{'users':>9} {'load s':>8} {'updates/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'RSS MiB':>8} {'peak MiB':>9} "
+          f"{'errors':>7}")
+    failed = False
+    for users in args.users:
+        # A fresh process per tier, so one tier's memory doesn't count towards the next
+        command = [
+            sys.executable, os.path.abspath(__file__), "--child", "--users", str(users),
+            "--updates", str(args.updates), "--concurrency", str(args.concurrency),
+            "--backend", args.backend, "--api-latency", str(args.api_latency),
+        ]
+        # The child's stderr goes straight through, so its errors are seen
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{result['users']:>9} {result['load_s']:>8.2f} {result['updates_per_s']:>10.0f} "
+              f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['rss_loaded_mib']:>8.0f} "
+              f"{result['rss_peak_mib']:>9.0f} {sum(result['errors'].values()):>7}")
+        if result["errors"]:
+            failed = True
+            print(f"    handlers raised: {', '.join(f'{name} x{count}' for name, count in result['errors'].items())}")
+        if args.steps:
+            for step, (count, p50, p99) in result["steps"].items():
+                print(f"    {step:<16} {count:>7} updates  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
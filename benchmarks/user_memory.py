@@ -0,0 +1,57 @@
+"""Compare the memory used by dict user records and UserRecord objects.
+
+Usage: python benchmarks/user_memory.py [number of users]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from records import UserRecord
+
+
+def dict_record(i):
+    # The format get_user() used to create
+    return {
+        "credits": 100 + i % 500,
+        "is_premium": i % 10 == 0,
+        "premium_expiry": "2030-01-01T00:00:00" if i % 10 == 0 else None,
+        "games_played": i % 50,
+        "games_won": i % 20,
+        "total_earnings": i % 1000,
+    }
+
+
+def slots_record(i):
+    return UserRecord(
+        credits=100 + i % 500,
+        is_premium=i % 10 == 0,
+        premium_expiry=1893456000 if i % 10 == 0 else None,
+        games_played=i % 50,
+        games_won=i % 20,
+        total_earnings=i % 1000,
+    )
+
+
+def measure(make_record, count):
+    tracemalloc.start()
+    records = {str(i): make_record(i) for i in range(count)}
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    dict_size = measure(dict_record, count)
+    slots_size = measure(slots_record, count)
+    print(f"{count} users")
+    print(f"dict records:  {dict_size / 2**20:8.1f} MiB  ({dict_size / count:6.0f} bytes/user)")
+    print(f"UserRecord:    {slots_size / 2**20:8.1f} MiB  ({slots_size / count:6.0f} bytes/user)")
+    print(f"reduction:     {100 * (1 - slots_size / dict_size):8.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Blackjack cards, hands and the shoe they are dealt from.
+
+A card is its rank as an int, 0 for a two up to 12 for an ace; suits never
+matter and aren't shown. A hand is one int holding its cards and running
+total, updated as each card is added, so scoring a hand never looks at
+its cards:
+
+    bits 0-4    hard total, every ace counted as 1
+    bit 5       set if the hand holds an ace
+    bits 6-10   number of cards
+    bits 11-    4 bits per card, first card lowest
+
+At most one ace can count as 11 without busting, so the hard total and
+the ace bit are enough for the score. A hand stops taking cards at 21, so
+the hard total never passes 31. The longest hand is 20 cards: ten aces
+(a soft 20), a two, eight more aces and one last card, which takes 19 aces
+and so a shoe of five decks or more.
+"""
+import random
+
+RANKS = ("2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K", "A")
+ACE = 12
+# Points for each rank, aces counting 1
+VALUES = (2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10, 1)
+
+_HARD = 0x1F
+_HAS_ACE = 1 << 5
+_COUNT_SHIFT = 6
+_COUNT_MASK = 0x1F
+_CARDS_SHIFT = 11
+_CARD_BITS = 4
+
+EMPTY_HAND = 0
+
+
+def add_card(hand, card):
+    count = (hand >> _COUNT_SHIFT) & _COUNT_MASK
+    hand += VALUES[card] + (1 << _COUNT_SHIFT) + (card << (_CARDS_SHIFT + _CARD_BITS * count))
+    if card == ACE:
+        hand |= _HAS_ACE
+    return hand
+
+
+def make_hand(cards):
+    hand = EMPTY_HAND
+    for card in cards:
+        hand = add_card(hand, card)
+    return hand
+
+
+def score(hand):
+    hard = hand & _HARD
+    return hard + 10 if hand & _HAS_ACE and hard <= 11 else hard
+
+
+def is_soft(hand):
+    """Return whether an ace in the hand counts as 11"""
+    return bool(hand & _HAS_ACE) and hand & _HARD <= 11
+
+
+def state(hand):
+    """Return just the hand's hard total and ace bit, all that decides how it plays on.
+
+    A state is itself a hand with no cards recorded, so score(), is_soft()
+    and add_card() work on it. There are STATES of them.
+    """
+    return hand & (_HARD | _HAS_ACE)
+
+
+STATES = _HAS_ACE << 1
+
+
+def card_count(hand):
+    return (hand >> _COUNT_SHIFT) & _COUNT_MASK
+
+
+def is_blackjack(hand):
+    return card_count(hand) == 2 and score(hand) == 21
+
+
+def cards(hand):
+    return [(hand >> (_CARDS_SHIFT + _CARD_BITS * i)) & 0xF for i in range(card_count(hand))]
+
+
+def first_card(hand):
+    return (hand >> _CARDS_SHIFT) & 0xF
+
+
+def describe(hand):
+    """Return the hand's cards as text, such as "A 10\""""
+    return " ".join(RANKS[card] for card in cards(hand))
+
+
+class Shoe:
+    """decks decks of cards, shuffled together and dealt in order.
+
+    One shoe deals every table. It is shuffled again once penetration of
+    its cards have been dealt, but only when a round starts (or, should it
+    run dry, mid-hand), so every round's cards come from the same shuffle.
+    """
+
+    def __init__(self, decks=6, penetration=0.75):
+        self.cards = bytearray(rank for _ in range(4 * decks) for rank in range(len(RANKS)))
+        self.cut = int(len(self.cards) * penetration)
+        self.position = 0
+        self.shuffle()
+
+    def shuffle(self):
+        random.shuffle(self.cards)
+        self.position = 0
+
+    def start_round(self):
+        """Shuffle if the cut card has come out; call before dealing a round"""
+        if self.position >= self.cut:
+            self.shuffle()
+
+    def draw(self):
+        if self.position == len(self.cards):
+            self.shuffle()
+        card = self.cards[self.position]
+        self.position += 1
+        return card
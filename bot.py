@@ -1,11 +1,35 @@
 import os
 import random
 import json
+import asyncio
+import heapq
+import time
+import uuid
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import lru_cache
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, ContextTypes, filters
+
+import blackjack
+from leaderboard import Leaderboard, StoredLeaderboard
+from locks import UserUpdateProcessor
+from metrics import CONTENT_TYPE, Registry, timed, watch_loop_lag
+from outbox import Outbox, PriorityRateLimiter
+from payouts import (
+    BLACKJACK_DECKS, BLACKJACK_PAYOUTS, BLACKJACK_PENETRATION, BONUS_BASE, BONUS_MULTIPLIERS, DAILY_REWARDS, GAMES,
+    LUCKY_BONUS_CHANCE, LUCKY_BONUS_TENS, PREMIUM_UPGRADE_CHANCE, PREMIUM_UPGRADE_DAYS, PREMIUM_UPGRADE_WINS, SLOTS,
+    SLOTS_SPINS, premium_bonus,
+)
+from quiz import DIFFICULTIES, QuestionBank
+from records import WIN_RATE_MIN_GAMES, UserRecord, win_rate
+from sessions import SessionStore
+from shards import SHARD_PATH, ShardClient, run_dispatcher
+from storage import TRANSIENT_ERRORS, StorageWriter, open_storage
+from strategy import BasicStrategy
+from webhook import WebhookServer, run_webhook
 
 # Enable logging
 logging.basicConfig(
@@ -16,119 +40,729 @@ logger = logging.getLogger(__name__)
 # Get environment variables
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 ADMIN_IDS = [int(admin_id) for admin_id in os.environ.get("ADMIN_IDS", "").split(",") if admin_id]
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "log")
+QUIZ_BANK = os.environ.get("QUIZ_BANK", os.path.join(os.path.dirname(os.path.abspath(__file__)), "quiz_questions.jsonl"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", "1"))
+FLUSH_SIZE = int(os.environ.get("FLUSH_SIZE", "500"))
+WRITE_QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", "8"))
+LEDGER_WINDOW = int(os.environ.get("LEDGER_WINDOW", "100000"))  # recent op ids remembered for idempotency
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+MAX_ACTIVE_GAMES = int(os.environ.get("MAX_ACTIVE_GAMES", "0")) or None
+ABANDONED_GAME_POLICY = os.environ.get("ABANDONED_GAME_POLICY", "forfeit")  # or "refund"
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "polling")  # or "webhook", or "sharded"
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # registered with Telegram at startup if set
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+SHARDS = int(os.environ.get("SHARDS", "1"))  # worker processes in sharded mode
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0"))  # set for each worker by the dispatcher
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", str(WEBHOOK_PORT + 1)))  # worker i listens on this + i
+SEND_RATE = float(os.environ.get("SEND_RATE", "30"))  # Bot API calls a second for the whole bot; 0 turns pacing off
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # serve /metrics on this port; 0 turns it off
+GAME_SWEEP_INTERVAL = 60  # seconds between checks for abandoned games
+TOTALS_CHECK_INTERVAL = 3600  # seconds between /stats_global drift checks
+PREMIUM_EXPIRY_INTERVAL = 60  # seconds between runs of the premium expiry job
+LEADERBOARD_SIZE = 10  # users shown by /leaderboard
+WRITE_RETRY_MAX = 60  # longest wait in seconds before retrying a write that failed
+QUIZ_CACHE_SIZE = 1024  # quiz questions kept parsed, with their answer keyboards
+
+# Data storage: users caches recently used records, the backend holds the rest
+users = OrderedDict()
+store = open_storage(STORAGE_BACKEND, DATA_DIR)
+writer = StorageWriter(WRITE_QUEUE_SIZE)
+
+# Users are split between SHARDS worker processes by user id; operations on a
+# user another worker owns go through shards.call()
+shards = ShardClient(SHARD_INDEX, SHARDS, SHARD_BASE_PORT, WEBHOOK_SECRET)
+
+# Notifications to users other than the one being answered, sent in the background
+outbox = Outbox()
+
+# Metrics served on METRICS_PORT
+metrics = Registry()
+handler_seconds = metrics.histogram("bot_handler_seconds", "Time spent in each handler", ("kind", "name"))
+handler_errors = metrics.counter("bot_handler_errors_total", "Handler calls that raised", ("kind", "name"))
+storage_seconds = metrics.histogram("bot_storage_seconds", "Time spent in each kind of storage call", ("call",))
+storage_errors = metrics.counter("bot_storage_errors_total", "Storage calls that raised", ("call",))
+loop_lag = metrics.histogram("bot_event_loop_lag_seconds", "How late the event loop woke from a one second sleep")
+metrics.gauge("bot_active_games", "Games in progress", function=lambda: len(games))
+metrics.gauge("bot_cached_users", "User records held in memory", function=lambda: len(users))
+metrics.gauge("bot_dirty_users", "Changed users waiting for a flush", function=lambda: len(dirty_users))
+metrics.gauge("bot_pending_writes", "Storage calls queued for the writer thread", function=lambda: writer.pending)
+metrics_server = None
+lag_watcher = None
+
+# store's methods wrapped by timed_storage(), by name
+storage_calls = {}
+
+def timed_storage(name):
+    """Return the store's method name, wrapped to record how long calls take"""
+    call = storage_calls.get(name)
+    if call is None:
+        call = timed(storage_seconds.labels(name), storage_errors.labels(name))(getattr(store, name))
+        storage_calls[name] = call
+    return call
+
+# Changes not yet written to storage: ids of changed users, new daily claims
+# and users' quiz seen sets
+dirty_users = set()
+pending_claims = {}
+pending_quiz_seen = {}
+dirty_games = set()
+# Ledger entries for credit changes, written with the users they changed
+pending_entries = []
+# Copies handed to the writer thread but not yet confirmed written
+writing_users = {}
+writing_claims = {}
+writing_quiz_seen = {}
+writing_games = {}
+flush_task = None
+# Writes that failed in a row, and the time.monotonic() before which
+# periodic flushes leave the storage alone
+write_failures = 0
+write_retry_at = 0.0
+
+# Ids of the last LEDGER_WINDOW ledger operations, oldest first
+recent_ops = OrderedDict()
+
+# Running totals for /stats_global, kept current by the helpers that change them
+totals = {"total_users": 0, "premium_users": 0, "total_credits": 0, "total_games": 0}
+
+# Leaderboards: name -> (title, score of a user, or None to leave them off
+# the board). With the log backend the boards are kept in memory and
+# update_user() moves users as their scores change. With SQLite the top
+# users come from its indexes and ranks from counts of each score, so
+# startup doesn't read every user.
+LEADERBOARDS = {
+    "credits": ("💰 Credits", lambda user: user.credits),
+    "earnings": ("💵 Total Earnings", lambda user: user.total_earnings),
+    "wins": ("🏆 Games Won", lambda user: user.games_won),
+    "winrate": ("🎯 Win Rate", win_rate),
+}
+if STORAGE_BACKEND == "sqlite":
+    leaderboard = StoredLeaderboard(
+        {name: score for name, (title, score) in LEADERBOARDS.items()},
+        timed_storage, lambda: unwritten_users(),
+    )
+else:
+    leaderboard = Leaderboard({name: score for name, (title, score) in LEADERBOARDS.items()})
+
+# Every blackjack game is dealt from this shoe; a game keeps only its two hands
+shoe = blackjack.Shoe(BLACKJACK_DECKS, BLACKJACK_PENETRATION)
+# What hitting and standing return for every hand, for hints and the audit;
+# loaded by load_data()
+basic_strategy = None
+# Blackjack play on this shard since it started, for /bjaudit: credits
+# staked, what basic strategy expected them to return, what was paid, and
+# the hit/stand decisions made, how many went against basic strategy and
+# the expected credits those cost
+blackjack_audit = {"games": 0, "staked": 0, "expected": 0.0, "paid": 0, "decisions": 0, "mistakes": 0, "ev_lost": 0.0}
+
+# Heap of (premium expiry, user id) for expire_premium(); entries for users
+# whose premium has since changed are skipped when they come up
+premium_expiries = []
+
+# Quiz questions, read from QUIZ_BANK as they are asked; loaded by load_data()
+quiz_bank = None
+
+# Keyboards and menu text that never change, built once and shared by every
+# handler. InlineKeyboardMarkup is immutable, so one instance can be sent to
+# any number of chats. Tables keyed by a bool are indexed by premium status.
+def make_keyboard(*rows):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=data) for text, data in row]
+        for row in rows
+    ])
+
+BACK_TO_MENU = ("🔙 Back to Menu", "menu")
+BACK_TO_GAMES = ("🔙 Back to Games", "games")
+PLAY_GAMES = ("🎮 Play Games", "games")
+
+START_KEYBOARD = make_keyboard(
+    [PLAY_GAMES],
+    [("💰 Check Credits", "credits")],
+    [("📊 My Stats", "stats")],
+)
+MAIN_MENU_KEYBOARD = make_keyboard(
+    [PLAY_GAMES],
+    [("💰 Check Credits", "credits")],
+    [("🎁 Claim Daily", "daily")],
+    [("📊 My Stats", "stats")],
+)
+CREDITS_KEYBOARD = make_keyboard([PLAY_GAMES], [("🎁 Claim Daily", "daily")], [BACK_TO_MENU])
+DAILY_CLAIMED_KEYBOARD = make_keyboard([PLAY_GAMES], [BACK_TO_MENU])
+BACK_TO_MENU_KEYBOARD = make_keyboard([BACK_TO_MENU])
+BACK_TO_GAMES_KEYBOARD = make_keyboard([BACK_TO_GAMES])
+NO_CREDITS_KEYBOARD = make_keyboard([("💰 Claim Daily Reward", "daily")], [BACK_TO_MENU])
+
+DICE_KEYBOARD = make_keyboard(
+    [(str(n), f"guess_{n}") for n in range(1, 4)],
+    [(str(n), f"guess_{n}") for n in range(4, 7)],
+)
+RPS_KEYBOARD = make_keyboard([("🪨 Rock", "rps_rock"), ("📄 Paper", "rps_paper"), ("✂️ Scissors", "rps_scissors")])
+BLACKJACK_KEYBOARD = make_keyboard([("🎯 Hit", "bj_hit"), ("🛑 Stand", "bj_stand")], [("💡 Hint", "bj_hint")])
+
+@lru_cache(maxsize=QUIZ_CACHE_SIZE)
+def quiz_question(question_id):
+    """Return a question from the bank and its answer keyboard"""
+    question = quiz_bank.question(question_id)
+    keyboard = make_keyboard(*([(option, f"answer_{i}")] for i, option in enumerate(question["options"])))
+    return question, keyboard
+
+# Shown when a game ends: game type -> (keyboard after a win, after a loss)
+PLAY_AGAIN_KEYBOARDS = {
+    game: (
+        make_keyboard([("🎮 Play Again", f"play_{game}")], [BACK_TO_GAMES]),
+        make_keyboard([("🎮 Try Again", f"play_{game}")], [BACK_TO_GAMES]),
+    )
+    for game in ("dice", "number", "quiz", "rps")
+}
+SLOTS_AGAIN_KEYBOARD = make_keyboard(
+    [(f"🎰 Spin x{spins}" if spins > 1 else "🎰 Spin Again", f"spin_{spins}") for spins in SLOTS_SPINS],
+    [BACK_TO_GAMES],
+)
+BLACKJACK_AGAIN_KEYBOARD = make_keyboard([("♠️ Play Again", "play_blackjack")], [BACK_TO_GAMES])
+
+NO_CREDITS_TEXT = "You don't have enough credits to play. You need {cost} credits."
+DAILY_REWARDS_TEXT = (
+    f"Daily Rewards:\n"
+    f"- Free users: {DAILY_REWARDS[False]} credits\n"
+    f"- Premium users: {DAILY_REWARDS[True]} credits"
+)
+DAILY_PREMIUM_TIP = f"💡 Tip: Premium users get {DAILY_REWARDS[True]} credits a day instead of {DAILY_REWARDS[False]}!"
+
+def build_games_menu(premium):
+    """Return the /games text (without the balance line) and keyboard"""
+    message = "🎮 Available Games:\n\n"
+    
+    # Free games
+    message += "Free Games:\n"
+    for game, details in GAMES.items():
+        if details.get("premium_only", False):
+            continue
+        cost = details["premium_cost"] if premium else details["cost"]
+        message += f"/{game} - Cost: {cost} credits\n"
+    
+    # Premium games
+    if premium:
+        message += "\n💎 Premium Games:\n"
+        for game, details in GAMES.items():
+            if details.get("premium_only", False):
+                message += f"/{game} - Cost: {details['premium_cost']} credits\n"
+    else:
+        message += "\n💎 Premium Games (unlock with premium status):\n"
+        for game, details in GAMES.items():
+            if details.get("premium_only", False):
+                message += f"/{game} - Requires premium\n"
+    
+    rows = [
+        [("🎲 Dice", "play_dice"), ("🔢 Number", "play_number")],
+        [("❓ Quiz", "play_quiz"), ("✂️ RPS", "play_rps")],
+    ]
+    if premium:
+        rows.append([("🎰 Slots", "play_slots"), ("♠️ Blackjack", "play_blackjack")])
+    rows.append([BACK_TO_MENU])
+    
+    return message, make_keyboard(*rows)
+
+GAMES_MENUS = {premium: build_games_menu(premium) for premium in (False, True)}
+
+def build_help(premium, admin):
+    help_message = (
+        "📚 Game Bot Commands\n\n"
+        "Basic Commands:\n"
+        "/start - Initialize the bot\n"
+        "/games - Show available games\n"
+        "/credits - Check your credit balance\n"
+        "/daily - Claim daily reward\n"
+        "/stats - View your statistics\n"
+        "/leaderboard - See the top players\n"
+        "/rank - See where you stand\n"
+        "/help - Show this help message\n\n"
+        "Game Commands:\n"
+        "/dice - Roll the dice game\n"
+        "/number - Number guessing game\n"
+        f"/quiz [category] [{'|'.join(DIFFICULTIES)}] - Trivia quiz game\n"
+        "/rps - Rock Paper Scissors\n"
+    )
+    
+    if premium:
+        help_message += (
+            "\nPremium Games:\n"
+            f"/slots [{'|'.join(map(str, SLOTS_SPINS[1:]))}] - Premium slots game, optionally several spins at once\n"
+            "/blackjack - Premium blackjack game\n"
+        )
+    
+    if admin:
+        help_message += (
+            "\n🔑 Admin Commands:\n"
+            "/givepremium <username> <days> - Give premium status\n"
+            "/revokepremium <username> - Revoke premium status\n"
+            "/addcredits <username> <amount> - Add credits\n"
+            "/stats_global - View bot statistics\n"
+            "/bjaudit - Compare blackjack results with basic strategy\n"
+        )
+    
+    return help_message
 
-# Data storage (in a real application, use a database)
-users = {}
-games = {}
-daily_claims = {}
-
-# Game configurations
-GAMES = {
-    "dice": {"cost": 10, "premium_cost": 5},
-    "number": {"cost": 15, "premium_cost": 7},
-    "quiz": {"cost": 20, "premium_cost": 10},
-    "rps": {"cost": 10, "premium_cost": 5},  # Rock Paper Scissors
-    "slots": {"cost": 25, "premium_cost": 12, "premium_only": True},
-    "blackjack": {"cost": 50, "premium_cost": 25, "premium_only": True},
+# (premium, admin) -> /help text
+HELP_TEXTS = {
+    (premium, admin): build_help(premium, admin)
+    for premium in (False, True) for admin in (False, True)
 }
 
-# Quiz questions
-QUIZ_QUESTIONS = [
-    {
-        "question": "What is the capital of France?",
-        "options": ["London", "Berlin", "Paris", "Madrid"],
-        "answer": 2,  # Paris (0-indexed)
-    },
-    {
-        "question": "Which planet is known as the Red Planet?",
-        "options": ["Venus", "Mars", "Jupiter", "Saturn"],
-        "answer": 1,  # Mars
-    },
-    {
-        "question": "What is 2 + 2?",
-        "options": ["3", "4", "5", "22"],
-        "answer": 1,  # 4
-    },
-    {
-        "question": "Who wrote 'Romeo and Juliet'?",
-        "options": ["Charles Dickens", "William Shakespeare", "Jane Austen", "Mark Twain"],
-        "answer": 1,  # William Shakespeare
-    },
-    {
-        "question": "What is the largest ocean on Earth?",
-        "options": ["Atlantic Ocean", "Indian Ocean", "Arctic Ocean", "Pacific Ocean"],
-        "answer": 3,  # Pacific Ocean
-    },
-]
+# Active games, closed by close_abandoned_game() once left idle too long
+def close_abandoned_game(user_id, game):
+    if ABANDONED_GAME_POLICY == "refund":
+        credit(user_id, game["cost"], f"refund:{game['type']}", earned=False)
+        logger.info(f"Refunded {game['cost']} credits for an abandoned {game['type']} game of user {user_id}")
+
+def game_changed(user_id):
+    dirty_games.add(user_id)
+    if len(dirty_games) >= FLUSH_SIZE:
+        request_flush()
+
+def load_game(user_id):
+    """Find a game saved before the last restart"""
+    if user_id in dirty_games:
+        # Changed since the last flush and no longer in memory, so it has ended
+        return None
+    user_id_str = str(user_id)
+    if user_id_str in writing_games:
+        saved = writing_games[user_id_str]
+    else:
+        saved = timed_storage("get_session")(user_id_str)
+    if saved is None:
+        return None
+    game_json, last_used, expires = saved
+    game = json.loads(game_json)
+    if game["type"] == "blackjack" and "player_hand" in game:
+        # Saved before hands were packed into ints; its deck goes back to the shoe's odds
+        game = {
+            "type": "blackjack",
+            "player": blackjack.make_hand(blackjack.RANKS.index(card) for card in game["player_hand"]),
+            "dealer": blackjack.make_hand(blackjack.RANKS.index(card) for card in game["dealer_hand"]),
+            "cost": game["cost"],
+        }
+    return game, last_used
+
+games = SessionStore(
+    {game: details["timeout"] for game, details in GAMES.items() if "timeout" in details},
+    max_size=MAX_ACTIVE_GAMES,
+    on_expire=close_abandoned_game,
+    on_change=game_changed,
+    loader=load_game,
+)
+
+async def sweep_games(context: ContextTypes.DEFAULT_TYPE):
+    closed = games.sweep()
+    
+    # Saved games nobody has come back to since a restart are only in storage
+    expired = await writer.submit(timed_storage("expired_sessions"), time.time())
+    for user_id_str in expired:
+        user_id = int(user_id_str)
+        # Looking the game up loads it, finds it expired and closes it
+        if user_id not in games.sessions and user_id not in games:
+            closed += 1
+    
+    if closed:
+        logger.info(f"Closed {closed} abandoned games, {len(games)} still active")
 
 # Save and load data functions
+def write_changes():
+    """Hand a copy of every pending change to the writer thread.
+
+    Returns a task that finishes once the batch has been written.
+    """
+    changed = {user_id_str: users[user_id_str].copy() for user_id_str in dirty_users}
+    claims = dict(pending_claims)
+    quiz_seen = dict(pending_quiz_seen)
+    entries = list(pending_entries)
+    sessions = {}
+    for user_id in dirty_games:
+        # Games are saved as JSON, which is also the copy the writer needs
+        session = games.export(user_id)
+        if session is not None:
+            game, last_used, expires = session
+            session = (json.dumps(game, separators=(",", ":")), last_used, expires)
+        sessions[str(user_id)] = session
+    dirty_users.clear()
+    pending_claims.clear()
+    pending_quiz_seen.clear()
+    dirty_games.clear()
+    pending_entries.clear()
+    writing_users.update(changed)
+    writing_claims.update(claims)
+    writing_quiz_seen.update(quiz_seen)
+    writing_games.update(sessions)
+    write = writer.submit(timed_storage("save_many"), changed, claims, sessions, entries, quiz_seen)
+    return asyncio.ensure_future(finish_write(write, changed, claims, sessions, entries, quiz_seen))
+
+async def finish_write(write, changed, claims, sessions, entries, quiz_seen):
+    global write_failures, write_retry_at
+    try:
+        await write
+    except TRANSIENT_ERRORS as e:
+        # Retried with backoff, so an outage isn't hit with a write every interval
+        write_failures += 1
+        delay = min(FLUSH_INTERVAL * 2 ** write_failures, WRITE_RETRY_MAX)
+        write_retry_at = time.monotonic() + delay
+        logger.error(f"Failed to save {len(changed)} users, will retry in {delay:g}s: {e}")
+        for user_id_str, data in changed.items():
+            users.setdefault(user_id_str, writing_users.get(user_id_str, data).copy())
+            dirty_users.add(user_id_str)
+        for user_id_str, day in claims.items():
+            pending_claims.setdefault(user_id_str, day)
+        for user_id_str, seen in quiz_seen.items():
+            pending_quiz_seen.setdefault(user_id_str, seen)
+        dirty_games.update(int(user_id_str) for user_id_str in sessions)
+        # Ahead of entries made since, keeping each user's entries in order
+        pending_entries[:0] = entries
+    except Exception:
+        # Writing the same batch again would fail the same way and hold up
+        # every later write behind it
+        logger.exception(f"Dropped {len(changed)} users and {len(entries)} ledger entries that can't be written")
+        write_failures = 0
+    else:
+        write_failures = 0
+    finally:
+        # A later flush may have replaced these copies with newer ones
+        for user_id_str, data in changed.items():
+            if writing_users.get(user_id_str) is data:
+                del writing_users[user_id_str]
+        for user_id_str, day in claims.items():
+            if writing_claims.get(user_id_str) == day:
+                del writing_claims[user_id_str]
+        for user_id_str, seen in quiz_seen.items():
+            if writing_quiz_seen.get(user_id_str) == seen:
+                del writing_quiz_seen[user_id_str]
+        for user_id_str, session in sessions.items():
+            if writing_games.get(user_id_str) is session:
+                del writing_games[user_id_str]
+
+async def flush_data():
+    """Write every changed user, daily claim, quiz seen set, game and ledger entry in one batch.
+
+    The write runs on the storage writer thread; this waits while the
+    writer's queue is full and then until the batch is on disk.
+    """
+    await writer.wait_for_room()
+    if not dirty_users and not pending_claims and not pending_quiz_seen and not dirty_games and not pending_entries:
+        return
+    await write_changes()
+
+def request_flush():
+    """Start a flush from synchronous code without waiting for it"""
+    global flush_task
+    if time.monotonic() < write_retry_at:
+        return
+    if flush_task is None or flush_task.done():
+        flush_task = asyncio.get_running_loop().create_task(flush_data())
+
+async def flush_job(context: ContextTypes.DEFAULT_TYPE):
+    if time.monotonic() < write_retry_at:
+        return
+    await flush_data()
+
+async def startup(application: Application):
+    global metrics_server, lag_watcher
+    outbox.start(application.bot)
+    if not METRICS_PORT:
+        return
+    lag_watcher = asyncio.get_running_loop().create_task(watch_loop_lag(loop_lag))
+    metrics_server = WebhookServer(
+        METRICS_LISTEN, METRICS_PORT, {"/metrics": metrics.handle}, method="GET", content_type=CONTENT_TYPE
+    )
+    await metrics_server.start()
+    logger.info(f"Serving metrics on {METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+async def shutdown(application: Application):
+    await outbox.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    if lag_watcher is not None:
+        lag_watcher.cancel()
+    await flush_data()
+    await writer.stop()
+
 def save_data():
-    with open("users.json", "w") as f:
-        json.dump(users, f)
-    with open("daily_claims.json", "w") as f:
-        json.dump(daily_claims, f)
+    """Make everything written so far cheap to load on the next start"""
+    timed_storage("checkpoint")()
 
 def load_data():
-    global users, daily_claims
-    try:
+    global basic_strategy, quiz_bank
+    users.clear()
+    dirty_users.clear()
+    pending_claims.clear()
+    pending_quiz_seen.clear()
+    dirty_games.clear()
+    pending_entries.clear()
+    writing_users.clear()
+    writing_claims.clear()
+    writing_quiz_seen.clear()
+    writing_games.clear()
+    store.load()
+    basic_strategy = BasicStrategy.load(os.path.join(DATA_DIR, "blackjack_strategy.json"))
+    quiz_bank = QuestionBank(QUIZ_BANK, os.path.join(DATA_DIR, "quiz_index.bin"))
+    quiz_question.cache_clear()
+    
+    # Import data saved by older versions as whole JSON files; in sharded
+    # mode every worker reads them and keeps only the users it owns
+    if store.is_empty() and os.path.exists("users.json"):
         with open("users.json", "r") as f:
-            users = json.load(f)
-        with open("daily_claims.json", "r") as f:
-            daily_claims = json.load(f)
-    except FileNotFoundError:
-        users = {}
-        daily_claims = {}
+            old_users = json.load(f)
+        old_claims = {}
+        if os.path.exists("daily_claims.json"):
+            with open("daily_claims.json", "r") as f:
+                old_claims = json.load(f)
+        old_users = {uid: data for uid, data in old_users.items() if shards.owner(uid) == shards.index}
+        old_claims = {uid: day for uid, day in old_claims.items() if shards.owner(uid) == shards.index}
+        store.save_many({uid: UserRecord.from_dict(data) for uid, data in old_users.items()}, old_claims)
+        save_data()
+        logger.info(f"Imported {len(old_users)} users from users.json")
+    
+    totals.update(store.aggregates())
+    if isinstance(leaderboard, Leaderboard):
+        leaderboard.load(store.all_users())
+    else:
+        leaderboard.load()
+    premium_expiries[:] = [(expiry, user_id_str) for user_id_str, expiry in store.premium_expiries()]
+    heapq.heapify(premium_expiries)
+    recent_ops.clear()
+    recent_ops.update((op_id, None) for op_id in store.recent_ops(LEDGER_WINDOW))
 
 # Helper functions
 def get_user(user_id):
     user_id_str = str(user_id)
-    if user_id_str not in users:
-        users[user_id_str] = {
-            "credits": 100,
-            "is_premium": False,
-            "premium_expiry": None,
-            "games_played": 0,
-            "games_won": 0,
-            "total_earnings": 0,
-        }
-    return users[user_id_str]
+    user = users.get(user_id_str)
+    if user is not None:
+        users.move_to_end(user_id_str)
+        return user
+    
+    if user_id_str in writing_users:
+        user = writing_users[user_id_str].copy()
+    else:
+        user = timed_storage("get_user")(user_id_str)
+    if user is None:
+        user = UserRecord()
+        leaderboard.update(user_id_str, user)
+        dirty_users.add(user_id_str)
+        totals["total_users"] += 1
+        totals["total_credits"] += user["credits"]
+    else:
+        leaderboard.track(user_id_str, user)
+
+    users[user_id_str] = user
+    if len(users) > USER_CACHE_SIZE:
+        # Unsaved records stay cached until a flush has taken them
+        if next(iter(users)) in dirty_users:
+            request_flush()
+        else:
+            leaderboard.forget(users.popitem(last=False)[0])
+    return user
 
 def update_user(user_id, data):
+    """Apply changes to a user; they are written out by the next flush"""
     user_id_str = str(user_id)
-    users[user_id_str].update(data)
-    save_data()
-
-def is_premium(user_id):
+    # The record may have been evicted from the cache since the caller read it
     user = get_user(user_id)
-    if not user["is_premium"]:
-        return False
-    
-    if user["premium_expiry"] is None:
+    if user is not data:
+        user.update(data)
+    leaderboard.update(user_id_str, user)
+    dirty_users.add(user_id_str)
+    if len(dirty_users) >= FLUSH_SIZE:
+        request_flush()
+
+def unwritten_users():
+    """Return user id -> record for every user with changes storage doesn't have yet"""
+    unwritten = dict(writing_users)
+    unwritten.update((user_id_str, users[user_id_str]) for user_id_str in dirty_users)
+    return unwritten
+
+def get_daily_claim(user_id_str):
+    if user_id_str in pending_claims:
+        return pending_claims[user_id_str]
+    if user_id_str in writing_claims:
+        return writing_claims[user_id_str]
+    return timed_storage("get_daily_claim")(user_id_str)
+
+def save_daily_claim(user_id_str, day):
+    pending_claims[user_id_str] = day
+    if len(pending_claims) >= FLUSH_SIZE:
+        request_flush()
+
+def get_quiz_seen(user_id_str):
+    if user_id_str in pending_quiz_seen:
+        return pending_quiz_seen[user_id_str]
+    if user_id_str in writing_quiz_seen:
+        return writing_quiz_seen[user_id_str]
+    return timed_storage("get_quiz_seen")(user_id_str)
+
+def save_quiz_seen(user_id_str, seen):
+    pending_quiz_seen[user_id_str] = seen
+    if len(pending_quiz_seen) >= FLUSH_SIZE:
+        request_flush()
+
+@shards.op
+async def find_user_by_username(username):
+    """Find a user on this shard by username"""
+    # Records not yet written hold the newest usernames, and the storage
+    # index only knows about those that have been
+    key = username.lower()
+    unwritten = unwritten_users()
+    for user_id_str, data in unwritten.items():
+        if data.username and data.username.lower() == key:
+            return user_id_str
+    user_id_str = timed_storage("find_user_by_username")(username)
+    if user_id_str in unwritten:
+        # Renamed since it was written
+        return None
+    return user_id_str
+
+async def locate_user(username):
+    """Find a user by username on whichever shard holds them"""
+    for user_id in await shards.call_all("find_user_by_username", username=username):
+        if user_id is not None:
+            return user_id
+    return None
+
+# Credits only change through debit(), credit() and transfer(). Each call is
+# one operation: it never awaits, so nothing else runs halfway through it,
+# and its ledger entries are written in the same batch as the records it
+# changed. An op_id that was already applied is ignored, so an operation
+# repeated with the same id (say, a resent admin command) happens once.
+def start_op(op_id):
+    """Return the id to record an operation under, or None if it already happened"""
+    if op_id is None:
+        return uuid.uuid4().hex
+    if op_id in recent_ops:
+        logger.info(f"Skipping ledger operation {op_id}, already applied")
+        return None
+    return op_id
+
+def finish_op(op_id):
+    recent_ops[op_id] = None
+    if len(recent_ops) > LEDGER_WINDOW:
+        recent_ops.popitem(last=False)
+
+def post_entry(user_id, user_data, amount, reason, op_id):
+    user_data["credits"] += amount
+    totals["total_credits"] += amount
+    pending_entries.append((op_id, str(user_id), amount, user_data["credits"], reason, time.time()))
+    update_user(user_id, user_data)
+
+def debit(user_id, amount, reason, op_id=None):
+    """Take credits from a user; return False if they don't have enough"""
+    op_id = start_op(op_id)
+    if op_id is None:
         return True
-    
-    expiry = datetime.fromisoformat(user["premium_expiry"])
-    if expiry > datetime.now():
+    user_data = get_user(user_id)
+    if user_data["credits"] < amount:
+        return False
+    post_entry(user_id, user_data, -amount, reason, op_id)
+    finish_op(op_id)
+    return True
+
+def credit(user_id, amount, reason, op_id=None, won=False, earned=True):
+    """Give a user credits.
+
+    earned counts them towards the user's total earnings (refunds aren't),
+    and won counts a won game, or is the number of games won.
+    """
+    op_id = start_op(op_id)
+    if op_id is None:
+        return
+    user_data = get_user(user_id)
+    if earned:
+        user_data["total_earnings"] += amount
+    if won:
+        user_data["games_won"] += won
+    post_entry(user_id, user_data, amount, reason, op_id)
+    finish_op(op_id)
+
+def transfer(from_user_id, to_user_id, amount, reason, op_id=None):
+    """Move credits between two users this shard owns; return False if the sender is short"""
+    if str(from_user_id) == str(to_user_id):
+        raise ValueError("Can't transfer credits to the same user")
+    op_id = start_op(op_id)
+    if op_id is None:
         return True
+    sender = get_user(from_user_id)
+    if sender["credits"] < amount:
+        return False
+    post_entry(from_user_id, sender, -amount, reason, op_id)
+    post_entry(to_user_id, get_user(to_user_id), amount, reason, op_id)
+    finish_op(op_id)
+    return True
+
+def count_game(user_data, count=1):
+    user_data["games_played"] += count
+    totals["total_games"] += count
+
+def set_premium(user_id, user_data, premium, expiry):
+    if premium != bool(user_data["is_premium"]):
+        totals["premium_users"] += 1 if premium else -1
+    user_data["is_premium"] = premium
+    user_data["premium_expiry"] = expiry
+    if premium and expiry is not None:
+        heapq.heappush(premium_expiries, (expiry, str(user_id)))
+
+async def remember_username(user_id, username):
+    """Store the user's current Telegram username so admins can find them"""
+    user = get_user(user_id)
+    if user.get("username") == username:
+        return
     
-    # Premium expired
-    user["is_premium"] = False
+    # Usernames can move to another account, which then owns the name
+    if username:
+        previous_id = await locate_user(username)
+        if previous_id is not None and previous_id != str(user_id):
+            await shards.call(shards.owner(previous_id), "forget_username", user_id=previous_id)
+        # Others may have changed the user during the awaits, or it may have
+        # left the cache, so set the name on the current record
+        user = get_user(user_id)
+
+    user["username"] = username
+    update_user(user_id, user)
+
+@shards.op
+async def forget_username(user_id):
+    user = get_user(user_id)
+    user["username"] = None
     update_user(user_id, user)
-    return False
+
+def is_premium(user_id):
+    # Only reads: expired premium is switched off by expire_premium()
+    user = get_user(user_id)
+    return user.is_premium and (user.premium_expiry is None or user.premium_expiry > time.time())
+
+async def expire_premium(context: ContextTypes.DEFAULT_TYPE):
+    """Switch off premium for everyone whose premium has run out"""
+    now = time.time()
+    while premium_expiries and premium_expiries[0][0] <= now:
+        expiry, user_id_str = heapq.heappop(premium_expiries)
+        user = get_user(user_id_str)
+        if user.is_premium and user.premium_expiry == expiry:
+            set_premium(user_id_str, user, False, expiry)
+            update_user(user_id_str, user)
 
 def is_admin(user_id):
     return user_id in ADMIN_IDS
 
-def award_random_points(user_id, base_amount=10, multiplier_range=(1, 5)):
+def award_random_points(user_id, base_amount=BONUS_BASE, multiplier_range=BONUS_MULTIPLIERS):
     """Award random points to a user with a chance for bonus"""
-    user = get_user(user_id)
-    
     # Base points
     multiplier = random.randint(*multiplier_range)
     points = base_amount * multiplier
     
-    # Lucky bonus (10% chance)
-    if random.random() < 0.1:
-        bonus = random.randint(1, 5) * 10
+    # Lucky bonus
+    if random.random() < LUCKY_BONUS_CHANCE:
+        bonus = random.randint(*LUCKY_BONUS_TENS) * 10
         points += bonus
         bonus_msg = f"\n🍀 Lucky bonus: +{bonus} credits!"
     else:
@@ -136,19 +770,23 @@ def award_random_points(user_id, base_amount=10, multiplier_range=(1, 5)):
     
     # Premium bonus
     if is_premium(user_id):
-        premium_bonus = points // 2  # 50% bonus for premium
-        points += premium_bonus
-        premium_msg = f"\n💎 Premium bonus: +{premium_bonus} credits!"
+        extra = premium_bonus(points)
+        points += extra
+        premium_msg = f"\n💎 Premium bonus: +{extra} credits!"
     else:
         premium_msg = ""
     
-    user["credits"] += points
-    user["total_earnings"] += points
-    update_user(user_id, user)
+    credit(user_id, points, "bonus")
     
     return points, f"{bonus_msg}{premium_msg}"
 
 # Command handlers
+async def track_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the username index current for whoever sent this update"""
+    user = update.effective_user
+    if user is not None:
+        await remember_username(user.id, user.username)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_data = get_user(user.id)
@@ -158,57 +796,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"You have {user_data['credits']} credits to start.\n"
         f"Use /help to see available commands.\n\n"
         f"💎 Premium Features:\n"
-        f"- Double credits rewards\n"
+        f"- {DAILY_REWARDS[True]} credits a day instead of {DAILY_REWARDS[False]}\n"
         f"- Exclusive games\n"
         f"- Reduced game costs\n"
         f"- Priority support\n\n"
         f"Win games to earn premium status!"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("🎮 Play Games", callback_data="games")],
-        [InlineKeyboardButton("💰 Check Credits", callback_data="credits")],
-        [InlineKeyboardButton("📊 My Stats", callback_data="stats")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    await update.message.reply_text(welcome_message, reply_markup=START_KEYBOARD)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    is_user_admin = is_admin(user_id)
-    
-    help_message = (
-        "📚 Game Bot Commands\n\n"
-        "Basic Commands:\n"
-        "/start - Initialize the bot\n"
-        "/games - Show available games\n"
-        "/credits - Check your credit balance\n"
-        "/daily - Claim daily reward\n"
-        "/stats - View your statistics\n"
-        "/help - Show this help message\n\n"
-        "Game Commands:\n"
-        "/dice - Roll the dice game\n"
-        "/number - Number guessing game\n"
-        "/quiz - Trivia quiz game\n"
-        "/rps - Rock Paper Scissors\n"
-    )
-    
-    if is_premium(user_id):
-        help_message += (
-            "\nPremium Games:\n"
-            "/slots - Premium slots game\n"
-            "/blackjack - Premium blackjack game\n"
-        )
-    
-    if is_user_admin:
-        help_message += (
-            "\n🔑 Admin Commands:\n"
-            "/givepremium <username> <days> - Give premium status\n"
-            "/revokepremium <username> - Revoke premium status\n"
-            "/addcredits <username> <amount> - Add credits\n"
-            "/stats_global - View bot statistics\n"
-        )
+    help_message = HELP_TEXTS[is_premium(user_id), is_admin(user_id)]
     
     await update.message.reply_text(help_message)
 
@@ -220,76 +819,24 @@ async def credits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     premium_expiry = ""
     if user_data["is_premium"] and user_data["premium_expiry"]:
-        expiry_date = datetime.fromisoformat(user_data["premium_expiry"])
+        expiry_date = datetime.fromtimestamp(user_data["premium_expiry"])
         premium_expiry = f"\nPremium expires: {expiry_date.strftime('%Y-%m-%d %H:%M')}"
     
     message = (
         f"💰 Your Credits: {user_data['credits']}\n"
         f"🎯 Status: {premium_status}{premium_expiry}\n\n"
-        f"Daily Rewards:\n"
-        f"- Free users: 50 credits\n"
-        f"- Premium users: 100 credits\n\n"
+        f"{DAILY_REWARDS_TEXT}\n\n"
         f"Use /games to start earning more credits!"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("🎮 Play Games", callback_data="games")],
-        [InlineKeyboardButton("🎁 Claim Daily", callback_data="daily")],
-        [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    await update.message.reply_text(message, reply_markup=CREDITS_KEYBOARD)
 
 async def games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_data = get_user(user_id)
-    is_user_premium = is_premium(user_id)
-    
-    message = "🎮 Available Games:\n\n"
-    
-    # Free games
-    message += "Free Games:\n"
-    for game, details in GAMES.items():
-        if details.get("premium_only", False):
-            continue
-        cost = details["premium_cost"] if is_user_premium else details["cost"]
-        message += f"/{game} - Cost: {cost} credits\n"
-    
-    # Premium games
-    if is_user_premium:
-        message += "\n💎 Premium Games:\n"
-        for game, details in GAMES.items():
-            if details.get("premium_only", False):
-                message += f"/{game} - Cost: {details['premium_cost']} credits\n"
-    else:
-        message += "\n💎 Premium Games (unlock with premium status):\n"
-        for game, details in GAMES.items():
-            if details.get("premium_only", False):
-                message += f"/{game} - Requires premium\n"
-    
+    message, reply_markup = GAMES_MENUS[is_premium(user_id)]
     message += f"\n💰 Your Credits: {user_data['credits']}"
     
-    keyboard = [
-        [
-            InlineKeyboardButton("🎲 Dice", callback_data="play_dice"),
-            InlineKeyboardButton("🔢 Number", callback_data="play_number"),
-        ],
-        [
-            InlineKeyboardButton("❓ Quiz", callback_data="play_quiz"),
-            InlineKeyboardButton("✂️ RPS", callback_data="play_rps"),
-        ],
-    ]
-    
-    if is_user_premium:
-        keyboard.append([
-            InlineKeyboardButton("🎰 Slots", callback_data="play_slots"),
-            InlineKeyboardButton("♠️ Blackjack", callback_data="play_blackjack"),
-        ])
-    
-    keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(message, reply_markup=reply_markup)
 
 async def daily_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -298,35 +845,27 @@ async def daily_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check if user has claimed daily reward today
     today = datetime.now().strftime("%Y-%m-%d")
-    if user_id_str in daily_claims and daily_claims[user_id_str] == today:
+    if get_daily_claim(user_id_str) == today:
         await update.message.reply_text(
             "You've already claimed your daily reward today. Come back tomorrow!",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")
-            ]])
+            reply_markup=BACK_TO_MENU_KEYBOARD
         )
         return
     
     # Give daily reward based on premium status
     user_data = get_user(user_id)
-    reward = 100 if is_premium(user_id) else 50
-    user_data["credits"] += reward
-    user_data["total_earnings"] += reward
-    update_user(user_id, user_data)
+    reward = DAILY_REWARDS[is_premium(user_id)]
+    credit(user_id, reward, "daily", op_id=f"daily:{user_id}:{today}")
     
     # Update daily claim
-    daily_claims[user_id_str] = today
-    save_data()
+    save_daily_claim(user_id_str, today)
     
     await update.message.reply_text(
         f"✅ Daily reward claimed!\n\n"
         f"You received {reward} credits.\n"
         f"Current balance: {user_data['credits']} credits.\n\n"
-        f"{'💎 Premium bonus applied!' if is_premium(user_id) else '💡 Tip: Premium users get double daily rewards!'}",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎮 Play Games", callback_data="games")],
-            [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-        ])
+        f"{'💎 Premium bonus applied!' if is_premium(user_id) else DAILY_PREMIUM_TIP}",
+        reply_markup=DAILY_CLAIMED_KEYBOARD
     )
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -347,10 +886,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Status: {'💎 Premium' if is_premium(user_id) else 'Free'}\n"
     )
     
-    keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    await update.message.reply_text(message, reply_markup=BACK_TO_MENU_KEYBOARD)
 
 # Admin commands
 async def give_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -368,35 +904,19 @@ async def give_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
     days = int(context.args[1])
     
     # Find user by username
-    target_user_id = None
-    for uid, data in users.items():
-        if data.get("username") == target_username:
-            target_user_id = uid
-            break
+    target_user_id = await locate_user(target_username)
     
     if not target_user_id:
         await update.message.reply_text(f"⚠️ User {target_username} not found.")
         return
     
     # Update user's premium status
-    user_data = get_user(int(target_user_id))
-    user_data["is_premium"] = True
-    
-    expiry_date = datetime.now() + timedelta(days=days)
-    user_data["premium_expiry"] = expiry_date.isoformat()
-    
-    update_user(int(target_user_id), user_data)
+    await shards.call(shards.owner(target_user_id), "grant_premium", user_id=target_user_id, days=days)
     
     await update.message.reply_text(f"✅ Gave {days} days of premium to @{target_username}")
     
     # Notify the user
-    try:
-        await context.bot.send_message(
-            chat_id=int(target_user_id),
-            text=f"🎉 You have been given {days} days of premium status by an admin!"
-        )
-    except Exception as e:
-        logger.error(f"Failed to notify user: {e}")
+    outbox.send(int(target_user_id), f"🎉 You have been given {days} days of premium status by an admin!")
 
 async def revoke_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -412,33 +932,19 @@ async def revoke_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_username = context.args[0].replace("@", "")
     
     # Find user by username
-    target_user_id = None
-    for uid, data in users.items():
-        if data.get("username") == target_username:
-            target_user_id = uid
-            break
+    target_user_id = await locate_user(target_username)
     
     if not target_user_id:
         await update.message.reply_text(f"⚠️ User {target_username} not found.")
         return
     
     # Update user's premium status
-    user_data = get_user(int(target_user_id))
-    user_data["is_premium"] = False
-    user_data["premium_expiry"] = None
-    
-    update_user(int(target_user_id), user_data)
+    await shards.call(shards.owner(target_user_id), "remove_premium", user_id=target_user_id)
     
     await update.message.reply_text(f"✅ Revoked premium from @{target_username}")
     
     # Notify the user
-    try:
-        await context.bot.send_message(
-            chat_id=int(target_user_id),
-            text="⚠️ Your premium status has been revoked by an admin."
-        )
-    except Exception as e:
-        logger.error(f"Failed to notify user: {e}")
+    outbox.send(int(target_user_id), "⚠️ Your premium status has been revoked by an admin.")
 
 async def add_credits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -455,33 +961,23 @@ async def add_credits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     amount = int(context.args[1])
     
     # Find user by username
-    target_user_id = None
-    for uid, data in users.items():
-        if data.get("username") == target_username:
-            target_user_id = uid
-            break
+    target_user_id = await locate_user(target_username)
     
     if not target_user_id:
         await update.message.reply_text(f"⚠️ User {target_username} not found.")
         return
     
     # Update user's credits
-    user_data = get_user(int(target_user_id))
-    user_data["credits"] += amount
-    user_data["total_earnings"] += amount
-    
-    update_user(int(target_user_id), user_data)
+    # Keyed by the update, so a resent /addcredits grants the credits once
+    await shards.call(
+        shards.owner(target_user_id), "grant_credits",
+        user_id=target_user_id, amount=amount, op_id=f"addcredits:{update.update_id}"
+    )
     
     await update.message.reply_text(f"✅ Added {amount} credits to @{target_username}")
     
     # Notify the user
-    try:
-        await context.bot.send_message(
-            chat_id=int(target_user_id),
-            text=f"🎉 You have been given {amount} credits by an admin!"
-        )
-    except Exception as e:
-        logger.error(f"Failed to notify user: {e}")
+    outbox.send(int(target_user_id), f"🎉 You have been given {amount} credits by an admin!")
 
 async def stats_global(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -490,10 +986,11 @@ async def stats_global(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ You are not authorized to use admin commands.")
         return
     
-    total_users = len(users)
-    premium_users = sum(1 for uid, data in users.items() if data.get("is_premium", False))
-    total_credits = sum(data.get("credits", 0) for data in users.values())
-    total_games = sum(data.get("games_played", 0) for data in users.values())
+    shard_totals = await shards.call_all("local_totals")
+    total_users = sum(counts["total_users"] for counts in shard_totals)
+    premium_users = sum(counts["premium_users"] for counts in shard_totals)
+    total_credits = sum(counts["total_credits"] for counts in shard_totals)
+    total_games = sum(counts["total_games"] for counts in shard_totals)
     
     message = (
         f"📊 Bot Statistics\n\n"
@@ -506,86 +1003,207 @@ async def stats_global(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(message)
 
-# Game implementations
-async def dice_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def blackjack_audit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_data = get_user(user_id)
-    is_user_premium = is_premium(user_id)
     
-    # Check if user has enough credits
-    game_cost = GAMES["dice"]["premium_cost"] if is_user_premium else GAMES["dice"]["cost"]
-    
-    if user_data["credits"] < game_cost:
-        await update.message.reply_text(
-            f"You don't have enough credits to play. You need {game_cost} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Claim Daily Reward", callback_data="daily")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
-        )
+    if not is_admin(user_id):
+        await update.message.reply_text("⚠️ You are not authorized to use admin commands.")
         return
     
-    # Deduct credits
-    user_data["credits"] -= game_cost
-    user_data["games_played"] += 1
-    update_user(user_id, user_data)
+    audit = {key: 0 for key in blackjack_audit}
+    for shard_audit in await shards.call_all("local_blackjack_audit"):
+        for key, value in shard_audit.items():
+            audit[key] += value
     
-    # Generate target number
-    target = random.randint(1, 6)
-    games[user_id] = {
-        "type": "dice",
-        "target": target,
+    staked = audit["staked"]
+    message = (
+        f"♠️ Blackjack Audit (since the last restart)\n\n"
+        f"Basic strategy RTP: {basic_strategy.rtp() * 100:.2f}%\n"
+        f"Games: {audit['games']}\n"
+        f"Staked: {staked}\n"
+    )
+    if staked:
+        message += (
+            f"Expected RTP of the hands dealt: {audit['expected'] / staked * 100:.2f}%\n"
+            f"Realised RTP: {audit['paid'] / staked * 100:.2f}%\n"
+        )
+    message += f"Decisions: {audit['decisions']}, against basic strategy: {audit['mistakes']}\n"
+    if staked:
+        message += f"Expected credits lost to those: {audit['ev_lost']:.0f} ({audit['ev_lost'] / staked * 100:.2f}% of stakes)\n"
+    
+    await update.message.reply_text(message)
+
+def format_score(board, score):
+    if board == "winrate":
+        return f"{score * 100:.1f}%"
+    return str(score)
+
+def board_usage(command):
+    return f"Usage: /{command} [{'|'.join(LEADERBOARDS)}]"
+
+@shards.op
+async def local_leaderboard(board, count):
+    """Return (user id, score, username) for this shard's top users on a board"""
+    return [(user_id, score, get_user(user_id)["username"]) for user_id, score in leaderboard.top(board, count)]
+
+@shards.op
+async def local_rank(board, score):
+    """Return how many of this shard's users have a higher score, and how many are ranked"""
+    return leaderboard.count_ahead(board, score), leaderboard.size(board)
+
+async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    board = context.args[0].lower() if context.args else "credits"
+    if board not in LEADERBOARDS:
+        await update.message.reply_text(board_usage("leaderboard"))
+        return
+    
+    # Each shard's top users, merged; the overall top can only come from those
+    entries = []
+    for shard_entries in await shards.call_all("local_leaderboard", board=board, count=LEADERBOARD_SIZE):
+        entries.extend(shard_entries)
+    entries.sort(key=lambda entry: (-entry[1], entry[0]))
+    
+    title = LEADERBOARDS[board][0]
+    if not entries:
+        await update.message.reply_text(f"{title} Leaderboard\n\nNobody is ranked yet.")
+        return
+    
+    user_id = update.effective_user.id
+    lines = []
+    for position, (entry_id, score, username) in enumerate(entries[:LEADERBOARD_SIZE], 1):
+        name = f"@{username}" if username else f"Player {entry_id}"
+        marker = " ⬅️" if entry_id == user_id else ""
+        lines.append(f"{position}. {name} - {format_score(board, score)}{marker}")
+    
+    await update.message.reply_text(f"{title} Leaderboard\n\n" + "\n".join(lines))
+
+async def rank_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    board = context.args[0].lower() if context.args else "credits"
+    if board not in LEADERBOARDS:
+        await update.message.reply_text(board_usage("rank"))
+        return
+    
+    user_id = update.effective_user.id
+    score = LEADERBOARDS[board][1](get_user(user_id))
+    if score is None:
+        await update.message.reply_text(
+            f"Play at least {WIN_RATE_MIN_GAMES} games to be ranked by win rate."
+        )
+        return
+    
+    counts = await shards.call_all("local_rank", board=board, score=score)
+    position = sum(ahead for ahead, ranked in counts) + 1
+    ranked = sum(ranked for ahead, ranked in counts)
+    
+    await update.message.reply_text(
+        f"{LEADERBOARDS[board][0]}\n\n"
+        f"Your rank: #{position} of {ranked}\n"
+        f"Your score: {format_score(board, score)}"
+    )
+
+# Changes admins make, run by the shard that owns the user
+@shards.op
+async def grant_premium(user_id, days):
+    user_data = get_user(user_id)
+    expiry_date = datetime.now() + timedelta(days=days)
+    set_premium(user_id, user_data, True, int(expiry_date.timestamp()))
+    update_user(user_id, user_data)
+
+@shards.op
+async def remove_premium(user_id):
+    user_data = get_user(user_id)
+    set_premium(user_id, user_data, False, None)
+    update_user(user_id, user_data)
+
+@shards.op
+async def grant_credits(user_id, amount, op_id=None):
+    credit(user_id, amount, "admin", op_id=op_id)
+
+@shards.op
+async def local_blackjack_audit():
+    """Return this shard's /bjaudit counts"""
+    return dict(blackjack_audit)
+
+@shards.op
+async def local_totals():
+    """Return this shard's /stats_global totals"""
+    return dict(totals)
+
+async def check_totals(context: ContextTypes.DEFAULT_TYPE):
+    """Compare the running totals with a full count from storage"""
+    await writer.wait_for_room()
+    # The count runs on the writer thread right after these changes are
+    # written, so it sees exactly the state the totals describe
+    expected = dict(totals)
+    changes = write_changes()
+    count = writer.submit(timed_storage("aggregates"))
+    await changes
+    actual = await count
+    drift = {key: expected[key] - actual[key] for key in actual if expected[key] != actual[key]}
+    if drift:
+        logger.warning(f"Running totals drifted from storage, correcting: {drift}")
+        for key, difference in drift.items():
+            totals[key] -= difference
+
+# Game implementations
+# Each start_* function starts a game for user_id and answers through reply,
+# which is update.message.reply_text for a command and
+# query.edit_message_text for a button, so both share one implementation.
+async def charge_for_game(user_id, game_type, reply, count=1):
+    """Take the cost of count games from the user; return the cost of one, or None if they can't play"""
+    details = GAMES[game_type]
+    user_data = get_user(user_id)
+    is_user_premium = is_premium(user_id)
+    
+    # Check if user is premium
+    if details.get("premium_only", False) and not is_user_premium:
+        await reply(
+            f"⭐ This is a premium game!\n\n"
+            f"You need to be a premium user to play {game_type}.",
+            reply_markup=BACK_TO_GAMES_KEYBOARD
+        )
+        return None
+    
+    # Check if user has enough credits
+    game_cost = details["premium_cost"] if is_user_premium else details["cost"]
+    
+    if not debit(user_id, game_cost * count, f"stake:{game_type}"):
+        await reply(NO_CREDITS_TEXT.format(cost=game_cost * count), reply_markup=NO_CREDITS_KEYBOARD)
+        return None
+    
+    count_game(user_data, count)
+    update_user(user_id, user_data)
+    return game_cost
+
+async def start_dice(user_id, reply):
+    game_cost = await charge_for_game(user_id, "dice", reply)
+    if game_cost is None:
+        return
+    
+    # Generate target number
+    target = random.randint(1, 6)
+    games[user_id] = {
+        "type": "dice",
+        "target": target,
         "attempts": 0,
         "max_attempts": 3,
         "cost": game_cost
     }
     
-    keyboard = [
-        [
-            InlineKeyboardButton("1", callback_data="guess_1"),
-            InlineKeyboardButton("2", callback_data="guess_2"),
-            InlineKeyboardButton("3", callback_data="guess_3"),
-        ],
-        [
-            InlineKeyboardButton("4", callback_data="guess_4"),
-            InlineKeyboardButton("5", callback_data="guess_5"),
-            InlineKeyboardButton("6", callback_data="guess_6"),
-        ],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
+    await reply(
         f"🎲 Dice Game Started!\n\n"
         f"I'm thinking of a number between 1 and 6.\n"
         f"You have 3 attempts to guess it.\n"
         f"Cost: {game_cost} credits\n\n"
         f"Select a number to guess:",
-        reply_markup=reply_markup
+        reply_markup=DICE_KEYBOARD
     )
 
-async def number_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data = get_user(user_id)
-    is_user_premium = is_premium(user_id)
-    
-    # Check if user has enough credits
-    game_cost = GAMES["number"]["premium_cost"] if is_user_premium else GAMES["number"]["cost"]
-    
-    if user_data["credits"] < game_cost:
-        await update.message.reply_text(
-            f"You don't have enough credits to play. You need {game_cost} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Claim Daily Reward", callback_data="daily")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
-        )
+async def start_number(user_id, reply):
+    game_cost = await charge_for_game(user_id, "number", reply)
+    if game_cost is None:
         return
     
-    # Deduct credits
-    user_data["credits"] -= game_cost
-    user_data["games_played"] += 1
-    update_user(user_id, user_data)
-    
     # Generate target number
     target = random.randint(1, 100)
     games[user_id] = {
@@ -596,7 +1214,7 @@ async def number_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "cost": game_cost
     }
     
-    await update.message.reply_text(
+    await reply(
         f"🔢 Number Guessing Game Started!\n\n"
         f"I'm thinking of a number between 1 and 100.\n"
         f"You have 5 attempts to guess it.\n"
@@ -604,31 +1222,16 @@ async def number_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Type a number between 1 and 100 to guess:"
     )
 
-async def quiz_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data = get_user(user_id)
-    is_user_premium = is_premium(user_id)
-    
-    # Check if user has enough credits
-    game_cost = GAMES["quiz"]["premium_cost"] if is_user_premium else GAMES["quiz"]["cost"]
-    
-    if user_data["credits"] < game_cost:
-        await update.message.reply_text(
-            f"You don't have enough credits to play. You need {game_cost} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Claim Daily Reward", callback_data="daily")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
-        )
+async def start_quiz(user_id, reply, category=None, difficulty=None):
+    game_cost = await charge_for_game(user_id, "quiz", reply)
+    if game_cost is None:
         return
     
-    # Deduct credits
-    user_data["credits"] -= game_cost
-    user_data["games_played"] += 1
-    update_user(user_id, user_data)
-    
-    # Select random question
-    question_data = random.choice(QUIZ_QUESTIONS)
+    # Ask a question the user hasn't had yet
+    user_id_str = str(user_id)
+    question_id, seen = quiz_bank.sample(get_quiz_seen(user_id_str), category, difficulty)
+    save_quiz_seen(user_id_str, seen)
+    question_data, keyboard = quiz_question(question_id)
     games[user_id] = {
         "type": "quiz",
         "question": question_data["question"],
@@ -637,563 +1240,329 @@ async def quiz_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "cost": game_cost
     }
     
-    # Create keyboard with options
-    keyboard = []
-    for i, option in enumerate(question_data["options"]):
-        keyboard.append([InlineKeyboardButton(option, callback_data=f"answer_{i}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
+    await reply(
         f"❓ Quiz Game Started!\n\n"
         f"{question_data['question']}\n"
         f"Cost: {game_cost} credits\n\n"
         f"Select your answer:",
-        reply_markup=reply_markup
+        reply_markup=keyboard
     )
 
-async def rps_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data = get_user(user_id)
-    is_user_premium = is_premium(user_id)
-    
-    # Check if user has enough credits
-    game_cost = GAMES["rps"]["premium_cost"] if is_user_premium else GAMES["rps"]["cost"]
-    
-    if user_data["credits"] < game_cost:
-        await update.message.reply_text(
-            f"You don't have enough credits to play. You need {game_cost} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Claim Daily Reward", callback_data="daily")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
-        )
+async def start_rps(user_id, reply):
+    game_cost = await charge_for_game(user_id, "rps", reply)
+    if game_cost is None:
         return
     
-    # Deduct credits
-    user_data["credits"] -= game_cost
-    user_data["games_played"] += 1
-    update_user(user_id, user_data)
-    
     games[user_id] = {
         "type": "rps",
         "cost": game_cost
     }
     
-    keyboard = [
-        [
-            InlineKeyboardButton("🪨 Rock", callback_data="rps_rock"),
-            InlineKeyboardButton("📄 Paper", callback_data="rps_paper"),
-            InlineKeyboardButton("✂️ Scissors", callback_data="rps_scissors"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
+    await reply(
         f"✂️ Rock Paper Scissors Game Started!\n\n"
         f"Cost: {game_cost} credits\n\n"
         f"Make your choice:",
-        reply_markup=reply_markup
+        reply_markup=RPS_KEYBOARD
     )
 
-async def slots_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data = get_user(user_id)
-    
-    # Check if user is premium
-    if not is_premium(user_id):
-        await update.message.reply_text(
-            "⭐ This is a premium game!\n\n"
-            "You need to be a premium user to play slots.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-            ])
-        )
+async def start_slots(user_id, reply, spins=1):
+    game_cost = await charge_for_game(user_id, "slots", reply, spins)
+    if game_cost is None:
         return
     
-    # Check if user has enough credits
-    game_cost = GAMES["slots"]["premium_cost"]
-    
-    if user_data["credits"] < game_cost:
-        await update.message.reply_text(
-            f"You don't have enough credits to play. You need {game_cost} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Claim Daily Reward", callback_data="daily")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
-        )
-        return
-    
-    # Deduct credits
-    user_data["credits"] -= game_cost
-    user_data["games_played"] += 1
-    update_user(user_id, user_data)
-    
-    # Generate slot results
-    symbols = ["🍒", "🍋", "🍊", "🍇", "💎", "7️⃣"]
-    result = [random.choice(symbols) for _ in range(3)]
-    
-    # Calculate winnings
-    winnings = 0
-    
-    if result[0] == result[1] == result[2]:
-        # All three match - big win
-        if result[0] == "7️⃣":
-            winnings = game_cost * 50  # Jackpot
-        elif result[0] == "💎":
-            winnings = game_cost * 20
-        else:
-            winnings = game_cost * 10
-    elif result[0] == result[1] or result[1] == result[2] or result[0] == result[2]:
-        # Two match - small win
-        winnings = game_cost * 2
+    # All the spins come from one call, each paid from the precomputed paytable
+    results = SLOTS.spin(spins)
+    payouts = [int(game_cost * multiple) for stops, multiple in results]
+    winnings = sum(payouts)
+    wins = sum(1 for paid in payouts if paid)
     
     # Update credits if won
     if winnings > 0:
-        user_data["credits"] += winnings
-        user_data["total_earnings"] += winnings
-        user_data["games_won"] += 1
-        update_user(user_id, user_data)
+        credit(user_id, winnings, "win:slots", won=wins)
     
     # Result message
-    result_str = " | ".join(result)
-    
-    if winnings > 0:
-        message = (
-            f"🎰 Slots Result\n\n"
-            f"{result_str}\n\n"
-            f"🎉 You won {winnings} credits!"
-        )
+    if spins == 1:
+        stops, multiple = results[0]
+        result_str = "\n".join(" | ".join(row) for row in SLOTS.window(stops))
+        title = "🎰 Slots Result"
     else:
-        message = (
-            f"🎰 Slots Result\n\n"
-            f"{result_str}\n\n"
-            f"😢 You lost {game_cost} credits."
+        result_str = "\n".join(
+            " / ".join(" | ".join(row) for row in SLOTS.window(stops)) + (f"  +{paid}" if paid else "")
+            for (stops, multiple), paid in zip(results, payouts)
         )
+        title = f"🎰 Slots x{spins}"
+    staked = game_cost * spins
     
-    keyboard = [
-        [InlineKeyboardButton("🎰 Spin Again", callback_data="play_slots")],
-        [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if winnings > staked:
+        outcome = f"🎉 You won {winnings} credits!"
+    elif winnings > 0:
+        outcome = f"You won {winnings} credits back of the {staked} you staked."
+    else:
+        outcome = f"😢 You lost {staked} credits."
     
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    await reply(f"{title}\n\n{result_str}\n\n{outcome}", reply_markup=SLOTS_AGAIN_KEYBOARD)
 
-async def blackjack_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data = get_user(user_id)
-    
-    # Check if user is premium
-    if not is_premium(user_id):
-        await update.message.reply_text(
-            "⭐ This is a premium game!\n\n"
-            "You need to be a premium user to play blackjack.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-            ])
-        )
+async def start_blackjack(user_id, reply):
+    game_cost = await charge_for_game(user_id, "blackjack", reply)
+    if game_cost is None:
         return
     
-    # Check if user has enough credits
-    game_cost = GAMES["blackjack"]["premium_cost"]
-    
-    if user_data["credits"] < game_cost:
-        await update.message.reply_text(
-            f"You don't have enough credits to play. You need {game_cost} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Claim Daily Reward", callback_data="daily")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
-        )
-        return
-    
-    # Deduct credits
-    user_data["credits"] -= game_cost
-    user_data["games_played"] += 1
-    update_user(user_id, user_data)
-    
-    # Initialize blackjack game
-    deck = ["2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K", "A"] * 4
-    random.shuffle(deck)
-    
-    player_hand = [deck.pop(), deck.pop()]
-    dealer_hand = [deck.pop(), deck.pop()]
+    # Deal from the shared shoe
+    shoe.start_round()
+    player = blackjack.make_hand((shoe.draw(), shoe.draw()))
+    dealer = blackjack.make_hand((shoe.draw(), shoe.draw()))
     
     games[user_id] = {
         "type": "blackjack",
-        "deck": deck,
-        "player_hand": player_hand,
-        "dealer_hand": dealer_hand,
+        "player": player,
+        "dealer": dealer,
         "cost": game_cost,
-        "status": "playing"
     }
-    
-    # Calculate initial scores
-    player_score = calculate_blackjack_score(player_hand)
-    dealer_score = calculate_blackjack_score([dealer_hand[0], "?"])
+    blackjack_audit["games"] += 1
+    blackjack_audit["staked"] += game_cost
+    blackjack_audit["expected"] += game_cost * basic_strategy.deal_return(player, blackjack.first_card(dealer))
     
     # Check for natural blackjack
-    if player_score == 21:
-        return await end_blackjack(update, context, user_id, "blackjack")
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("🎯 Hit", callback_data="bj_hit"),
-            InlineKeyboardButton("🛑 Stand", callback_data="bj_stand"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if blackjack.is_blackjack(player):
+        return await end_blackjack(user_id, reply, "blackjack")
     
-    await update.message.reply_text(
-        f"♠️ Blackjack Game Started!\n\n"
-        f"Your hand: {' '.join(player_hand)} (Score: {player_score})\n"
-        f"Dealer shows: {dealer_hand[0]} ?\n\n"
-        f"What would you like to do?",
-        reply_markup=reply_markup
-    )
+    await reply(blackjack_status("♠️ Blackjack Game Started!", games[user_id]), reply_markup=BLACKJACK_KEYBOARD)
 
-def calculate_blackjack_score(hand):
-    score = 0
-    aces = 0
-    
-    for card in hand:
-        if card == "?":
-            continue
-        elif card in ["J", "Q", "K"]:
-            score += 10
-        elif card == "A":
-            aces += 1
-            score += 11
+# Game type -> start function, for the game commands and play_<game> buttons
+GAME_STARTERS = {
+    "dice": start_dice,
+    "number": start_number,
+    "quiz": start_quiz,
+    "rps": start_rps,
+    "slots": start_slots,
+    "blackjack": start_blackjack,
+}
+
+async def dice_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await start_dice(update.effective_user.id, update.message.reply_text)
+
+async def number_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await start_number(update.effective_user.id, update.message.reply_text)
+
+async def quiz_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    category = difficulty = None
+    for arg in context.args:
+        arg = arg.lower()
+        if arg in DIFFICULTIES:
+            difficulty = arg
+        elif arg in quiz_bank.categories:
+            category = arg
         else:
-            score += int(card)
-    
-    # Adjust for aces
-    while score > 21 and aces > 0:
-        score -= 10
-        aces -= 1
-    
-    return score
+            await update.message.reply_text(
+                f"Usage: /quiz [category] [{'|'.join(DIFFICULTIES)}]\n\n"
+                f"Categories: {', '.join(quiz_bank.categories)}"
+            )
+            return
+    if not quiz_bank.pool(category, difficulty):
+        await update.message.reply_text("There are no questions of that kind yet. Try another category or difficulty.")
+        return
+    await start_quiz(update.effective_user.id, update.message.reply_text, category, difficulty)
+
+async def rps_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await start_rps(update.effective_user.id, update.message.reply_text)
+
+async def slots_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    spins = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    if spins not in SLOTS_SPINS:
+        await update.message.reply_text(f"Usage: /slots [{'|'.join(map(str, SLOTS_SPINS[1:]))}]")
+        return
+    await start_slots(update.effective_user.id, update.message.reply_text, spins)
+
+async def blackjack_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await start_blackjack(update.effective_user.id, update.message.reply_text)
 
-async def end_blackjack(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, result):
+def blackjack_status(title, game, hint=False):
+    """Return the message for a hand still in play, the dealer's second card hidden.
+    
+    With hint, it also gives basic strategy's play and what hitting and
+    standing are expected to return per credit staked.
+    """
+    player = game["player"]
+    up = blackjack.first_card(game["dealer"])
+    message = (
+        f"{title}\n\n"
+        f"Your hand: {blackjack.describe(player)} (Score: {blackjack.score(player)})\n"
+        f"Dealer shows: {blackjack.RANKS[up]} ?\n\n"
+    )
+    if hint:
+        stand, hit = basic_strategy.returns(player, up)
+        message += (
+            f"💡 Basic strategy says: {'Hit' if hit > stand else 'Stand'}\n"
+            f"Expected return per credit: hit {hit:.3f}, stand {stand:.3f}\n\n"
+        )
+    return message + "What would you like to do?"
+
+async def end_blackjack(user_id, reply, result):
     game = games.pop(user_id, None)
     if not game:
         return
     
-    user_data = get_user(user_id)
-    
-    player_score = calculate_blackjack_score(game["player_hand"])
-    dealer_score = calculate_blackjack_score(game["dealer_hand"])
-    
-    winnings = 0
+    player, dealer = game["player"], game["dealer"]
+    winnings = int(game["cost"] * BLACKJACK_PAYOUTS[result])
+    blackjack_audit["paid"] += winnings
     
     if result == "blackjack":
-        winnings = int(game["cost"] * 2.5)  # Blackjack pays 3:2
-        message = (
-            f"♠️ Blackjack Result\n\n"
-            f"Your hand: {' '.join(game['player_hand'])} (Score: {player_score})\n"
-            f"Dealer's hand: {' '.join(game['dealer_hand'])} (Score: {dealer_score})\n\n"
-            f"🎉 BLACKJACK! You won {winnings} credits!"
-        )
+        outcome = f"🎉 BLACKJACK! You won {winnings} credits!"
     elif result == "win":
-        winnings = game["cost"] * 2
-        message = (
-            f"♠️ Blackjack Result\n\n"
-            f"Your hand: {' '.join(game['player_hand'])} (Score: {player_score})\n"
-            f"Dealer's hand: {' '.join(game['dealer_hand'])} (Score: {dealer_score})\n\n"
-            f"🎉 You won {winnings} credits!"
-        )
+        outcome = f"🎉 You won {winnings} credits!"
     elif result == "push":
-        winnings = game["cost"]  # Return the bet
-        message = (
-            f"♠️ Blackjack Result\n\n"
-            f"Your hand: {' '.join(game['player_hand'])} (Score: {player_score})\n"
-            f"Dealer's hand: {' '.join(game['dealer_hand'])} (Score: {dealer_score})\n\n"
-            f"🤝 Push! Your bet of {winnings} credits has been returned."
-        )
+        outcome = f"🤝 Push! Your bet of {winnings} credits has been returned."
     else:  # lose
-        message = (
-            f"♠️ Blackjack Result\n\n"
-            f"Your hand: {' '.join(game['player_hand'])} (Score: {player_score})\n"
-            f"Dealer's hand: {' '.join(game['dealer_hand'])} (Score: {dealer_score})\n\n"
-            f"😢 You lost {game['cost']} credits."
-        )
+        outcome = f"😢 You lost {game['cost']} credits."
+    message = (
+        f"♠️ Blackjack Result\n\n"
+        f"Your hand: {blackjack.describe(player)} (Score: {blackjack.score(player)})\n"
+        f"Dealer's hand: {blackjack.describe(dealer)} (Score: {blackjack.score(dealer)})\n\n"
+        f"{outcome}"
+    )
     
     # Update credits if won
     if winnings > 0:
-        user_data["credits"] += winnings
-        user_data["total_earnings"] += winnings
-        
-        if result != "push":
-            user_data["games_won"] += 1
-        
-        update_user(user_id, user_data)
-    
-    keyboard = [
-        [InlineKeyboardButton("♠️ Play Again", callback_data="play_blackjack")],
-        [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        credit(user_id, winnings, f"{'push' if result == 'push' else 'win'}:blackjack", won=result != "push")
     
-    # Check if this is a callback query or a message
-    if update.callback_query:
-        await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
-    else:
-        await context.bot.send_message(chat_id=user_id, text=message, reply_markup=reply_markup)
+    await reply(message, reply_markup=BLACKJACK_AGAIN_KEYBOARD)
 
 # Callback query handlers
+# callback_data is "<action>" or "<action>_<argument>". Handlers register for
+# an action with the function that parses its argument, so routing a button
+# press is one dict lookup however many games there are.
+CALLBACK_ROUTES = {}
+
+def on_callback(action, parse=str):
+    def register(handler):
+        timer = timed(handler_seconds.labels("button", action), handler_errors.labels("button", action))
+        CALLBACK_ROUTES[action] = (timer(handler), parse)
+        return handler
+    return register
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    user_id = query.from_user.id
-    data = query.data
     
     await query.answer()
     
-    if data == "menu":
-        keyboard = [
-            [InlineKeyboardButton("🎮 Play Games", callback_data="games")],
-            [InlineKeyboardButton("💰 Check Credits", callback_data="credits")],
-            [InlineKeyboardButton("🎁 Claim Daily", callback_data="daily")],
-            [InlineKeyboardButton("📊 My Stats", callback_data="stats")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("🎮 Game Bot - Main Menu", reply_markup=reply_markup)
-    
-    elif data == "games":
-        user_data = get_user(user_id)
-        is_user_premium = is_premium(user_id)
-        
-        message = "🎮 Available Games:\n\n"
-        
-        # Free games
-        message += "Free Games:\n"
-        for game, details in GAMES.items():
-            if details.get("premium_only", False):
-                continue
-            cost = details["premium_cost"] if is_user_premium else details["cost"]
-            message += f"/{game} - Cost: {cost} credits\n"
-        
-        # Premium games
-        if is_user_premium:
-            message += "\n💎 Premium Games:\n"
-            for game, details in GAMES.items():
-                if details.get("premium_only", False):
-                    message += f"/{game} - Cost: {details['premium_cost']} credits\n"
-        else:
-            message += "\n💎 Premium Games (unlock with premium status):\n"
-            for game, details in GAMES.items():
-                if details.get("premium_only", False):
-                    message += f"/{game} - Requires premium\n"
-        
-        message += f"\n💰 Your Credits: {user_data['credits']}"
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🎲 Dice", callback_data="play_dice"),
-                InlineKeyboardButton("🔢 Number", callback_data="play_number"),
-            ],
-            [
-                InlineKeyboardButton("❓ Quiz", callback_data="play_quiz"),
-                InlineKeyboardButton("✂️ RPS", callback_data="play_rps"),
-            ],
-        ]
-        
-        if is_user_premium:
-            keyboard.append([
-                InlineKeyboardButton("🎰 Slots", callback_data="play_slots"),
-                InlineKeyboardButton("♠️ Blackjack", callback_data="play_blackjack"),
-            ])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(message, reply_markup=reply_markup)
-    
-    elif data == "credits":
-        user_data = get_user(user_id)
-        
-        premium_status = "💎 Premium" if is_premium(user_id) else "Free"
-        
-        premium_expiry = ""
-        if user_data["is_premium"] and user_data["premium_expiry"]:
-            expiry_date = datetime.fromisoformat(user_data["premium_expiry"])
-            premium_expiry = f"\nPremium expires: {expiry_date.strftime('%Y-%m-%d %H:%M')}"
-        
-        message = (
-            f"💰 Your Credits: {user_data['credits']}\n"
-            f"🎯 Status: {premium_status}{premium_expiry}\n\n"
-            f"Daily Rewards:\n"
-            f"- Free users: 50 credits\n"
-            f"- Premium users: 100 credits\n\n"
-            f"Use /games to start earning more credits!"
-        )
-        
-        keyboard = [
-            [InlineKeyboardButton("🎮 Play Games", callback_data="games")],
-            [InlineKeyboardButton("🎁 Claim Daily", callback_data="daily")],
-            [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    action, _, argument = query.data.partition("_")
+    route = CALLBACK_ROUTES.get(action)
+    if route is None:
+        return
     
-    elif data == "daily":
-        user_id_str = str(user_id)
-        
-        # Check if user has claimed daily reward today
-        today = datetime.now().strftime("%Y-%m-%d")
-        if user_id_str in daily_claims and daily_claims[user_id_str] == today:
-            await query.edit_message_text(
-                "You've already claimed your daily reward today. Come back tomorrow!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")
-                ]])
-            )
-            return
-        
-        # Give daily reward based on premium status
-        user_data = get_user(user_id)
-        reward = 100 if is_premium(user_id) else 50
-        user_data["credits"] += reward
-        user_data["total_earnings"] += reward
-        update_user(user_id, user_data)
-        
-        # Update daily claim
-        daily_claims[user_id_str] = today
-        save_data()
-        
-        await query.edit_message_text(
-            f"✅ Daily reward claimed!\n\n"
-            f"You received {reward} credits.\n"
-            f"Current balance: {user_data['credits']} credits.\n\n"
-            f"{'💎 Premium bonus applied!' if is_premium(user_id) else '💡 Tip: Premium users get double daily rewards!'}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎮 Play Games", callback_data="games")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
-        )
+    handler, parse = route
+    try:
+        argument = parse(argument)
+    except ValueError:
+        return
     
-    elif data == "stats":
-        user_data = get_user(user_id)
-        
-        win_rate = 0
-        if user_data["games_played"] > 0:
-            win_rate = (user_data["games_won"] / user_data["games_played"]) * 100
-        
-        message = (
-            f"📊 Your Statistics\n\n"
-            f"Games Played: {user_data['games_played']}\n"
-            f"Games Won: {user_data['games_won']}\n"
-            f"Win Rate: {win_rate:.1f}%\n"
-            f"Total Earnings: {user_data['total_earnings']} credits\n"
-            f"Current Balance: {user_data['credits']} credits\n"
-            f"Status: {'💎 Premium' if is_premium(user_id) else 'Free'}\n"
-        )
-        
-        keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    await handler(query, context, argument)
+
+@on_callback("menu")
+async def handle_menu(query, context, argument):
+    await query.edit_message_text("🎮 Game Bot - Main Menu", reply_markup=MAIN_MENU_KEYBOARD)
+
+@on_callback("games")
+async def handle_games(query, context, argument):
+    user_id = query.from_user.id
+    user_data = get_user(user_id)
+    message, reply_markup = GAMES_MENUS[is_premium(user_id)]
+    message += f"\n💰 Your Credits: {user_data['credits']}"
     
-    # Game start callbacks
-    elif data.startswith("play_"):
-        game_type = data.split("_")[1]
-        
-        if game_type == "dice":
-            await handle_play_dice(query, context)
-        elif game_type == "number":
-            await handle_play_number(query, context)
-        elif game_type == "quiz":
-            await handle_play_quiz(query, context)
-        elif game_type == "rps":
-            await handle_play_rps(query, context)
-        elif game_type == "slots":
-            await handle_play_slots(query, context)
-        elif game_type == "blackjack":
-            await handle_play_blackjack(query, context)
-    
-    # Game action callbacks
-    elif data.startswith("guess_"):
-        guess = int(data.split("_")[1])
-        await handle_dice_guess(query, context, guess)
-    
-    elif data.startswith("answer_"):
-        answer_idx = int(data.split("_")[1])
-        await handle_quiz_answer(query, context, answer_idx)
-    
-    elif data.startswith("rps_"):
-        choice = data.split("_")[1]
-        await handle_rps_choice(query, context, choice)
-    
-    elif data.startswith("bj_"):
-        action = data.split("_")[1]
-        await handle_blackjack_action(query, context, action)
+    await query.edit_message_text(message, reply_markup=reply_markup)
 
-# Game callback handlers
-async def handle_play_dice(query, context):
+@on_callback("credits")
+async def handle_credits(query, context, argument):
     user_id = query.from_user.id
     user_data = get_user(user_id)
-    is_user_premium = is_premium(user_id)
     
-    # Check if user has enough credits
-    game_cost = GAMES["dice"]["premium_cost"] if is_user_premium else GAMES["dice"]["cost"]
+    premium_status = "💎 Premium" if is_premium(user_id) else "Free"
+    
+    premium_expiry = ""
+    if user_data["is_premium"] and user_data["premium_expiry"]:
+        expiry_date = datetime.fromtimestamp(user_data["premium_expiry"])
+        premium_expiry = f"\nPremium expires: {expiry_date.strftime('%Y-%m-%d %H:%M')}"
+    
+    message = (
+        f"💰 Your Credits: {user_data['credits']}\n"
+        f"🎯 Status: {premium_status}{premium_expiry}\n\n"
+        f"{DAILY_REWARDS_TEXT}\n\n"
+        f"Use /games to start earning more credits!"
+    )
     
-    if user_data["credits"] < game_cost:
+    await query.edit_message_text(message, reply_markup=CREDITS_KEYBOARD)
+
+@on_callback("daily")
+async def handle_daily(query, context, argument):
+    user_id = query.from_user.id
+    user_id_str = str(user_id)
+    
+    # Check if user has claimed daily reward today
+    today = datetime.now().strftime("%Y-%m-%d")
+    if get_daily_claim(user_id_str) == today:
         await query.edit_message_text(
-            f"You don't have enough credits to play. You need {game_cost} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("💰 Claim Daily Reward", callback_data="daily")],
-                [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")],
-            ])
+            "You've already claimed your daily reward today. Come back tomorrow!",
+            reply_markup=BACK_TO_MENU_KEYBOARD
         )
         return
     
-    # Deduct credits
-    user_data["credits"] -= game_cost
-    user_data["games_played"] += 1
-    update_user(user_id, user_data)
-    
-    # Generate target number
-    target = random.randint(1, 6)
-    games[user_id] = {
-        "type": "dice",
-        "target": target,
-        "attempts": 0,
-        "max_attempts": 3,
-        "cost": game_cost
-    }
+    # Give daily reward based on premium status
+    user_data = get_user(user_id)
+    reward = DAILY_REWARDS[is_premium(user_id)]
+    credit(user_id, reward, "daily", op_id=f"daily:{user_id}:{today}")
     
-    keyboard = [
-        [
-            InlineKeyboardButton("1", callback_data="guess_1"),
-            InlineKeyboardButton("2", callback_data="guess_2"),
-            InlineKeyboardButton("3", callback_data="guess_3"),
-        ],
-        [
-            InlineKeyboardButton("4", callback_data="guess_4"),
-            InlineKeyboardButton("5", callback_data="guess_5"),
-            InlineKeyboardButton("6", callback_data="guess_6"),
-        ],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Update daily claim
+    save_daily_claim(user_id_str, today)
     
     await query.edit_message_text(
-        f"🎲 Dice Game Started!\n\n"
-        f"I'm thinking of a number between 1 and 6.\n"
-        f"You have 3 attempts to guess it.\n"
-        f"Cost: {game_cost} credits\n\n"
-        f"Select a number to guess:",
-        reply_markup=reply_markup
+        f"✅ Daily reward claimed!\n\n"
+        f"You received {reward} credits.\n"
+        f"Current balance: {user_data['credits']} credits.\n\n"
+        f"{'💎 Premium bonus applied!' if is_premium(user_id) else DAILY_PREMIUM_TIP}",
+        reply_markup=DAILY_CLAIMED_KEYBOARD
     )
 
+@on_callback("stats")
+async def handle_stats(query, context, argument):
+    user_id = query.from_user.id
+    user_data = get_user(user_id)
+    
+    win_rate = 0
+    if user_data["games_played"] > 0:
+        win_rate = (user_data["games_won"] / user_data["games_played"]) * 100
+    
+    message = (
+        f"📊 Your Statistics\n\n"
+        f"Games Played: {user_data['games_played']}\n"
+        f"Games Won: {user_data['games_won']}\n"
+        f"Win Rate: {win_rate:.1f}%\n"
+        f"Total Earnings: {user_data['total_earnings']} credits\n"
+        f"Current Balance: {user_data['credits']} credits\n"
+        f"Status: {'💎 Premium' if is_premium(user_id) else 'Free'}\n"
+    )
+    
+    await query.edit_message_text(message, reply_markup=BACK_TO_MENU_KEYBOARD)
+
+@on_callback("play")
+async def handle_play(query, context, game_type):
+    start_game = GAME_STARTERS.get(game_type)
+    if start_game is not None:
+        await start_game(query.from_user.id, query.edit_message_text)
+
+@on_callback("spin", int)
+async def handle_spin(query, context, spins):
+    if spins in SLOTS_SPINS:
+        await start_slots(query.from_user.id, query.edit_message_text, spins)
+
+# Game callback handlers
+@on_callback("guess", int)
 async def handle_dice_guess(query, context, guess):
     user_id = query.from_user.id
     
     if user_id not in games or games[user_id]["type"] != "dice":
         await query.edit_message_text(
             "No active dice game found. Start a new game with /dice",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back to Games", callback_data="games")
-            ]])
+            reply_markup=BACK_TO_GAMES_KEYBOARD
         )
         return
     
@@ -1202,12 +1571,8 @@ async def handle_dice_guess(query, context, guess):
     
     if guess == game["target"]:
         # Win
-        reward = game["cost"] * 3
-        user_data = get_user(user_id)
-        user_data["credits"] += reward
-        user_data["total_earnings"] += reward
-        user_data["games_won"] += 1
-        update_user(user_id, user_data)
+        reward = game["cost"] * GAMES["dice"]["payout"]
+        credit(user_id, reward, "win:dice", won=True)
         
         # Check for premium upgrade
         await check_premium_upgrade(query, context, user_id)
@@ -1221,10 +1586,7 @@ async def handle_dice_guess(query, context, guess):
             f"🎉 Congratulations! You guessed correctly: {guess}\n\n"
             f"You won {reward} credits!\n"
             f"+ {bonus_points} bonus points!{bonus_msg}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎮 Play Again", callback_data="play_dice")],
-                [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-            ])
+            reply_markup=PLAY_AGAIN_KEYBOARDS["dice"][0]
         )
     elif game["attempts"] >= game["max_attempts"]:
         # Game over
@@ -1234,35 +1596,167 @@ async def handle_dice_guess(query, context, guess):
             f"Game Over! You've used all your attempts.\n"
             f"The correct number was {game['target']}.\n\n"
             f"You lost {game['cost']} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎮 Try Again", callback_data="play_dice")],
-                [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-            ])
+            reply_markup=PLAY_AGAIN_KEYBOARDS["dice"][1]
         )
     else:
         # Continue
-        keyboard = [
-            [
-                InlineKeyboardButton("1", callback_data="guess_1"),
-                InlineKeyboardButton("2", callback_data="guess_2"),
-                InlineKeyboardButton("3", callback_data="guess_3"),
-            ],
-            [
-                InlineKeyboardButton("4", callback_data="guess_4"),
-                InlineKeyboardButton("5", callback_data="guess_5"),
-                InlineKeyboardButton("6", callback_data="guess_6"),
-            ],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             f"Wrong guess! The number is {guess < game['target'] and 'higher' or 'lower'} than {guess}.\n\n"
             f"Attempts left: {game['max_attempts'] - game['attempts']}\n\n"
             f"Try again with a number between 1 and 6:",
-            reply_markup=reply_markup
+            reply_markup=DICE_KEYBOARD
         )
 
-# Similar handlers for other games...
+@on_callback("answer", int)
+async def handle_quiz_answer(query, context, answer_idx):
+    user_id = query.from_user.id
+    
+    if user_id not in games or games[user_id]["type"] != "quiz":
+        await query.edit_message_text(
+            "No active quiz game found. Start a new game with /quiz",
+            reply_markup=BACK_TO_GAMES_KEYBOARD
+        )
+        return
+    
+    game = games.pop(user_id)
+    correct_option = game["options"][game["answer"]]
+    
+    if answer_idx == game["answer"]:
+        # Win
+        reward = game["cost"] * GAMES["quiz"]["payout"]
+        credit(user_id, reward, "win:quiz", won=True)
+        
+        # Check for premium upgrade
+        await check_premium_upgrade(query, context, user_id)
+        
+        # Award random bonus points
+        bonus_points, bonus_msg = award_random_points(user_id)
+        
+        await query.edit_message_text(
+            f"🎉 Correct! The answer is {correct_option}.\n\n"
+            f"You won {reward} credits!\n"
+            f"+ {bonus_points} bonus points!{bonus_msg}",
+            reply_markup=PLAY_AGAIN_KEYBOARDS["quiz"][0]
+        )
+    else:
+        await query.edit_message_text(
+            f"❌ Wrong answer! The correct answer was {correct_option}.\n\n"
+            f"You lost {game['cost']} credits.",
+            reply_markup=PLAY_AGAIN_KEYBOARDS["quiz"][1]
+        )
+
+# Rock Paper Scissors: choice -> (label, the choice it beats)
+RPS_CHOICES = {
+    "rock": ("🪨 Rock", "scissors"),
+    "paper": ("📄 Paper", "rock"),
+    "scissors": ("✂️ Scissors", "paper"),
+}
+
+@on_callback("rps")
+async def handle_rps_choice(query, context, choice):
+    user_id = query.from_user.id
+    
+    if choice not in RPS_CHOICES:
+        return
+    
+    if user_id not in games or games[user_id]["type"] != "rps":
+        await query.edit_message_text(
+            "No active Rock Paper Scissors game found. Start a new game with /rps",
+            reply_markup=BACK_TO_GAMES_KEYBOARD
+        )
+        return
+    
+    game = games.pop(user_id)
+    bot_choice = random.choice(list(RPS_CHOICES))
+    choices = f"You: {RPS_CHOICES[choice][0]}\nBot: {RPS_CHOICES[bot_choice][0]}\n\n"
+    
+    if choice == bot_choice:
+        # Draw - return the bet
+        credit(user_id, game["cost"], "refund:rps", earned=False)
+        
+        await query.edit_message_text(
+            f"{choices}🤝 It's a draw! Your {game['cost']} credits have been returned.",
+            reply_markup=PLAY_AGAIN_KEYBOARDS["rps"][0]
+        )
+    elif RPS_CHOICES[choice][1] == bot_choice:
+        # Win
+        reward = game["cost"] * GAMES["rps"]["payout"]
+        credit(user_id, reward, "win:rps", won=True)
+        
+        # Check for premium upgrade
+        await check_premium_upgrade(query, context, user_id)
+        
+        await query.edit_message_text(
+            f"{choices}🎉 You win! You won {reward} credits!",
+            reply_markup=PLAY_AGAIN_KEYBOARDS["rps"][0]
+        )
+    else:
+        await query.edit_message_text(
+            f"{choices}😢 You lose! You lost {game['cost']} credits.",
+            reply_markup=PLAY_AGAIN_KEYBOARDS["rps"][1]
+        )
+
+@on_callback("bj")
+async def handle_blackjack_action(query, context, action):
+    user_id = query.from_user.id
+    
+    if action not in ("hit", "stand", "hint"):
+        return
+    
+    if user_id not in games or games[user_id]["type"] != "blackjack":
+        await query.edit_message_text(
+            "No active blackjack game found. Start a new game with /blackjack",
+            reply_markup=BACK_TO_GAMES_KEYBOARD
+        )
+        return
+    
+    game = games[user_id]
+    
+    if action == "hint":
+        # Premium may have run out since the game was dealt
+        title = "♠️ Blackjack" if is_premium(user_id) else "♠️ Blackjack\n\n💎 Hints are a premium feature."
+        await query.edit_message_text(
+            blackjack_status(title, game, hint=is_premium(user_id)), reply_markup=BLACKJACK_KEYBOARD
+        )
+        return
+    
+    # Audit the decision against basic strategy
+    stand, hit = basic_strategy.returns(game["player"], blackjack.first_card(game["dealer"]))
+    regret = max(stand, hit) - (hit if action == "hit" else stand)
+    blackjack_audit["decisions"] += 1
+    if regret > 0:
+        blackjack_audit["mistakes"] += 1
+        blackjack_audit["ev_lost"] += game["cost"] * regret
+    
+    if action == "hit":
+        game["player"] = blackjack.add_card(game["player"], shoe.draw())
+        player_score = blackjack.score(game["player"])
+        
+        if player_score > 21:
+            return await end_blackjack(user_id, query.edit_message_text, "lose")
+        
+        if player_score < 21:
+            await query.edit_message_text(blackjack_status("♠️ Blackjack", game), reply_markup=BLACKJACK_KEYBOARD)
+            return
+        # Stand automatically on 21
+    
+    # Dealer draws to 17
+    dealer = game["dealer"]
+    while blackjack.score(dealer) < 17:
+        dealer = blackjack.add_card(dealer, shoe.draw())
+    game["dealer"] = dealer
+    
+    player_score = blackjack.score(game["player"])
+    dealer_score = blackjack.score(dealer)
+    
+    if dealer_score > 21 or player_score > dealer_score:
+        result = "win"
+    elif player_score == dealer_score:
+        result = "push"
+    else:
+        result = "lose"
+    
+    await end_blackjack(user_id, query.edit_message_text, result)
 
 async def check_premium_upgrade(query, context, user_id):
     """Check if user qualifies for premium upgrade after winning"""
@@ -1273,27 +1767,67 @@ async def check_premium_upgrade(query, context, user_id):
         return
     
     # Check win streak or other conditions for premium
-    if user_data["games_won"] >= 10 and random.random() < 0.2:  # 20% chance after 10 wins
+    if user_data["games_won"] >= PREMIUM_UPGRADE_WINS and random.random() < PREMIUM_UPGRADE_CHANCE:
         # Award premium status
-        user_data["is_premium"] = True
-        expiry_date = datetime.now() + timedelta(days=3)  # 3 days of premium
-        user_data["premium_expiry"] = expiry_date.isoformat()
+        expiry_date = datetime.now() + timedelta(days=PREMIUM_UPGRADE_DAYS)
+        set_premium(user_id, user_data, True, int(expiry_date.timestamp()))
         update_user(user_id, user_data)
         
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"🎉 Congratulations! You've been awarded 3 days of premium status for your winning streak!\n\n"
-                 f"Enjoy premium benefits until {expiry_date.strftime('%Y-%m-%d %H:%M')}!"
+        outbox.send(
+            user_id,
+            f"🎉 Congratulations! You've been awarded {PREMIUM_UPGRADE_DAYS} days of premium status for your winning streak!\n\n"
+            f"Enjoy premium benefits until {expiry_date.strftime('%Y-%m-%d %H:%M')}!"
         )
 
 # Main function
 def main():
     """Start the bot."""
+    if UPDATE_MODE == "sharded":
+        # This process only dispatches; the workers it starts run the bot
+        asyncio.run(run_dispatcher(
+            os.path.abspath(__file__), [worker_env(shard) for shard in range(SHARDS)],
+            WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, SHARD_BASE_PORT,
+            secret_token=WEBHOOK_SECRET, bot=Bot(TOKEN), url=WEBHOOK_URL,
+        ))
+        return
+    
     # Load saved data
     load_data()
     
-    # Create the Application
-    application = Application.builder().token(TOKEN).build()
+    application = create_application(Application.builder().token(TOKEN))
+    
+    # Run the bot until the user presses Ctrl-C
+    if UPDATE_MODE == "webhook":
+        asyncio.run(run_webhook(
+            application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET, url=WEBHOOK_URL,
+            routes={SHARD_PATH: shards.handle} if SHARDS > 1 else None, max_pending=WEBHOOK_QUEUE_SIZE,
+        ))
+    else:
+        application.run_polling()
+    
+    # Leave a fresh snapshot behind so the next start has no log to replay
+    save_data()
+    store.close()
+
+def create_application(builder):
+    """Build the application with every handler and job, from a builder with the bot set up"""
+    builder = builder.post_init(startup).post_shutdown(shutdown)
+    if SEND_RATE:
+        # Workers share the bot's limit between them
+        builder = builder.rate_limiter(PriorityRateLimiter(overall_rate=SEND_RATE / SHARDS))
+    # Different users' updates are handled concurrently, each user's in
+    # order. Jobs and shard operations change users without awaiting in
+    # between, so they can't interleave with a handler's check and update.
+    builder = builder.concurrent_updates(UserUpdateProcessor(CONCURRENT_UPDATES))
+    if UPDATE_MODE == "webhook":
+        # Updates arrive through our own server, which limits them to
+        # WEBHOOK_QUEUE_SIZE in progress
+        builder = builder.updater(None)
+    application = builder.build()
+    
+    # Record usernames before any other handler runs
+    application.add_handler(TypeHandler(Update, track_user), group=-1)
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -1302,6 +1836,8 @@ def main():
     application.add_handler(CommandHandler("games", games_command))
     application.add_handler(CommandHandler("daily", daily_command))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("leaderboard", leaderboard_command))
+    application.add_handler(CommandHandler("rank", rank_command))
     
     # Game commands
     application.add_handler(CommandHandler("dice", dice_game))
@@ -1316,6 +1852,19 @@ def main():
     application.add_handler(CommandHandler("revokepremium", revoke_premium))
     application.add_handler(CommandHandler("addcredits", add_credits))
     application.add_handler(CommandHandler("stats_global", stats_global))
+    application.add_handler(CommandHandler("bjaudit", blackjack_audit_command))
+    
+    # Close games players have walked away from
+    application.job_queue.run_repeating(sweep_games, interval=GAME_SWEEP_INTERVAL)
+    
+    # Write changed users out in batches
+    application.job_queue.run_repeating(flush_job, interval=FLUSH_INTERVAL)
+    
+    # Switch off premium as it runs out
+    application.job_queue.run_repeating(expire_premium, interval=PREMIUM_EXPIRY_INTERVAL)
+    
+    # Periodically check the /stats_global totals against storage
+    application.job_queue.run_repeating(check_totals, interval=TOTALS_CHECK_INTERVAL, first=TOTALS_CHECK_INTERVAL)
     
     # Add callback query handler
     application.add_handler(CallbackQueryHandler(button_callback))
@@ -1323,8 +1872,45 @@ def main():
     # Add message handler for number guessing game
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
     
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # Time every handler added above
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            instrument(handler)
+    
+    return application
+
+# Handler class -> kind label for handler metrics
+HANDLER_KINDS = {
+    CommandHandler: "command",
+    CallbackQueryHandler: "callback",
+    MessageHandler: "message",
+    TypeHandler: "update",
+}
+
+def instrument(handler):
+    """Record the run time of a handler's callback, named after its commands or the callback"""
+    kind = HANDLER_KINDS.get(type(handler), type(handler).__name__)
+    if isinstance(handler, CommandHandler):
+        name = ",".join(sorted(handler.commands))
+    else:
+        name = handler.callback.__name__
+    handler.callback = timed(handler_seconds.labels(kind, name), handler_errors.labels(kind, name))(handler.callback)
+
+def worker_env(shard):
+    """Return the environment for one worker process in sharded mode"""
+    env = dict(os.environ)
+    env.pop("WEBHOOK_URL", None)
+    env.update({
+        "UPDATE_MODE": "webhook",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(SHARD_BASE_PORT + shard),
+        "SHARD_INDEX": str(shard),
+        "SHARD_BASE_PORT": str(SHARD_BASE_PORT),
+        "DATA_DIR": os.path.join(DATA_DIR, f"shard-{shard}"),
+    })
+    if METRICS_PORT:
+        env["METRICS_PORT"] = str(METRICS_PORT + shard)
+    return env
 
 async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text input for games like number guessing"""
@@ -1349,9 +1935,7 @@ async def handle_number_guess(update: Update, context: ContextTypes.DEFAULT_TYPE
     if user_id not in games or games[user_id]["type"] != "number":
         await update.message.reply_text(
             "No active number game found. Start a new game with /number",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back to Games", callback_data="games")
-            ]])
+            reply_markup=BACK_TO_GAMES_KEYBOARD
         )
         return
     
@@ -1360,12 +1944,8 @@ async def handle_number_guess(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     if guess == game["target"]:
         # Win
-        reward = game["cost"] * 4  # Higher reward for harder game
-        user_data = get_user(user_id)
-        user_data["credits"] += reward
-        user_data["total_earnings"] += reward
-        user_data["games_won"] += 1
-        update_user(user_id, user_data)
+        reward = game["cost"] * GAMES["number"]["payout"]
+        credit(user_id, reward, "win:number", won=True)
         
         # Check for premium upgrade
         await check_premium_upgrade(update, context, user_id)
@@ -1379,10 +1959,7 @@ async def handle_number_guess(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"🎉 Congratulations! You guessed correctly: {guess}\n\n"
             f"You won {reward} credits!\n"
             f"+ {bonus_points} bonus points!{bonus_msg}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎮 Play Again", callback_data="play_number")],
-                [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-            ])
+            reply_markup=PLAY_AGAIN_KEYBOARDS["number"][0]
         )
     elif game["attempts"] >= game["max_attempts"]:
         # Game over
@@ -1392,10 +1969,7 @@ async def handle_number_guess(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"Game Over! You've used all your attempts.\n"
             f"The correct number was {game['target']}.\n\n"
             f"You lost {game['cost']} credits.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎮 Try Again", callback_data="play_number")],
-                [InlineKeyboardButton("🔙 Back to Games", callback_data="games")],
-            ])
+            reply_markup=PLAY_AGAIN_KEYBOARDS["number"][1]
         )
     else:
         # Continue
@@ -0,0 +1,349 @@
+import random
+
+MAX_LEVEL = 32
+# ScoreCounts buckets: SUB_BUCKETS for scores below 1, then SUB_BUCKETS for
+# every power of two up to 2**EXPONENTS, past which scores share the last one
+SUB_BUCKETS = 256
+EXPONENTS = 64
+BUCKETS = (EXPONENTS + 1) * SUB_BUCKETS
+
+
+def _height():
+    """Return a random node height: 1 for half the nodes, 2 for a quarter, and so on"""
+    bits = random.getrandbits(MAX_LEVEL - 1) | 1 << (MAX_LEVEL - 1)
+    return (bits & -bits).bit_length()
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, height):
+        self.key = key
+        self.next = [None] * height
+        # width[level] is how many places along the list next[level] is
+        self.width = [1] * height
+
+
+class SkipList:
+    """A sorted list of distinct keys with O(log n) insert, remove and rank.
+
+    Each link records how many places it skips, so the position of a key
+    and the key at a position are found on the same path down the levels
+    as a search, without walking the bottom level.
+    """
+
+    def __init__(self):
+        self.head = _Node(None, MAX_LEVEL)
+        self.levels = 1
+        self.size = 0
+
+    @classmethod
+    def from_sorted(cls, keys):
+        """Build a list from keys already in order, in linear time"""
+        skiplist = cls()
+        # The last node on each level so far, and its position
+        last = [skiplist.head] * MAX_LEVEL
+        last_positions = [0] * MAX_LEVEL
+        position = 0
+        for position, key in enumerate(keys, 1):
+            height = _height()
+            node = _Node(key, height)
+            for level in range(height):
+                last[level].next[level] = node
+                last[level].width[level] = position - last_positions[level]
+                last[level] = node
+                last_positions[level] = position
+            skiplist.levels = max(skiplist.levels, height)
+        for level in range(skiplist.levels):
+            last[level].width[level] = position + 1 - last_positions[level]
+        skiplist.size = position
+        return skiplist
+
+    def __len__(self):
+        return self.size
+
+    def _path(self, key):
+        """Return the last node before key on each level, and its position"""
+        chain = [None] * self.levels
+        positions = [0] * self.levels
+        node = self.head
+        position = 0
+        for level in reversed(range(self.levels)):
+            following = node.next[level]
+            while following is not None and following.key < key:
+                position += node.width[level]
+                node = following
+                following = node.next[level]
+            chain[level] = node
+            positions[level] = position
+        return chain, positions
+
+    def insert(self, key):
+        height = _height()
+        # A new level starts out as one link from the head past the end
+        while self.levels < height:
+            self.head.width[self.levels] = self.size + 1
+            self.levels += 1
+
+        chain, positions = self._path(key)
+        position = positions[0]
+        node = _Node(key, height)
+        for level in range(height):
+            before = chain[level]
+            skipped = position - positions[level]
+            node.next[level] = before.next[level]
+            node.width[level] = before.width[level] - skipped
+            before.next[level] = node
+            before.width[level] = skipped + 1
+        for level in range(height, self.levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self._path(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for level in range(self.levels):
+            before = chain[level]
+            if before.next[level] is node:
+                before.width[level] += node.width[level] - 1
+                before.next[level] = node.next[level]
+            else:
+                before.width[level] -= 1
+        self.size -= 1
+
+    def count_less(self, key):
+        """Return the number of keys smaller than key, which is its index if present"""
+        _, positions = self._path(key)
+        return positions[0]
+
+    def slice(self, start, count):
+        """Return up to count keys from index start onwards"""
+        node = self.head
+        position = 0
+        for level in reversed(range(self.levels)):
+            while node.next[level] is not None and position + node.width[level] <= start:
+                position += node.width[level]
+                node = node.next[level]
+        keys = []
+        node = node.next[0]
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+def _bucket(score):
+    """Return the ScoreCounts bucket of a score; a higher score never gets a lower bucket"""
+    if score < 1:
+        return max(int(score * SUB_BUCKETS), 0)
+    exponent = int(score).bit_length() - 1
+    if exponent >= EXPONENTS:
+        return BUCKETS - 1
+    bucket = (exponent + 1) * SUB_BUCKETS + int((score / (1 << exponent) - 1) * SUB_BUCKETS)
+    return min(bucket, BUCKETS - 1)
+
+
+class ScoreCounts:
+    """How many users have each score, counting those above a score in O(log n).
+
+    Scores fall into buckets that widen as scores grow, and the number of
+    users in each bucket is kept in a Fenwick tree. Counting the users above
+    a score adds up the buckets after its own, then the higher scores in its
+    own bucket.
+    """
+
+    def __init__(self):
+        # tree[i] holds the users in the buckets from i - (i & -i) to i - 1
+        self.tree = [0] * (BUCKETS + 1)
+        # bucket -> {score: users with it}
+        self.buckets = {}
+        self.size = 0
+
+    @classmethod
+    def from_counts(cls, counts):
+        """Build the counts from (score, users) pairs"""
+        score_counts = cls()
+        for score, users in counts:
+            score_counts.add(score, users)
+        return score_counts
+
+    def __len__(self):
+        return self.size
+
+    def add(self, score, users=1):
+        bucket = _bucket(score)
+        scores = self.buckets.setdefault(bucket, {})
+        scores[score] = scores.get(score, 0) + users
+        if not scores[score]:
+            del scores[score]
+            if not scores:
+                del self.buckets[bucket]
+        self.size += users
+        index = bucket + 1
+        while index <= BUCKETS:
+            self.tree[index] += users
+            index += index & -index
+
+    def remove(self, score):
+        self.add(score, -1)
+
+    def count_above(self, score):
+        """Return the number of users with a higher score"""
+        bucket = _bucket(score)
+        up_to_bucket = 0
+        index = bucket + 1
+        while index:
+            up_to_bucket += self.tree[index]
+            index -= index & -index
+        in_bucket = sum(users for other, users in self.buckets.get(bucket, {}).items() if other > score)
+        return self.size - up_to_bucket + in_bucket
+
+
+class Leaderboard:
+    """Users ranked by several metrics, each kept sorted as users change.
+
+    metrics maps a name to a function that takes a user record and returns
+    its score, or None to leave the user off that board. Each board is a
+    SkipList of (-score, user id) keys, so the highest score comes first and
+    ties go to the lower user id. Call update() whenever a user changes.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.boards = {name: SkipList() for name in metrics}
+        # name -> {user id: the user's key on that board}
+        self.keys = {name: {} for name in metrics}
+
+    def load(self, records):
+        """Rebuild every board from (user id, record) pairs"""
+        self.keys = {name: {} for name in self.metrics}
+        for user_id, record in records:
+            user_id = int(user_id)
+            for name, score_of in self.metrics.items():
+                score = score_of(record)
+                if score is not None:
+                    self.keys[name][user_id] = (-score, user_id)
+        self.boards = {name: SkipList.from_sorted(sorted(keys.values())) for name, keys in self.keys.items()}
+
+    def update(self, user_id, record):
+        user_id = int(user_id)
+        for name, score_of in self.metrics.items():
+            score = score_of(record)
+            key = None if score is None else (-score, user_id)
+            keys = self.keys[name]
+            old_key = keys.get(user_id)
+            if key == old_key:
+                continue
+            board = self.boards[name]
+            if old_key is not None:
+                board.remove(old_key)
+            if key is None:
+                del keys[user_id]
+            else:
+                board.insert(key)
+                keys[user_id] = key
+
+    def top(self, name, count, start=0):
+        """Return (user id, score) for count users from position start"""
+        return [(user_id, -score) for score, user_id in self.boards[name].slice(start, count)]
+
+    def rank(self, name, user_id):
+        """Return the user's 1-based position on a board, or None if they aren't on it"""
+        key = self.keys[name].get(int(user_id))
+        if key is None:
+            return None
+        return self.boards[name].count_less(key) + 1
+
+    def score(self, name, user_id):
+        key = self.keys[name].get(int(user_id))
+        return None if key is None else -key[0]
+
+    def count_ahead(self, name, score):
+        """Return how many users have a higher score; users with the same score share a rank"""
+        # (-score,) sorts before every key with this score
+        return self.boards[name].count_less((-score,))
+
+    def size(self, name):
+        return len(self.boards[name])
+
+    def track(self, user_id, record):
+        pass
+
+    def forget(self, user_id):
+        pass
+
+
+class StoredLeaderboard:
+    """The same boards for SQLiteStore, without holding every user.
+
+    Top users come from a storage query that walks the board's index, with
+    users changed since they were last written ranked from their records in
+    unwritten(), a dict of user id -> record, and left out of the query.
+    Ranks and sizes come from ScoreCounts of every user's score, read from
+    storage by load() and kept current by update(). call(name) returns the
+    storage method of that name.
+
+    update() moves a user from their previous scores, so it needs to know
+    them: call track() with each record read from storage and forget() when
+    the record is dropped. A user that was never tracked is counted as new.
+    """
+
+    def __init__(self, metrics, call, unwritten):
+        self.metrics = metrics
+        self.call = call
+        self.unwritten = unwritten
+        self.counts = {name: ScoreCounts() for name in metrics}
+        # user id -> (score on each board), for the users tracked
+        self.scores = {}
+
+    def load(self):
+        """Count every stored user's scores"""
+        self.scores = {}
+        self.counts = {name: ScoreCounts.from_counts(self.call("leaderboard_counts")(name)) for name in self.metrics}
+
+    def _scores_of(self, record):
+        return tuple(score_of(record) for score_of in self.metrics.values())
+
+    def track(self, user_id, record):
+        self.scores[str(user_id)] = self._scores_of(record)
+
+    def forget(self, user_id):
+        self.scores.pop(str(user_id), None)
+
+    def update(self, user_id, record):
+        user_id = str(user_id)
+        scores = self._scores_of(record)
+        old_scores = self.scores.get(user_id, (None,) * len(scores))
+        if scores == old_scores:
+            return
+        for name, score, old_score in zip(self.metrics, scores, old_scores):
+            if score == old_score:
+                continue
+            if old_score is not None:
+                self.counts[name].remove(old_score)
+            if score is not None:
+                self.counts[name].add(score)
+        self.scores[user_id] = scores
+
+    def top(self, name, count):
+        """Return (user id, score) for the top count users"""
+        unwritten = self.unwritten()
+        score_of = self.metrics[name]
+        keys = []
+        for user_id, record in unwritten.items():
+            score = score_of(record)
+            if score is not None:
+                keys.append((-score, int(user_id)))
+        top = self.call("leaderboard_top")(name, count, unwritten.keys())
+        keys.extend((-score, int(user_id)) for user_id, score in top)
+        keys.sort()
+        return [(user_id, -score) for score, user_id in keys[:count]]
+
+    def count_ahead(self, name, score):
+        """Return how many users have a higher score; users with the same score share a rank"""
+        return self.counts[name].count_above(score)
+
+    def size(self, name):
+        return len(self.counts[name])
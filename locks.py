@@ -0,0 +1,54 @@
+import asyncio
+import weakref
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class UserLocks:
+    """An asyncio.Lock per user, kept only while something holds or awaits it.
+
+    Locks live in a WeakValueDictionary, so a user's lock is dropped as soon
+    as nobody references it and memory stays proportional to the number of
+    users with an update in flight.
+    """
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+
+    def __call__(self, user_id):
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[user_id] = lock
+        return lock
+
+    def __len__(self):
+        return len(self.locks)
+
+
+class UserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one at a time for each user.
+
+    Handlers check a balance or an active game and change it later, often
+    with an await in between. Holding the sender's lock for the whole update
+    means two quick taps from one user can't both pass the same check.
+    Updates without a user are not serialised.
+    """
+
+    def __init__(self, max_concurrent_updates, locks=None):
+        super().__init__(max_concurrent_updates)
+        self.locks = UserLocks() if locks is None else locks
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await coroutine
+            return
+        async with self.locks(user.id):
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,236 @@
+"""Counters, gauges and histograms, served in Prometheus' text format.
+
+Metrics may be updated from any thread; the storage writer records its
+call times from its own thread.
+"""
+import asyncio
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+# Upper bounds, in seconds, for latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """A named metric with one series per combination of label values"""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        # label values -> series
+        self.series = {}
+
+    def labels(self, *values):
+        """Return the series for these label values, creating it on first use"""
+        series = self.series.get(values)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(values, self._new_series())
+        return series
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, series in list(self.series.items()):
+            lines.extend(series.render(self.name, self.label_names, values))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self, lock):
+        self.value = 0
+        self.lock = lock
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, label_names, values):
+        return [f"{name}{format_labels(label_names, values)} {format_value(self.value)}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_series(self):
+        return _Value(self.lock)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """A value that goes up and down. With function given, it is called for
+    the value each time the metric is rendered."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def _new_series(self):
+        return _Value(self.lock)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds, lock):
+        self.bounds = bounds
+        # counts[i] counts observations in (bounds[i - 1], bounds[i]]; the
+        # last one counts those above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = lock
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, label_names, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.bounds, float("inf")), counts):
+            cumulative += count
+            le = f'le="{format_value(float(bound))}"'
+            lines.append(f"{name}_bucket{format_labels(label_names, values, le)} {cumulative}")
+        labels = format_labels(label_names, values)
+        lines.append(f"{name}_sum{labels} {format_value(total)}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self):
+        return _Buckets(self.buckets, self.lock)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.add(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, body):
+        """WebhookServer route that answers with every metric"""
+        return 200, self.render().encode()
+
+
+def timed(seconds, errors=None):
+    """Decorator recording how long each call takes in the histogram series
+    seconds, and counting calls that raise in errors. Works on plain and
+    coroutine functions."""
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc()
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc()
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+async def watch_loop_lag(lag, interval=1.0):
+    """Record how late the event loop wakes from a sleep of interval seconds.
+
+    A handler that blocks the loop shows up here as lag, however short the
+    handler's own latency looks. Runs until cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, loop.time() - start - interval))
@@ -0,0 +1,261 @@
+import asyncio
+import collections
+import logging
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Priorities, passed to Bot API calls as rate_limit_args; lower goes first
+INTERACTIVE = 0  # replies to someone using the bot right now
+NOTIFICATION = 1  # messages nobody is waiting on
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """rate tokens a second, holding at most capacity; each call takes one"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Return how many seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Paces Bot API calls with token buckets, higher priorities first.
+
+    Every call takes a token from the overall bucket, and a call to a chat
+    also takes one from that chat's bucket; group chats (negative ids) get
+    Telegram's slower group rate. rate_limit_args is the call's priority,
+    INTERACTIVE by default. Waiting calls are let through lowest priority
+    number first, in order within a priority, except that a call whose chat
+    is out of tokens doesn't hold up calls to other chats.
+
+    A 429 from Telegram pauses every call for the time it asks (at least
+    doubling with each retry of the same call), and the call is retried up
+    to max_retries times.
+    """
+
+    # Chat buckets are dropped once full, when there are more than this many
+    MAX_IDLE_CHATS = 10000
+
+    def __init__(self, overall_rate=30, overall_burst=30, chat_rate=1, chat_burst=3, group_rate=20 / 60,
+                 group_burst=20, max_retries=3):
+        self.overall_rate = overall_rate
+        self.overall_burst = overall_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.overall = None
+        # chat id -> TokenBucket
+        self.chats = {}
+        # priority -> deque of (chat id, future) waiting for tokens
+        self.waiting = {}
+        self.paused_until = 0.0
+        self.wakeup = None
+        self.dispatcher = None
+
+    async def initialize(self):
+        loop = asyncio.get_running_loop()
+        self.overall = TokenBucket(self.overall_rate, self.overall_burst, loop.time())
+        self.wakeup = asyncio.Event()
+        self.dispatcher = loop.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            await asyncio.gather(self.dispatcher, return_exceptions=True)
+            self.dispatcher = None
+        for queue in self.waiting.values():
+            for chat_id, future in queue:
+                future.cancel()
+        self.waiting = {}
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = max(e.retry_after, 2 ** attempt)
+                logger.warning(f"Telegram asked to slow down on {endpoint}, pausing sends for {delay}s")
+                loop = asyncio.get_running_loop()
+                self.paused_until = max(self.paused_until, loop.time() + delay)
+
+    async def _acquire(self, priority, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        queue = self.waiting.get(priority)
+        if queue is None:
+            queue = self.waiting[priority] = collections.deque()
+        queue.append((chat_id, future))
+        self.wakeup.set()
+        await future
+
+    def _chat_bucket(self, chat_id, now):
+        if chat_id is None:
+            return None
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.MAX_IDLE_CHATS:
+                self.chats = {key: value for key, value in self.chats.items() if not value.is_full(now)}
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    def _grant(self, now):
+        """Let through every waiting call there are tokens for.
+
+        Returns how long until the next waiting call could go, or None when
+        nothing is waiting.
+        """
+        next_wait = None
+        for priority in sorted(self.waiting):
+            queue = self.waiting[priority]
+            blocked = collections.deque()
+            while queue:
+                chat_id, future = queue[0]
+                if future.done():
+                    # Its caller was cancelled
+                    queue.popleft()
+                    continue
+                wait = max(self.paused_until - now, self.overall.wait_time(now))
+                if wait > 0:
+                    queue.extendleft(reversed(blocked))
+                    return wait if next_wait is None else min(wait, next_wait)
+                queue.popleft()
+                bucket = self._chat_bucket(chat_id, now)
+                chat_wait = 0.0 if bucket is None else bucket.wait_time(now)
+                if chat_wait > 0:
+                    blocked.append((chat_id, future))
+                    next_wait = chat_wait if next_wait is None else min(chat_wait, next_wait)
+                    continue
+                self.overall.take(now)
+                if bucket is not None:
+                    bucket.take(now)
+                future.set_result(None)
+            self.waiting[priority] = blocked
+        return next_wait
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            wait = self._grant(loop.time())
+            if wait is None:
+                await self.wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+def join_messages(texts, limit=MAX_MESSAGE_LENGTH):
+    """Join texts into as few messages of at most limit characters as they fit in"""
+    messages = []
+    current = ""
+    for text in texts:
+        if current and len(current) + 2 + len(text) <= limit:
+            current += "\n\n" + text
+            continue
+        if current:
+            messages.append(current)
+        current = text
+    if current:
+        messages.append(current)
+    return messages
+
+
+class Outbox:
+    """Notifications sent in the background, so handlers don't wait on delivery.
+
+    send() queues a text for a chat and returns at once. Texts that pile up
+    for a chat while it waits its turn go out together as one message. The
+    workers send with NOTIFICATION priority when the bot has a
+    PriorityRateLimiter, so they never hold up interactive replies. Texts
+    sent before start() wait for the workers it starts.
+    """
+
+    def __init__(self, workers=8, max_chats=10000):
+        self.workers = workers
+        self.max_chats = max_chats
+        self.bot = None
+        # chat id -> texts waiting to be sent, in the order they were queued
+        self.pending = {}
+        # Chats in pending, in the order they were first queued
+        self.ready = asyncio.Queue()
+        self.tasks = []
+
+    def start(self, bot):
+        self.bot = bot
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    def send(self, chat_id, text):
+        texts = self.pending.get(chat_id)
+        if texts is not None:
+            texts.append(text)
+            return
+        if len(self.pending) >= self.max_chats:
+            logger.warning(f"Outbox full, dropping a notification to {chat_id}")
+            return
+        self.pending[chat_id] = [text]
+        self.ready.put_nowait(chat_id)
+
+    async def _work(self):
+        limiter = getattr(self.bot, "rate_limiter", None)
+        rate_limit_args = NOTIFICATION if isinstance(limiter, PriorityRateLimiter) else None
+        while True:
+            chat_id = await self.ready.get()
+            try:
+                for message in join_messages(self.pending.pop(chat_id)):
+                    await self.bot.send_message(chat_id=chat_id, text=message, rate_limit_args=rate_limit_args)
+            except Exception as e:
+                logger.error(f"Failed to notify {chat_id}: {e}")
+            finally:
+                self.ready.task_done()
+
+    async def stop(self, timeout=10):
+        """Send what is queued, waiting at most timeout seconds, then stop the workers"""
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(self.ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping with notifications for {len(self.pending)} chats unsent")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
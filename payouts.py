@@ -0,0 +1,74 @@
+"""Game costs and payout rules.
+
+The bot's handlers and tools/simulate.py both read them from here, so a
+payout tuned in this file is the payout the simulator measures. Nothing
+here touches Telegram or storage.
+"""
+from slots import SlotMachine
+
+# Game configurations (timeout: seconds an untouched game stays open;
+# payout: what a win pays, as a multiple of the stake)
+GAMES = {
+    "dice": {"cost": 10, "premium_cost": 5, "timeout": 600, "payout": 3},
+    "number": {"cost": 15, "premium_cost": 7, "timeout": 900, "payout": 4},  # Higher reward for harder game
+    "quiz": {"cost": 20, "premium_cost": 10, "timeout": 300, "payout": 2},
+    "rps": {"cost": 10, "premium_cost": 5, "timeout": 300, "payout": 2},  # Rock Paper Scissors; a draw refunds
+    "slots": {"cost": 25, "premium_cost": 12, "premium_only": True},
+    "blackjack": {"cost": 50, "premium_cost": 25, "premium_only": True, "timeout": 900},
+}
+
+# Slots: three reels showing one row, read by one payline. Each reel strip
+# lists symbol indices, once each, so every symbol is equally likely.
+# Three of a symbol pay SLOTS_TRIPLES for that symbol (SLOTS_TRIPLE for the
+# others), any two the same pay SLOTS_PAIR, all times the stake
+SLOTS_SYMBOLS = ("🍒", "🍋", "🍊", "🍇", "💎", "7️⃣")
+SLOTS_REELS = [range(len(SLOTS_SYMBOLS))] * 3
+SLOTS_ROWS = 1
+SLOTS_PAYLINES = [(0, 0, 0)]
+SLOTS_SPINS = (1, 10)  # spins a player may buy at once
+SLOTS_TRIPLES = {"7️⃣": 50, "💎": 20}  # Jackpot, then diamonds
+SLOTS_TRIPLE = 10
+SLOTS_PAIR = 2
+
+# Blackjack result -> what it pays as a multiple of the stake; blackjack
+# pays 3:2 and a push returns the stake
+BLACKJACK_PAYOUTS = {"blackjack": 2.5, "win": 2, "push": 1, "lose": 0}
+# Blackjack is dealt from a shoe of this many decks, shuffled once this
+# share of it has been dealt
+BLACKJACK_DECKS = 6
+BLACKJACK_PENETRATION = 0.75
+
+# Bonus after winning dice, number or quiz: BONUS_BASE times a multiplier
+# drawn from BONUS_MULTIPLIERS, with a LUCKY_BONUS_CHANCE of LUCKY_BONUS_TENS
+# tens more, then premium_bonus() of that on top for premium users
+BONUS_BASE = 10
+BONUS_MULTIPLIERS = (1, 5)
+LUCKY_BONUS_CHANCE = 0.1
+LUCKY_BONUS_TENS = (1, 5)
+
+# premium -> daily reward
+DAILY_REWARDS = {False: 50, True: 100}
+
+# A free user with at least PREMIUM_UPGRADE_WINS wins has PREMIUM_UPGRADE_CHANCE
+# of PREMIUM_UPGRADE_DAYS of premium after each win at dice, number, quiz or rps
+PREMIUM_UPGRADE_WINS = 10
+PREMIUM_UPGRADE_CHANCE = 0.2
+PREMIUM_UPGRADE_DAYS = 3
+
+
+def slots_multiplier(reels):
+    """Return what a spin showing reels pays, as a multiple of the stake"""
+    first, second, third = reels
+    if first == second == third:
+        return SLOTS_TRIPLES.get(first, SLOTS_TRIPLE)
+    if first == second or second == third or first == third:
+        return SLOTS_PAIR
+    return 0
+
+
+def premium_bonus(points):
+    """Return the extra premium users get on top of points; works on NumPy arrays too"""
+    return points // 2
+
+
+SLOTS = SlotMachine(SLOTS_SYMBOLS, SLOTS_REELS, slots_multiplier, SLOTS_ROWS, SLOTS_PAYLINES)
@@ -0,0 +1,146 @@
+"""The quiz question bank, read a question at a time.
+
+The bank is a JSONL file, one question per line:
+
+    {"category": "geography", "difficulty": "easy", "question": "...",
+     "options": ["...", "..."], "answer": 2}
+
+A question's id is its line number, counting from 0, so questions should
+only ever be added at the end; players' seen bitmaps refer to ids.
+
+Opening the bank reads only its index, which holds each line's byte offset,
+category and difficulty in a few bytes per question. The index is built by
+reading the whole bank once, when it is missing or the bank has changed
+since, and saved to index_path. The bank itself is memory-mapped and a
+question is parsed only when it is asked.
+"""
+import json
+import logging
+import mmap
+import os
+import random
+from array import array
+
+logger = logging.getLogger(__name__)
+
+DIFFICULTIES = ("easy", "medium", "hard")
+INDEX_VERSION = 1
+# Random picks tried before sample() lists a pool's unseen questions
+SAMPLE_TRIES = 8
+
+
+class QuestionBank:
+    """Questions by id, and the ids of each category and difficulty.
+
+    Seen sets are int bitmaps, bit n set once question n has been asked, so
+    marking and testing a question is a shift and a mask whatever the size
+    of the bank.
+    """
+
+    def __init__(self, path, index_path):
+        self.path = path
+        self.index_path = index_path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if not stat.st_size:
+                raise ValueError(f"Quiz bank {path} has no questions")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if not self._load_index(source):
+            self._build_index(source)
+
+        # (category or None, difficulty or None) -> ids, None matching any
+        pools = {}
+        for question_id, key in enumerate(zip(self.question_categories, self.question_difficulties)):
+            pools.setdefault(key, array("I")).append(question_id)
+        self.pools = {(None, None): array("I", range(len(self)))}
+        for (category, difficulty), ids in pools.items():
+            category, difficulty = self.categories[category], DIFFICULTIES[difficulty]
+            self.pools[category, difficulty] = ids
+            self.pools.setdefault((category, None), array("I")).extend(ids)
+            self.pools.setdefault((None, difficulty), array("I")).extend(ids)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _load_index(self, source):
+        """Read the saved index; return False if there is none for this version of the bank"""
+        try:
+            with open(self.index_path, "rb") as f:
+                header = json.loads(f.readline())
+                if header["version"] != INDEX_VERSION or header["source"] != source:
+                    return False
+                count = header["count"]
+                self.categories = header["categories"]
+                self.offsets = array("Q")
+                self.offsets.fromfile(f, count + 1)
+                self.question_categories = array("B")
+                self.question_categories.fromfile(f, count)
+                self.question_difficulties = array("B")
+                self.question_difficulties.fromfile(f, count)
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError, EOFError) as e:
+            logger.warning(f"Unreadable quiz index {self.index_path}, rebuilding: {e}")
+            return False
+        return True
+
+    def _build_index(self, source):
+        categories = {}
+        self.offsets = array("Q", [0])
+        self.question_categories = array("B")
+        self.question_difficulties = array("B")
+        with open(self.path, "rb") as f:
+            for line_number, line in enumerate(f, 1):
+                question = json.loads(line)
+                if not 0 <= question["answer"] < len(question["options"]):
+                    raise ValueError(f"Quiz bank {self.path} line {line_number}: answer is not one of the options")
+                category = categories.setdefault(question["category"], len(categories))
+                self.offsets.append(self.offsets[-1] + len(line))
+                self.question_categories.append(category)
+                self.question_difficulties.append(DIFFICULTIES.index(question["difficulty"]))
+        self.categories = list(categories)
+        logger.info(f"Indexed {len(self)} quiz questions in {len(self.categories)} categories")
+
+        header = {"version": INDEX_VERSION, "source": source, "count": len(self), "categories": self.categories}
+        try:
+            with open(self.index_path + ".tmp", "wb") as f:
+                f.write(json.dumps(header).encode() + b"\n")
+                self.offsets.tofile(f)
+                self.question_categories.tofile(f)
+                self.question_difficulties.tofile(f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+        except OSError as e:
+            logger.error(f"Failed to save quiz index: {e}")
+
+    def question(self, question_id):
+        """Return the question with this id, read from the bank"""
+        return json.loads(self.data[self.offsets[question_id]:self.offsets[question_id + 1]])
+
+    def pool(self, category=None, difficulty=None):
+        """Return the ids of the questions in category at difficulty; None matches any"""
+        return self.pools.get((category, difficulty), array("I"))
+
+    def sample(self, seen, category=None, difficulty=None):
+        """Pick a question from the pool the seen bitmap hasn't had yet.
+
+        Return (question id, seen with it marked). Once every question in
+        the pool has been seen, the pool's bits are cleared and it starts
+        over. Returns (None, seen) for an empty pool.
+        """
+        pool = self.pool(category, difficulty)
+        if not pool:
+            return None, seen
+        # Most of a pool is unseen most of the time, so a few random picks
+        # find a question without walking the pool
+        for _ in range(SAMPLE_TRIES):
+            question_id = random.choice(pool)
+            if not seen >> question_id & 1:
+                return question_id, seen | 1 << question_id
+        unseen = [question_id for question_id in pool if not seen >> question_id & 1]
+        if not unseen:
+            for question_id in pool:
+                seen &= ~(1 << question_id)
+            unseen = pool
+        question_id = random.choice(unseen)
+        return question_id, seen | 1 << question_id
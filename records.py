@@ -0,0 +1,124 @@
+from datetime import datetime
+
+
+class UserRecord:
+    """One user's data, kept in slots rather than a per-user dict.
+
+    premium_expiry is a Unix timestamp in whole seconds, or None for premium
+    that never expires. The dict operations the handlers already use
+    (user["credits"] += 10, get(), update(), items()) keep working.
+    """
+
+    FIELDS = ("credits", "is_premium", "premium_expiry", "games_played", "games_won", "total_earnings", "username")
+    __slots__ = FIELDS
+
+    def __init__(self, credits=100, is_premium=False, premium_expiry=None, games_played=0, games_won=0,
+                 total_earnings=0, username=None):
+        self.credits = credits
+        self.is_premium = is_premium
+        self.premium_expiry = premium_expiry
+        self.games_played = games_played
+        self.games_won = games_won
+        self.total_earnings = total_earnings
+        self.username = username
+
+    def __getitem__(self, key):
+        if key not in FIELD_SET:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in FIELD_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in FIELD_SET
+
+    def __eq__(self, other):
+        if not isinstance(other, UserRecord):
+            return NotImplemented
+        return self.to_row() == other.to_row()
+
+    def __repr__(self):
+        fields = ", ".join(f"{key}={value!r}" for key, value in self.items())
+        return f"UserRecord({fields})"
+
+    def get(self, key, default=None):
+        if key not in FIELD_SET:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.FIELDS]
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def copy(self):
+        return UserRecord(*self.to_row())
+
+    def to_row(self):
+        """Return the fields as a tuple, in FIELDS order"""
+        return (
+            self.credits,
+            self.is_premium,
+            self.premium_expiry,
+            self.games_played,
+            self.games_won,
+            self.total_earnings,
+            self.username,
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        credits, is_premium, premium_expiry, games_played, games_won, total_earnings, username = row
+        return cls(credits, bool(is_premium), parse_expiry(premium_expiry), games_played, games_won,
+                   total_earnings, username)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a record from the dict format older versions saved"""
+        return cls(
+            data.get("credits", 100),
+            bool(data.get("is_premium", False)),
+            parse_expiry(data.get("premium_expiry")),
+            data.get("games_played", 0),
+            data.get("games_won", 0),
+            data.get("total_earnings", 0),
+            data.get("username"),
+        )
+
+    @classmethod
+    def load(cls, value):
+        """Build a record from a saved row, or a dict saved by older versions"""
+        if isinstance(value, dict):
+            return cls.from_dict(value)
+        return cls.from_row(value)
+
+
+FIELD_SET = frozenset(UserRecord.FIELDS)
+
+WIN_RATE_MIN_GAMES = 10  # games a user must play before they are ranked by win rate
+
+
+def win_rate(user):
+    if user.games_played < WIN_RATE_MIN_GAMES:
+        return None
+    return user.games_won / user.games_played
+
+
+def parse_expiry(value):
+    """Turn a saved premium expiry into a Unix timestamp.
+
+    Older versions saved ISO 8601 strings.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float) or value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
@@ -0,0 +1,132 @@
+import time
+from collections import OrderedDict
+
+
+class SessionStore:
+    """Active games keyed by user id, closed after sitting idle too long.
+
+    Each game type has its own idle timeout. Reading or replacing a game
+    counts as activity. Games past their timeout are handed to on_expire
+    either when they are next looked up or when sweep() runs, whichever
+    comes first. With max_size set, starting a game beyond that many closes
+    the least recently used one the same way.
+
+    on_change(user_id) is called whenever a game is used, started or closed,
+    so it can be saved. A user without a game in memory is looked up with
+    loader(user_id), which returns (game, wall-clock time of last use) or None.
+    """
+
+    def __init__(self, timeouts, default_timeout=600, max_size=None, on_expire=None, on_change=None, loader=None):
+        self.timeouts = timeouts
+        self.default_timeout = default_timeout
+        self.max_size = max_size
+        self.on_expire = on_expire
+        self.on_change = on_change
+        self.loader = loader
+        # user_id -> (game, last activity), least recently used first
+        self.sessions = OrderedDict()
+
+    def _timeout(self, game):
+        return self.timeouts.get(game["type"], self.default_timeout)
+
+    def _live(self, user_id, now=None):
+        entry = self.sessions.get(user_id)
+        if entry is None:
+            entry = self._load(user_id)
+            if entry is None:
+                return None
+        game, last_used = entry
+        if (now or time.monotonic()) - last_used > self._timeout(game):
+            self._expire(user_id)
+            return None
+        return game
+
+    def _load(self, user_id):
+        if self.loader is None:
+            return None
+        loaded = self.loader(user_id)
+        if loaded is None:
+            return None
+        game, last_used_at = loaded
+        entry = (game, time.monotonic() - (time.time() - last_used_at))
+        self.sessions[user_id] = entry
+        return entry
+
+    def _changed(self, user_id):
+        if self.on_change is not None:
+            self.on_change(user_id)
+
+    def _expire(self, user_id):
+        game, _ = self.sessions.pop(user_id)
+        self._changed(user_id)
+        if self.on_expire is not None:
+            self.on_expire(user_id, game)
+
+    def __contains__(self, user_id):
+        return self._live(user_id) is not None
+
+    def __getitem__(self, user_id):
+        now = time.monotonic()
+        game = self._live(user_id, now)
+        if game is None:
+            raise KeyError(user_id)
+        self.sessions[user_id] = (game, now)
+        self.sessions.move_to_end(user_id)
+        self._changed(user_id)
+        return game
+
+    def get(self, user_id, default=None):
+        try:
+            return self[user_id]
+        except KeyError:
+            return default
+
+    def __setitem__(self, user_id, game):
+        self.sessions.pop(user_id, None)
+        self.sessions[user_id] = (game, time.monotonic())
+        self._changed(user_id)
+        if self.max_size is not None:
+            while len(self.sessions) > self.max_size:
+                self._expire(next(iter(self.sessions)))
+
+    def __delitem__(self, user_id):
+        del self.sessions[user_id]
+        self._changed(user_id)
+
+    def pop(self, user_id, *default):
+        game = self._live(user_id)
+        if game is None:
+            if default:
+                return default[0]
+            raise KeyError(user_id)
+        del self.sessions[user_id]
+        self._changed(user_id)
+        return game
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def export(self, user_id):
+        """Return (game, wall-clock time of last use, time it expires), or None"""
+        entry = self.sessions.get(user_id)
+        if entry is None:
+            return None
+        game, last_used = entry
+        last_used_at = time.time() - (time.monotonic() - last_used)
+        return game, last_used_at, last_used_at + self._timeout(game)
+
+    def sweep(self):
+        """Close every game past its timeout; return how many were closed"""
+        now = time.monotonic()
+        shortest = min(self.timeouts.values(), default=self.default_timeout)
+        shortest = min(shortest, self.default_timeout)
+        expired = []
+        # Oldest first; nothing used within the shortest timeout can have expired
+        for user_id, (game, last_used) in self.sessions.items():
+            if now - last_used <= shortest:
+                break
+            if now - last_used > self._timeout(game):
+                expired.append(user_id)
+        for user_id in expired:
+            self._expire(user_id)
+        return len(expired)
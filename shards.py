@@ -0,0 +1,189 @@
+"""Sharded mode: users split across worker processes by user id.
+
+The dispatcher takes Telegram's webhook POSTs and forwards each update to
+the worker that owns the user it came from. Workers are ordinary
+webhook-mode bots listening on 127.0.0.1, each with its own data directory.
+The few things that span shards (admin commands, global statistics) go
+through ShardClient.
+"""
+import asyncio
+import json
+import logging
+import subprocess
+import sys
+
+from telegram import Update
+
+from webhook import SECRET_HEADER, WebhookServer, read_headers, stop_event
+
+logger = logging.getLogger(__name__)
+
+# Path on each worker's server for calls from other shards
+SHARD_PATH = "/shard"
+
+
+def shard_of(user_id, count):
+    return int(user_id) % count
+
+
+def update_user_id(data):
+    """Return the id of the user a decoded update came from, or None"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+    return None
+
+
+class LocalHTTP:
+    """POSTs to a server on 127.0.0.1 over reused keep-alive connections"""
+
+    def __init__(self, port, secret_token=None):
+        self.port = port
+        self.secret_token = secret_token
+        self.idle = []
+
+    async def post(self, path, body):
+        """POST body to path; return (status, response body)"""
+        while self.idle:
+            reader, writer = self.idle.pop()
+            # The server may have dropped an idle connection; only then try another
+            response = await self._request(reader, writer, path, body, reused=True)
+            if response is not None:
+                return response
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        return await self._request(reader, writer, path, body, reused=False)
+
+    async def _request(self, reader, writer, path, body, reused):
+        head = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{self.port}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+        )
+        if self.secret_token:
+            head += f"{SECRET_HEADER}: {self.secret_token}\r\n"
+        try:
+            writer.write(head.encode() + b"\r\n" + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                writer.close()
+                if reused:
+                    return None
+                raise ConnectionError(f"Connection to port {self.port} closed without a response")
+            status = int(status_line.split()[1])
+            headers = await read_headers(reader)
+            response = await reader.readexactly(int(headers.get("content-length", "0")))
+        except ConnectionError:
+            writer.close()
+            if reused:
+                return None
+            raise
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+        return status, response
+
+
+class ShardClient:
+    """Runs named operations on the shard that owns the data.
+
+    Every worker registers the same operations with op(). call() runs one
+    directly when the shard is this process's own and over HTTP otherwise,
+    so with a single shard nothing leaves the process.
+    """
+
+    def __init__(self, index, count, base_port, secret_token=None):
+        self.index = index
+        self.count = count
+        self.ops = {}
+        self.peers = {
+            shard: LocalHTTP(base_port + shard, secret_token)
+            for shard in range(count) if shard != index
+        }
+
+    def op(self, func):
+        """Register a coroutine function as an operation other shards can call"""
+        self.ops[func.__name__] = func
+        return func
+
+    def owner(self, user_id):
+        return shard_of(user_id, self.count)
+
+    async def call(self, shard, op, **args):
+        if shard == self.index:
+            return await self.ops[op](**args)
+        request = json.dumps({"op": op, "args": args}).encode()
+        status, body = await self.peers[shard].post(SHARD_PATH, request)
+        if status != 200:
+            raise RuntimeError(f"Shard {shard} answered {status} to {op}")
+        return json.loads(body)
+
+    async def call_all(self, op, **args):
+        """Run an operation on every shard; return the results in shard order"""
+        return await asyncio.gather(*(self.call(shard, op, **args) for shard in range(self.count)))
+
+    async def handle(self, body):
+        """WebhookServer route for calls from other shards"""
+        try:
+            request = json.loads(body)
+            func = self.ops[request["op"]]
+            args = request.get("args", {})
+        except (ValueError, KeyError, TypeError):
+            return 400, b""
+        return 200, json.dumps(await func(**args)).encode()
+
+
+def forward_updates(workers, path):
+    """Return a route that passes each posted update to the owning worker.
+
+    A worker that is down or still starting gets the update answered 503,
+    as does a full worker, so Telegram resends it later.
+    """
+    async def handle(body):
+        try:
+            user_id = update_user_id(json.loads(body))
+        except (ValueError, AttributeError):
+            return 400, b""
+        worker = workers[0 if user_id is None else shard_of(user_id, len(workers))]
+        try:
+            return await worker.post(path, body)
+        except (OSError, asyncio.IncompleteReadError):
+            return 503, b""
+
+    return handle
+
+
+async def run_dispatcher(script, worker_envs, host, port, path, base_port, secret_token=None, bot=None, url=None):
+    """Start one worker per environment in worker_envs and forward updates to them.
+
+    Each worker runs script with its environment and must listen on
+    base_port + its shard index. Runs until SIGINT or SIGTERM, then stops
+    the workers. With bot and url given, the webhook is registered first.
+    """
+    processes = [subprocess.Popen([sys.executable, script], env=env) for env in worker_envs]
+    workers = [LocalHTTP(base_port + shard, secret_token) for shard in range(len(worker_envs))]
+
+    server = WebhookServer(host, port, {path: forward_updates(workers, path)}, secret_token)
+    stop = stop_event()
+    try:
+        if bot is not None and url is not None:
+            async with bot:
+                await bot.set_webhook(url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        await server.start()
+        logger.info(f"Dispatching webhook updates on {host}:{port}{path} to {len(workers)} workers")
+        await stop.wait()
+        await server.stop()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.wait)
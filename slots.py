@@ -0,0 +1,87 @@
+import itertools
+import random
+from fractions import Fraction
+
+
+class SlotMachine:
+    """Reels, paylines and a paytable, with every line payout looked up.
+
+    symbols are the names shown for symbol indices 0, 1, ...; each reel is a
+    strip of symbol indices, and a spin stops every reel at a position
+    drawn uniformly from its strip. rows symbols of each reel show, the one
+    at the stop and those after it. A payline gives the row it reads on
+    each reel, and pays(names) gives the multiple of the stake a line
+    showing those symbol names pays. The stake is split evenly between the
+    paylines.
+
+    Every combination a line can show is priced once, here, into paytable,
+    indexed by the line's symbols read as digits in base len(symbols). Each
+    reel's stops are turned into what they add to every line's index, so a
+    spin is a few additions and one lookup per line.
+    """
+
+    def __init__(self, symbols, reels, pays, rows=1, paylines=None):
+        self.symbols = tuple(symbols)
+        self.reels = [tuple(strip) for strip in reels]
+        self.rows = rows
+        self.paylines = [tuple(line) for line in paylines or [(rows // 2,) * len(self.reels)]]
+        for line in self.paylines:
+            if len(line) != len(self.reels) or not all(0 <= row < rows for row in line):
+                raise ValueError(f"Payline {line} doesn't fit {len(self.reels)} reels of {rows} rows")
+        base = len(self.symbols)
+        self.paytable = [
+            pays(tuple(self.symbols[symbol] for symbol in combination))
+            for combination in itertools.product(range(base), repeat=len(self.reels))
+        ]
+        # line_codes[line][reel][stop] is what that stop adds to the line's paytable index
+        self.line_codes = [
+            [
+                [strip[(stop + row) % len(strip)] * base ** (len(self.reels) - 1 - reel) for stop in range(len(strip))]
+                for reel, (strip, row) in enumerate(zip(self.reels, line))
+            ]
+            for line in self.paylines
+        ]
+        self.lengths = [len(strip) for strip in self.reels]
+
+    def multiple(self, stops):
+        """Return what a spin stopping at stops pays, as a multiple of the stake"""
+        paytable = self.paytable
+        if len(self.line_codes) == 1:
+            return paytable[sum(map(list.__getitem__, self.line_codes[0], stops))]
+        total = sum(paytable[sum(map(list.__getitem__, codes, stops))] for codes in self.line_codes)
+        return Fraction(total, len(self.line_codes))
+
+    def spin(self, count=1):
+        """Spin count times; return (stops, multiple) for each spin"""
+        draw = random.random
+        results = []
+        for _ in range(count):
+            stops = tuple([int(draw() * length) for length in self.lengths])
+            results.append((stops, self.multiple(stops)))
+        return results
+
+    def window(self, stops):
+        """Return the symbol names showing after a spin, row by row"""
+        return [
+            tuple(self.symbols[strip[(stop + row) % len(strip)]] for strip, stop in zip(self.reels, stops))
+            for row in range(self.rows)
+        ]
+
+    def rtp(self):
+        """Return the exact return to player, the mean multiple of the stake a spin pays.
+
+        Every row of a reel shows each symbol as often as the strip holds
+        it, so each line's symbols have the same odds, and the mean of the
+        lines is the mean of one.
+        """
+        odds = [[Fraction(strip.count(symbol), len(strip)) for symbol in range(len(self.symbols))]
+                for strip in self.reels]
+        total = Fraction(0)
+        for combination, pays in zip(itertools.product(range(len(self.symbols)), repeat=len(self.reels)),
+                                     self.paytable):
+            if pays:
+                chance = Fraction(1)
+                for reel, symbol in enumerate(combination):
+                    chance *= odds[reel][symbol]
+                total += chance * pays
+        return total
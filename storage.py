@@ -0,0 +1,721 @@
+import asyncio
+import collections
+import concurrent.futures
+import glob
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+from records import WIN_RATE_MIN_GAMES, UserRecord
+
+logger = logging.getLogger(__name__)
+
+# Errors a write can succeed after when tried again, such as a full disk or a
+# locked database; others, like constraint violations, fail every time
+TRANSIENT_ERRORS = (OSError, sqlite3.OperationalError)
+
+
+class Storage:
+    """Interface shared by the storage backends.
+
+    User ids are passed as strings, the same keys the bot has always used.
+    User records are UserRecord objects.
+    """
+
+    def load(self):
+        raise NotImplementedError
+
+    def is_empty(self):
+        raise NotImplementedError
+
+    def get_user(self, user_id_str):
+        """Return a copy of the stored record for a user, or None.
+
+        The caller may change the copy freely; only save_many() changes
+        what is stored.
+        """
+        raise NotImplementedError
+
+    def save_user(self, user_id_str, data):
+        self.save_many({user_id_str: data}, {})
+
+    def get_daily_claim(self, user_id_str):
+        """Return the date of the user's last daily claim, or None"""
+        raise NotImplementedError
+
+    def save_daily_claim(self, user_id_str, day):
+        self.save_many({}, {user_id_str: day})
+
+    def get_quiz_seen(self, user_id_str):
+        """Return the bitmap of quiz questions the user has been asked, 0 for none"""
+        raise NotImplementedError
+
+    def get_session(self, user_id_str):
+        """Return the user's saved game as (game JSON, last used, expires), or None"""
+        raise NotImplementedError
+
+    def expired_sessions(self, now):
+        """Return the ids of users whose saved game expired before now"""
+        raise NotImplementedError
+
+    def save_many(self, users, daily_claims, sessions=None, entries=None, quiz_seen=None):
+        """Write a batch of user records, daily claims, games, ledger entries and quiz seen sets.
+
+        Records, claims, games and seen sets are keyed by user id. A game is
+        saved as (game JSON, last used, expires) timestamps, or None to
+        delete it. Ledger entries are (op id, user id, amount, balance,
+        reason, time) tuples and are only ever added. Seen sets are kept
+        apart from user records so that a user's record stays the same size
+        however many questions there are.
+        """
+        raise NotImplementedError
+
+    def recent_ops(self, limit):
+        """Return the op ids of the last limit ledger entries, oldest first"""
+        raise NotImplementedError
+
+    def find_user_by_username(self, username):
+        """Return the id of the user with this username, or None.
+
+        The match ignores case, as Telegram usernames do.
+        """
+        raise NotImplementedError
+
+    def aggregates(self):
+        """Return user, premium, credit and game totals"""
+        raise NotImplementedError
+
+    def premium_expiries(self):
+        """Return (user id, expiry) for every premium user whose premium expires"""
+        raise NotImplementedError
+
+    def all_users(self):
+        """Return an iterable of (user id, record) for every user"""
+        raise NotImplementedError
+
+    def checkpoint(self):
+        """Make everything written so far cheap to load on the next start"""
+
+    def close(self):
+        pass
+
+
+class LogStore(Storage):
+    """Snapshot file plus an append-only log of per-record changes.
+
+    Every change is one small JSON line in the log, so a write costs the same
+    no matter how many users there are. Once the log has grown as large as the
+    snapshot, the current log is rotated out and a fresh snapshot is written on
+    a background thread, after which the rotated segment is deleted.
+    All records are kept in memory.
+
+    Ledger entries are kept only on disk: before a rotated segment is
+    deleted, its entries are copied to a file of their own under ledger/.
+    """
+
+    def __init__(self, path="data", compact_every=10000, keep_ops=100000):
+        self.path = path
+        self.snapshot_path = os.path.join(path, "snapshot.json")
+        self.log_path = os.path.join(path, "changes.log")
+        self.ledger_path = os.path.join(path, "ledger")
+        self.compact_every = compact_every
+        self.ops = collections.deque(maxlen=keep_ops)
+        self.users = {}
+        self.daily_claims = {}
+        self.sessions = {}
+        self.quiz_seen = {}
+        self.usernames = {}
+        self.seq = 0
+        self.log_records = 0
+        self.log_file = None
+        self.compactor = None
+
+    def load(self):
+        """Rebuild users and daily claims from the snapshot and the log"""
+        os.makedirs(self.path, exist_ok=True)
+        self.users = {}
+        self.daily_claims = {}
+        self.sessions = {}
+        self.quiz_seen = {}
+        self.ops.clear()
+        snapshot_seq = 0
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            self.users = {uid: UserRecord.load(row) for uid, row in snapshot["users"].items()}
+            self.daily_claims = snapshot["daily_claims"]
+            self.sessions = snapshot.get("sessions", {})
+            self.quiz_seen = snapshot.get("quiz_seen", {})
+            self.ops.extend(snapshot.get("ops", []))
+            snapshot_seq = snapshot["seq"]
+
+        self.seq = snapshot_seq
+        self.log_records = 0
+        for segment in self._segments():
+            end = self._replay(segment, snapshot_seq)
+            if segment == self.log_path and end < os.path.getsize(segment):
+                # Cut off a record torn by a crash, so the next one written
+                # starts a line of its own
+                logger.warning(f"Truncating torn record at the end of {segment}")
+                with open(segment, "r+b") as f:
+                    f.truncate(end)
+
+        self.usernames = {}
+        for uid, data in self.users.items():
+            if data.username:
+                self.usernames[data.username.lower()] = uid
+
+        self.log_file = open(self.log_path, "a")
+
+    def _replay(self, segment, snapshot_seq):
+        """Apply a log segment's records; return the offset just past its last whole line.
+
+        A crash in the middle of a write leaves a torn last line, which is
+        left out. A damaged line before the end, left by versions that
+        appended after a torn line, is skipped.
+        """
+        end = 0
+        with open(segment, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                try:
+                    seq, kind, key, value = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipping damaged record in {segment}")
+                    continue
+                if seq <= snapshot_seq:
+                    continue
+                if kind == "u":
+                    self.users[key] = UserRecord.load(value)
+                elif kind == "d":
+                    self.daily_claims[key] = value
+                elif kind == "s" and value is None:
+                    self.sessions.pop(key, None)
+                elif kind == "s":
+                    self.sessions[key] = value
+                elif kind == "l":
+                    self.ops.append(key)
+                elif kind == "q":
+                    self.quiz_seen[key] = value
+                self.seq = max(self.seq, seq)
+                self.log_records += 1
+        return end
+
+    def is_empty(self):
+        return not self.users
+
+    def get_user(self, user_id_str):
+        data = self.users.get(user_id_str)
+        return data.copy() if data is not None else None
+
+    def get_daily_claim(self, user_id_str):
+        return self.daily_claims.get(user_id_str)
+
+    def get_quiz_seen(self, user_id_str):
+        return int(self.quiz_seen.get(user_id_str, "0"), 16)
+
+    def get_session(self, user_id_str):
+        return self.sessions.get(user_id_str)
+
+    def expired_sessions(self, now):
+        return [uid for uid, (game, last_used, expires) in self.sessions.items() if expires < now]
+
+    def save_many(self, users, daily_claims, sessions=None, entries=None, quiz_seen=None):
+        records = []
+        for user_id_str, data in users.items():
+            self.users[user_id_str] = data
+            if data.username:
+                self.usernames[data.username.lower()] = user_id_str
+            records.append(("u", user_id_str, data.to_row()))
+        for user_id_str, day in daily_claims.items():
+            self.daily_claims[user_id_str] = day
+            records.append(("d", user_id_str, day))
+        for user_id_str, session in (sessions or {}).items():
+            if session is None:
+                self.sessions.pop(user_id_str, None)
+            else:
+                self.sessions[user_id_str] = session
+            records.append(("s", user_id_str, session))
+        for op_id, *entry in entries or ():
+            self.ops.append(op_id)
+            records.append(("l", op_id, entry))
+        for user_id_str, seen in (quiz_seen or {}).items():
+            self.quiz_seen[user_id_str] = format(seen, "x")
+            records.append(("q", user_id_str, self.quiz_seen[user_id_str]))
+        self.append(records)
+
+    def recent_ops(self, limit):
+        return list(self.ops)[-limit:] if limit else []
+
+    def find_user_by_username(self, username):
+        key = username.lower()
+        uid = self.usernames.get(key)
+        if uid is None:
+            return None
+        # Renamed users leave their old name behind in the index
+        current = self.users[uid].username
+        if current and current.lower() == key:
+            return uid
+        return None
+
+    def aggregates(self):
+        return {
+            "total_users": len(self.users),
+            "premium_users": sum(1 for data in self.users.values() if data.is_premium),
+            "total_credits": sum(data.credits for data in self.users.values()),
+            "total_games": sum(data.games_played for data in self.users.values()),
+        }
+
+    def premium_expiries(self):
+        return [
+            (uid, data.premium_expiry) for uid, data in self.users.items()
+            if data.is_premium and data.premium_expiry is not None
+        ]
+
+    def all_users(self):
+        return list(self.users.items())
+
+    def append(self, records):
+        """Append (kind, key, value) change records.
+
+        Kind is "u" for a user, "d" for a daily claim, "s" for a game, with a
+        value of None when the game has ended, "l" for a ledger entry,
+        keyed by its op id, and "q" for a quiz seen set, in hex.
+        """
+        lines = []
+        for kind, key, value in records:
+            self.seq += 1
+            lines.append(json.dumps([self.seq, kind, key, value], separators=(",", ":")) + "\n")
+        # One write and one flush for the whole batch
+        self.log_file.write("".join(lines))
+        self.log_file.flush()
+        self.log_records += len(lines)
+        if self.needs_compaction():
+            self.compact()
+
+    def needs_compaction(self):
+        # Compacting only once the log is as large as the data keeps the
+        # amortized cost of snapshotting constant per change
+        if self.compactor is not None and self.compactor.is_alive():
+            return False
+        return self.log_records >= max(self.compact_every, len(self.users))
+
+    def compact(self, wait=False):
+        """Rotate the log and write a snapshot of the current state"""
+        if self.compactor is not None:
+            self.compactor.join()
+
+        # Everything up to self.seq is in the state we are about to copy, so the
+        # rotated segment can be dropped once the snapshot is on disk
+        self.log_file.close()
+        segment = f"{self.log_path}.{self.seq}"
+        os.replace(self.log_path, segment)
+        self.log_file = open(self.log_path, "a")
+        self.log_records = 0
+
+        state = {
+            "seq": self.seq,
+            "users": {uid: data.to_row() for uid, data in self.users.items()},
+            "daily_claims": dict(self.daily_claims),
+            "sessions": dict(self.sessions),
+            "quiz_seen": dict(self.quiz_seen),
+            "ops": list(self.ops),
+        }
+        self.compactor = threading.Thread(target=self._write_snapshot, args=(state,), daemon=True)
+        self.compactor.start()
+        if wait:
+            self.compactor.join()
+
+    def checkpoint(self):
+        self.compact(wait=True)
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.join()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def _write_snapshot(self, state):
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.error(f"Failed to write snapshot: {e}")
+            return
+
+        for segment in self._segments():
+            if segment == self.log_path:
+                continue
+            if int(segment.rsplit(".", 1)[1]) <= state["seq"]:
+                try:
+                    self._archive_entries(segment)
+                except OSError as e:
+                    logger.error(f"Failed to archive ledger entries from {segment}: {e}")
+                    return
+                os.remove(segment)
+
+    def _archive_entries(self, segment):
+        """Copy a segment's ledger entries to ledger/<segment seq>.log.
+
+        The copy replaces any earlier one of the same segment, so a crash
+        before the segment is deleted can't leave entries archived twice.
+        """
+        lines = []
+        with open(segment, "r") as f:
+            for line in f:
+                try:
+                    seq, kind, key, value = json.loads(line)
+                except ValueError:
+                    continue
+                if kind == "l":
+                    lines.append(json.dumps([seq, key, *value], separators=(",", ":")) + "\n")
+        if not lines:
+            return
+        os.makedirs(self.ledger_path, exist_ok=True)
+        path = os.path.join(self.ledger_path, segment.rsplit(".", 1)[1] + ".log")
+        with open(path + ".tmp", "w") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _segments(self):
+        rotated = glob.glob(f"{glob.escape(self.log_path)}.*")
+        rotated = [p for p in rotated if p.rsplit(".", 1)[1].isdigit()]
+        rotated.sort(key=lambda p: int(p.rsplit(".", 1)[1]))
+        if os.path.exists(self.log_path):
+            rotated.append(self.log_path)
+        return rotated
+
+
+# Statements are kept as constants so sqlite3's statement cache reuses the
+# prepared form on every call
+SQLITE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    credits INTEGER NOT NULL,
+    is_premium INTEGER NOT NULL,
+    premium_expiry INTEGER,
+    games_played INTEGER NOT NULL,
+    games_won INTEGER NOT NULL,
+    total_earnings INTEGER NOT NULL
+);
+DROP INDEX IF EXISTS users_username;
+CREATE INDEX IF NOT EXISTS users_username_nocase ON users (username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_premium ON users (is_premium, premium_expiry);
+CREATE INDEX IF NOT EXISTS users_credits ON users (credits);
+CREATE INDEX IF NOT EXISTS users_earnings ON users (total_earnings);
+CREATE INDEX IF NOT EXISTS users_wins ON users (games_won);
+CREATE INDEX IF NOT EXISTS users_winrate ON users (CAST(games_won AS REAL) / games_played)
+    WHERE games_played >= {WIN_RATE_MIN_GAMES};
+CREATE TABLE IF NOT EXISTS daily_claims (
+    user_id INTEGER PRIMARY KEY,
+    day TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    game TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+CREATE TABLE IF NOT EXISTS quiz_seen (
+    user_id INTEGER PRIMARY KEY,
+    seen BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ledger (
+    seq INTEGER PRIMARY KEY,
+    op_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    balance INTEGER NOT NULL,
+    reason TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ledger_op ON ledger (op_id, user_id);
+CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id, seq);
+"""
+SELECT_USER = (
+    "SELECT credits, is_premium, premium_expiry, games_played, games_won, total_earnings, username "
+    "FROM users WHERE user_id = ?"
+)
+UPSERT_USER = (
+    "INSERT INTO users (user_id, credits, is_premium, premium_expiry, games_played, games_won, total_earnings, username) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, credits = excluded.credits, "
+    "is_premium = excluded.is_premium, premium_expiry = excluded.premium_expiry, "
+    "games_played = excluded.games_played, games_won = excluded.games_won, total_earnings = excluded.total_earnings"
+)
+SELECT_DAILY_CLAIM = "SELECT day FROM daily_claims WHERE user_id = ?"
+UPSERT_DAILY_CLAIM = (
+    "INSERT INTO daily_claims (user_id, day) VALUES (?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET day = excluded.day"
+)
+SELECT_SESSION = "SELECT game, last_used, expires FROM sessions WHERE user_id = ?"
+SELECT_EXPIRED_SESSIONS = "SELECT user_id FROM sessions WHERE expires < ?"
+UPSERT_SESSION = (
+    "INSERT INTO sessions (user_id, game, last_used, expires) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET game = excluded.game, last_used = excluded.last_used, "
+    "expires = excluded.expires"
+)
+DELETE_SESSION = "DELETE FROM sessions WHERE user_id = ?"
+SELECT_QUIZ_SEEN = "SELECT seen FROM quiz_seen WHERE user_id = ?"
+UPSERT_QUIZ_SEEN = (
+    "INSERT INTO quiz_seen (user_id, seen) VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET seen = excluded.seen"
+)
+# An op id already in the ledger was applied before; a repeat that has left
+# the bot's window of recent ops is dropped rather than failing the batch
+INSERT_LEDGER_ENTRY = (
+    "INSERT OR IGNORE INTO ledger (op_id, user_id, amount, balance, reason, created) VALUES (?, ?, ?, ?, ?, ?)"
+)
+SELECT_RECENT_OPS = "SELECT op_id FROM ledger ORDER BY seq DESC LIMIT ?"
+SELECT_USER_BY_USERNAME = "SELECT user_id FROM users WHERE username = ? COLLATE NOCASE"
+SELECT_PREMIUM_EXPIRIES = (
+    "SELECT user_id, premium_expiry FROM users WHERE is_premium = 1 AND premium_expiry IS NOT NULL"
+)
+SELECT_ALL_USERS = (
+    "SELECT user_id, credits, is_premium, premium_expiry, games_played, games_won, total_earnings, username "
+    "FROM users"
+)
+# Leaderboard -> (score expression, condition for a user to be on it),
+# matching the users_* indexes so top and rank queries walk an index
+LEADERBOARD_SCORES = {
+    "credits": ("credits", "1"),
+    "earnings": ("total_earnings", "1"),
+    "wins": ("games_won", "1"),
+    "winrate": ("CAST(games_won AS REAL) / games_played", f"games_played >= {WIN_RATE_MIN_GAMES}"),
+}
+# Users passed in a JSON list are left out, for callers that rank their
+# newer copies of those users themselves. Ties go to the lower user id.
+SELECT_LEADERBOARD_TOP = {
+    board: (
+        f"SELECT user_id, {score} FROM users WHERE {condition} "
+        f"AND user_id NOT IN (SELECT value FROM json_each(?)) ORDER BY {score} DESC, user_id LIMIT ?"
+    )
+    for board, (score, condition) in LEADERBOARD_SCORES.items()
+}
+SELECT_LEADERBOARD_COUNTS = {
+    board: f"SELECT {score}, COUNT(*) FROM users WHERE {condition} GROUP BY 1"
+    for board, (score, condition) in LEADERBOARD_SCORES.items()
+}
+SELECT_AGGREGATES = (
+    "SELECT COUNT(*), COALESCE(SUM(is_premium), 0), COALESCE(SUM(credits), 0), COALESCE(SUM(games_played), 0) "
+    "FROM users"
+)
+
+
+def exclude_list(user_id_strs):
+    """Return user ids as the JSON list the leaderboard queries take"""
+    return json.dumps([int(user_id_str) for user_id_str in user_id_strs])
+
+
+class SQLiteStore(Storage):
+    """Users and daily claims in an SQLite database, read one row at a time.
+
+    Each thread gets its own connection, so reads on the event loop can run
+    while a StorageWriter thread is writing.
+    """
+
+    def __init__(self, path="data/bot.db"):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+
+    def load(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self.db
+        db.executescript(SQLITE_SCHEMA)
+        db.commit()
+
+    @property
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            self.local.db = db
+            self.connections.append(db)
+        return db
+
+    def is_empty(self):
+        return self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def get_user(self, user_id_str):
+        row = self.db.execute(SELECT_USER, (int(user_id_str),)).fetchone()
+        if row is None:
+            return None
+        return UserRecord.from_row(row)
+
+    def get_daily_claim(self, user_id_str):
+        row = self.db.execute(SELECT_DAILY_CLAIM, (int(user_id_str),)).fetchone()
+        return row[0] if row else None
+
+    def get_quiz_seen(self, user_id_str):
+        row = self.db.execute(SELECT_QUIZ_SEEN, (int(user_id_str),)).fetchone()
+        return int.from_bytes(row[0], "little") if row else 0
+
+    def get_session(self, user_id_str):
+        return self.db.execute(SELECT_SESSION, (int(user_id_str),)).fetchone()
+
+    def expired_sessions(self, now):
+        return [str(row[0]) for row in self.db.execute(SELECT_EXPIRED_SESSIONS, (now,))]
+
+    def save_many(self, users, daily_claims, sessions=None, entries=None, quiz_seen=None):
+        sessions = sessions or {}
+        db = self.db
+        # One transaction, and so one commit, for the whole batch
+        with db:
+            db.executemany(UPSERT_USER, [
+                (int(user_id_str), *data.to_row()) for user_id_str, data in users.items()
+            ])
+            db.executemany(UPSERT_DAILY_CLAIM, [
+                (int(user_id_str), day) for user_id_str, day in daily_claims.items()
+            ])
+            db.executemany(UPSERT_SESSION, [
+                (int(user_id_str), *session) for user_id_str, session in sessions.items() if session is not None
+            ])
+            db.executemany(DELETE_SESSION, [
+                (int(user_id_str),) for user_id_str, session in sessions.items() if session is None
+            ])
+            db.executemany(INSERT_LEDGER_ENTRY, [
+                (op_id, int(user_id_str), *entry) for op_id, user_id_str, *entry in entries or ()
+            ])
+            db.executemany(UPSERT_QUIZ_SEEN, [
+                (int(user_id_str), seen.to_bytes((seen.bit_length() + 7) // 8, "little"))
+                for user_id_str, seen in (quiz_seen or {}).items()
+            ])
+
+    def recent_ops(self, limit):
+        rows = self.db.execute(SELECT_RECENT_OPS, (limit,)).fetchall()
+        return [op_id for (op_id,) in reversed(rows)]
+
+    def find_user_by_username(self, username):
+        row = self.db.execute(SELECT_USER_BY_USERNAME, (username,)).fetchone()
+        return str(row[0]) if row else None
+
+    def aggregates(self):
+        total_users, premium_users, total_credits, total_games = self.db.execute(SELECT_AGGREGATES).fetchone()
+        return {
+            "total_users": total_users,
+            "premium_users": premium_users,
+            "total_credits": total_credits,
+            "total_games": total_games,
+        }
+
+    def premium_expiries(self):
+        return [(str(user_id), expiry) for user_id, expiry in self.db.execute(SELECT_PREMIUM_EXPIRIES)]
+
+    def all_users(self):
+        # Rows are read as they are used rather than all at once
+        return ((str(user_id), UserRecord.from_row(row)) for user_id, *row in self.db.execute(SELECT_ALL_USERS))
+
+    def leaderboard_top(self, board, count, exclude=()):
+        """Return (user id, score) for the top count users on a board, leaving out the ids in exclude"""
+        rows = self.db.execute(SELECT_LEADERBOARD_TOP[board], (exclude_list(exclude), count))
+        return [(str(user_id), score) for user_id, score in rows]
+
+    def leaderboard_counts(self, board):
+        """Return (score, number of users with it) for every score on a board"""
+        return self.db.execute(SELECT_LEADERBOARD_COUNTS[board]).fetchall()
+
+    def checkpoint(self):
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        for db in self.connections:
+            db.close()
+        self.connections = []
+        self.local = threading.local()
+
+
+class StorageWriter:
+    """Runs storage calls on one background thread, in the order they were submitted.
+
+    Async callers await wait_for_room() before submitting, which holds them
+    back while max_pending calls are already queued instead of letting the
+    queue grow or blocking the event loop.
+    """
+
+    def __init__(self, max_pending=8):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.queue = queue.Queue()
+        self.thread = None
+        self.loop = None
+        self.room = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.room = asyncio.Event()
+        self.thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+        self.thread.start()
+
+    async def wait_for_room(self):
+        while self.pending >= self.max_pending:
+            self.room.clear()
+            await self.room.wait()
+
+    def submit(self, func, *args):
+        """Queue func(*args) for the writer thread and return a future for its result"""
+        if self.thread is None:
+            self.start()
+        future = concurrent.futures.Future()
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self._finished))
+        self.pending += 1
+        self.queue.put((func, args, future))
+        return asyncio.wrap_future(future, loop=self.loop)
+
+    async def stop(self):
+        """Finish everything queued so far and stop the thread"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        await self.loop.run_in_executor(None, self.thread.join)
+        self.thread = None
+
+    def _finished(self):
+        self.pending -= 1
+        self.room.set()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            func, args, future = item
+            # A write still has to happen when its caller stopped waiting for
+            # it (was cancelled); only the result has nowhere to go
+            waited_for = future.set_running_or_notify_cancel()
+            try:
+                result = func(*args)
+            except Exception as e:
+                if waited_for:
+                    future.set_exception(e)
+                else:
+                    logger.exception(f"Storage call {func.__name__} failed after its caller was cancelled")
+            else:
+                if waited_for:
+                    future.set_result(result)
+
+
+def open_storage(backend, data_dir):
+    if backend == "sqlite":
+        return SQLiteStore(os.path.join(data_dir, "bot.db"))
+    if backend == "log":
+        return LogStore(data_dir)
+    raise ValueError(f"Unknown storage backend: {backend}")
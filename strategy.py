@@ -0,0 +1,174 @@
+"""Exact blackjack odds and basic strategy for the bot's rules.
+
+The rules solved for are the ones handle_blackjack_action() plays: the
+dealer draws to 17 and stands on every 17, soft or not, and never checks
+for blackjack; the player may only hit or stand, and stands on 21; a
+natural pays BLACKJACK_PAYOUTS["blackjack"] whatever the dealer holds, and
+otherwise equal scores push.
+
+Cards come from an infinite deck, each rank with chance 1/13, as basic
+strategy usually assumes; the bot's six-deck shoe moves the odds by a
+fraction of a percent. Both the dealer's final totals and the player's
+returns are worked out by dynamic programming over hand states (see
+blackjack.state()), each state solved once.
+
+Returns are what comes back per credit staked, so 1.0 breaks even.
+"""
+import json
+import logging
+import os
+
+import blackjack
+from blackjack import RANKS
+from payouts import BLACKJACK_PAYOUTS
+
+logger = logging.getLogger(__name__)
+
+STAND, HIT = 0, 1
+DEALER_STANDS = 17
+# The dealer's possible finishes: a total from 17 to 21, or bust
+DEALER_FINISHES = (17, 18, 19, 20, 21, "bust")
+# Changing any of these makes a saved table stale
+RULES = {"version": 1, "dealer_stands": DEALER_STANDS, "payouts": BLACKJACK_PAYOUTS}
+
+
+def next_state(state, card):
+    return blackjack.state(blackjack.add_card(state, card))
+
+
+def dealer_finishes(state, memo):
+    """Return the chance of each of DEALER_FINISHES for a dealer holding state"""
+    finishes = memo.get(state)
+    if finishes is not None:
+        return finishes
+    score = blackjack.score(state)
+    if score > 21:
+        finishes = (0.0,) * 5 + (1.0,)
+    elif score >= DEALER_STANDS:
+        finishes = tuple(1.0 if total == score else 0.0 for total in DEALER_FINISHES)
+    else:
+        sums = [0.0] * len(DEALER_FINISHES)
+        for card in range(len(RANKS)):
+            for i, chance in enumerate(dealer_finishes(next_state(state, card), memo)):
+                sums[i] += chance / len(RANKS)
+        finishes = tuple(sums)
+    memo[state] = finishes
+    return finishes
+
+
+def stand_return(score, finishes, payouts):
+    """Return what standing on score pays back against the dealer's finishes"""
+    result = finishes[-1] * payouts["win"]
+    for total, chance in zip(DEALER_FINISHES, finishes):
+        if total == "bust":
+            continue
+        if score > total:
+            result += chance * payouts["win"]
+        elif score == total:
+            result += chance * payouts["push"]
+        else:
+            result += chance * payouts["lose"]
+    return result
+
+
+class BasicStrategy:
+    """Returns of standing and hitting for every player state and dealer up card.
+
+    Both are flat lists indexed by index(), so a lookup is a mask, a
+    multiply and an add. States the player can't act from (21 or more)
+    return the lose payout for hitting, so standing always wins there.
+    """
+
+    def __init__(self, stand, hit, rules=RULES):
+        self.stand = stand
+        self.hit = hit
+        self.rules = rules
+
+    @classmethod
+    def solve(cls, payouts=BLACKJACK_PAYOUTS):
+        size = blackjack.STATES * len(RANKS)
+        stand = [0.0] * size
+        hit = [0.0] * size
+        dealer_memo = {}
+        for up in range(len(RANKS)):
+            finishes = dealer_finishes(next_state(blackjack.EMPTY_HAND, up), dealer_memo)
+            best_memo = {}
+
+            def best(state):
+                """Return what the best play from state pays back, filling in its table entries"""
+                result = best_memo.get(state)
+                if result is not None:
+                    return result
+                score = blackjack.score(state)
+                if score > 21:
+                    return payouts["lose"]
+                index = state * len(RANKS) + up
+                stand[index] = stand_return(score, finishes, payouts)
+                if score == 21:
+                    hit[index] = payouts["lose"]
+                else:
+                    hit[index] = sum(best(next_state(state, card)) for card in range(len(RANKS))) / len(RANKS)
+                best_memo[state] = result = max(stand[index], hit[index])
+                return result
+
+            for state in range(blackjack.STATES):
+                best(state)
+        return cls(stand, hit, dict(RULES, payouts=payouts))
+
+    @staticmethod
+    def index(hand, up):
+        return blackjack.state(hand) * len(RANKS) + up
+
+    def returns(self, hand, up):
+        """Return (stand, hit): what each pays back for hand against up card up"""
+        index = self.index(hand, up)
+        return self.stand[index], self.hit[index]
+
+    def action(self, hand, up):
+        stand, hit = self.returns(hand, up)
+        return HIT if hit > stand else STAND
+
+    def best_return(self, hand, up):
+        return max(self.returns(hand, up))
+
+    def deal_return(self, hand, up):
+        """Return what a freshly dealt hand pays back with best play from here"""
+        if blackjack.is_blackjack(hand):
+            return self.rules["payouts"]["blackjack"]
+        return self.best_return(hand, up)
+
+    def rtp(self):
+        """Return the whole game's return to player with best play"""
+        total = 0.0
+        for first in range(len(RANKS)):
+            for second in range(len(RANKS)):
+                hand = blackjack.make_hand((first, second))
+                for up in range(len(RANKS)):
+                    total += self.deal_return(hand, up)
+        return total / len(RANKS) ** 3
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as f:
+            json.dump({"rules": self.rules, "stand": self.stand, "hit": self.hit}, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, payouts=BLACKJACK_PAYOUTS):
+        """Load the table saved at path, solving and saving it if it is missing or for other rules"""
+        rules = dict(RULES, payouts=payouts)
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["rules"] == rules:
+                return cls(saved["stand"], saved["hit"], rules)
+            logger.info("Blackjack strategy table is for other rules, solving again")
+        except FileNotFoundError:
+            logger.info("No blackjack strategy table yet, solving")
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Unreadable blackjack strategy table, solving again: {e}")
+        strategy = cls.solve(payouts)
+        try:
+            strategy.save(path)
+        except OSError as e:
+            logger.error(f"Failed to save blackjack strategy table: {e}")
+        return strategy
@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blackjack
+from payouts import BLACKJACK_DECKS
+
+
+def longest_cards(hand_state, remaining, memo):
+    """Return the longest run of cards a hand in hand_state can still take from remaining"""
+    key = (hand_state, remaining)
+    if key not in memo:
+        best = []
+        if blackjack.score(hand_state) < 21:
+            for card, left in enumerate(remaining):
+                if left:
+                    after = remaining[:card] + (left - 1,) + remaining[card + 1:]
+                    following = longest_cards(blackjack.state(blackjack.add_card(hand_state, card)), after, memo)
+                    if len(following) + 1 > len(best):
+                        best = [card] + following
+        memo[key] = best
+    return memo[key]
+
+
+def test_longest_hand_the_shoe_allows():
+    shoe = (4 * BLACKJACK_DECKS,) * len(blackjack.RANKS)
+    cards = longest_cards(blackjack.EMPTY_HAND, shoe, {})
+    hand = blackjack.make_hand(cards)
+    assert blackjack.card_count(hand) == len(cards)
+    assert blackjack.cards(hand) == cards
+    assert blackjack.describe(hand) == " ".join(blackjack.RANKS[card] for card in cards)
+    assert blackjack.state(hand) == blackjack.state(blackjack.make_hand(sorted(cards)))
+    if BLACKJACK_DECKS >= 5:
+        assert len(cards) == 20
+
+
+def hand_of(*ranks):
+    return blackjack.make_hand(blackjack.RANKS.index(rank) for rank in ranks)
+
+
+def test_score_and_softness():
+    assert blackjack.score(hand_of("10", "7")) == 17
+    assert not blackjack.is_soft(hand_of("10", "7"))
+    assert blackjack.score(hand_of("A", "6")) == 17
+    assert blackjack.is_soft(hand_of("A", "6"))
+    # The ace drops back to 1 rather than bust
+    assert blackjack.score(hand_of("A", "6", "9")) == 16
+    assert not blackjack.is_soft(hand_of("A", "6", "9"))
+    assert blackjack.score(hand_of("A", "A", "9")) == 21
+    assert blackjack.is_soft(hand_of("A", "A", "9"))
+    assert blackjack.score(hand_of("K", "Q", "5")) == 25
+    assert blackjack.score(blackjack.EMPTY_HAND) == 0
+
+
+def test_blackjack_needs_two_cards():
+    assert blackjack.is_blackjack(hand_of("A", "K"))
+    assert not blackjack.is_blackjack(hand_of("7", "7", "7"))
+    assert not blackjack.is_blackjack(hand_of("A", "9"))
+
+
+def test_cards_and_describe():
+    hand = hand_of("A", "10", "2", "J")
+    assert blackjack.card_count(hand) == 4
+    assert blackjack.first_card(hand) == blackjack.ACE
+    assert blackjack.cards(hand) == [12, 8, 0, 9]
+    assert blackjack.describe(hand) == "A 10 2 J"
+    assert blackjack.describe(blackjack.EMPTY_HAND) == ""
+
+
+def test_state_plays_like_the_hand():
+    hand = hand_of("A", "3", "2")
+    hand_state = blackjack.state(hand)
+    assert blackjack.card_count(hand_state) == 0
+    assert 0 <= hand_state < blackjack.STATES
+    for card in range(len(blackjack.RANKS)):
+        assert blackjack.score(blackjack.add_card(hand_state, card)) == blackjack.score(blackjack.add_card(hand, card))
+        assert blackjack.is_soft(blackjack.add_card(hand_state, card)) == blackjack.is_soft(blackjack.add_card(hand, card))
@@ -0,0 +1,109 @@
+import bisect
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from leaderboard import BUCKETS, Leaderboard, ScoreCounts, SkipList, _bucket
+
+
+def check_against(skiplist, expected, rng):
+    assert len(skiplist) == len(expected)
+    assert skiplist.slice(0, len(expected) + 1) == expected
+    for _ in range(5):
+        start = rng.randrange(len(expected) + 2)
+        count = rng.randrange(1, 8)
+        assert skiplist.slice(start, count) == expected[start:start + count]
+    if expected:
+        key = rng.choice(expected)
+        assert skiplist.count_less(key) == expected.index(key)
+    key = rng.randrange(-10, 2010)
+    assert skiplist.count_less(key) == bisect.bisect_left(expected, key)
+
+
+def test_skiplist_matches_a_sorted_list():
+    rng = random.Random(2)
+    skiplist = SkipList()
+    expected = []
+    for _ in range(4000):
+        if expected and rng.random() < 0.45:
+            key = expected.pop(rng.randrange(len(expected)))
+            skiplist.remove(key)
+        else:
+            key = rng.randrange(2000)
+            if key in expected:
+                continue
+            bisect.insort(expected, key)
+            skiplist.insert(key)
+        check_against(skiplist, expected, rng)
+
+
+def test_skiplist_from_sorted_then_changed():
+    rng = random.Random(3)
+    for size in (0, 1, 2, 17, 500):
+        expected = sorted(rng.sample(range(2000), size))
+        skiplist = SkipList.from_sorted(expected)
+        check_against(skiplist, expected, rng)
+        for _ in range(200):
+            if expected and rng.random() < 0.5:
+                key = expected.pop(rng.randrange(len(expected)))
+                skiplist.remove(key)
+            else:
+                key = rng.randrange(2000)
+                if key in expected:
+                    continue
+                bisect.insort(expected, key)
+                skiplist.insert(key)
+            check_against(skiplist, expected, rng)
+
+
+def test_skiplist_remove_missing_key():
+    skiplist = SkipList.from_sorted([1, 3])
+    with pytest.raises(KeyError):
+        skiplist.remove(2)
+    assert skiplist.slice(0, 5) == [1, 3]
+
+
+def test_leaderboard_ranks_ties_together():
+    board = Leaderboard({"score": lambda record: record})
+    board.load([("1", 50), ("2", 70), ("3", 50)])
+    board.update("4", 60)
+    board.update("2", None)
+    assert board.top("score", 10) == [(4, 60), (1, 50), (3, 50)]
+    assert board.count_ahead("score", 50) == 1
+    assert board.rank("score", 3) == 3
+    assert board.size("score") == 3
+
+
+def test_score_counts_match_a_plain_count():
+    rng = random.Random(1)
+    counts = ScoreCounts()
+    scores = []
+    for _ in range(3000):
+        if scores and rng.random() < 0.3:
+            counts.remove(scores.pop(rng.randrange(len(scores))))
+        else:
+            score = rng.choice([rng.randrange(100), rng.randrange(10 ** 12), rng.random(), 2 ** 70])
+            counts.add(score)
+            scores.append(score)
+        probe = rng.choice(scores) if scores and rng.random() < 0.5 else rng.randrange(10 ** 12)
+        assert counts.count_above(probe) == sum(1 for score in scores if score > probe)
+        assert len(counts) == len(scores)
+
+
+def test_score_counts_from_counts():
+    counts = ScoreCounts.from_counts([(100, 5), (250, 2), (0.5, 3)])
+    assert len(counts) == 10
+    assert counts.count_above(100) == 2
+    assert counts.count_above(99) == 7
+    assert counts.count_above(0) == 10
+
+
+def test_buckets_never_go_down():
+    scores = sorted({-5, 0, 0.25, 0.999, 1, 1.5, 2, 3, 255, 256, 257, 10 ** 9, 2 ** 63 - 1, 2 ** 64, 2 ** 200})
+    buckets = [_bucket(score) for score in scores]
+    assert buckets == sorted(buckets)
+    assert 0 <= buckets[0] and buckets[-1] == BUCKETS - 1
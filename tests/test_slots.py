@@ -0,0 +1,61 @@
+import itertools
+import os
+import sys
+from fractions import Fraction
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payouts import SLOTS, slots_multiplier
+from slots import SlotMachine
+
+
+def line_pays(machine, stops, pays):
+    """Work out a spin's multiple from the symbols on each payline, without the paytable"""
+    total = Fraction(0)
+    for line in machine.paylines:
+        names = tuple(
+            machine.symbols[strip[(stop + row) % len(strip)]]
+            for strip, stop, row in zip(machine.reels, stops, line)
+        )
+        total += pays(names)
+    return total / len(machine.paylines)
+
+
+def every_spin(machine):
+    return itertools.product(*(range(len(strip)) for strip in machine.reels))
+
+
+def test_configured_rtp_matches_every_spin():
+    spins = list(every_spin(SLOTS))
+    expected = sum(line_pays(SLOTS, stops, slots_multiplier) for stops in spins) / len(spins)
+    assert SLOTS.rtp() == expected
+
+
+def test_paylines_over_several_rows():
+    machine = SlotMachine(
+        ("a", "b", "c"),
+        [(0, 1, 2, 0), (1, 1, 2), (2, 0, 1, 1, 0)],
+        slots_multiplier,
+        rows=3,
+        paylines=[(0, 0, 0), (1, 1, 1), (0, 1, 2)],
+    )
+    for combination, pays in zip(itertools.product(machine.symbols, repeat=3), machine.paytable):
+        assert pays == slots_multiplier(combination)
+    spins = list(every_spin(machine))
+    for stops in spins:
+        assert machine.multiple(stops) == line_pays(machine, stops, slots_multiplier)
+    expected = sum(line_pays(machine, stops, slots_multiplier) for stops in spins) / len(spins)
+    assert machine.rtp() == expected
+
+
+def test_window_and_spin():
+    stops, multiple = SLOTS.spin(20)[-1]
+    assert len(SLOTS.window(stops)) == SLOTS.rows
+    assert multiple == line_pays(SLOTS, stops, slots_multiplier)
+
+
+def test_payline_must_fit():
+    with pytest.raises(ValueError):
+        SlotMachine(("a", "b"), [(0, 1), (0, 1)], lambda names: 0, rows=1, paylines=[(0, 1)])
@@ -0,0 +1,75 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from records import UserRecord
+from storage import LogStore
+
+
+def reopen(path):
+    store = LogStore(str(path))
+    store.load()
+    return store
+
+
+def test_replay_after_torn_record(tmp_path):
+    store = reopen(tmp_path)
+    store.save_many({"1": UserRecord(credits=111)}, {})
+    store.close()
+    # A crash in the middle of the next write
+    with open(store.log_path, "a") as f:
+        f.write('[2,"u","1",[222,fal')
+
+    store = reopen(tmp_path)
+    assert store.users["1"].credits == 111
+    store.save_many({"1": UserRecord(credits=333), "2": UserRecord(credits=444)}, {})
+    store.close()
+
+    store = reopen(tmp_path)
+    assert store.users["1"].credits == 333
+    assert store.users["2"].credits == 444
+    assert store.seq == 3
+    store.close()
+
+
+def test_replay_skips_damaged_line_before_later_records(tmp_path):
+    # Logs written by versions that appended straight after a torn record
+    with open(tmp_path / "changes.log", "w") as f:
+        f.write('[1,"u","1",[111,false,null,0,0,0,null]]\n')
+        f.write('[2,"u","1",[2[2,"u","1",[333,false,null,0,0,0,null]]\n')
+        f.write('[3,"u","2",[444,false,null,0,0,0,null]]\n')
+
+    store = reopen(tmp_path)
+    assert store.users["1"].credits == 111
+    assert store.users["2"].credits == 444
+    assert store.seq == 3
+    store.close()
+
+
+def test_get_user_returns_a_copy(tmp_path):
+    store = reopen(tmp_path)
+    store.save_many({"1": UserRecord(credits=100)}, {})
+    user = store.get_user("1")
+    user.credits += 50
+    assert store.get_user("1").credits == 100
+    assert store.aggregates()["total_credits"] == 100
+    store.close()
+
+
+def test_quiz_seen_kept_apart_from_user_rows(tmp_path):
+    store = reopen(tmp_path)
+    store.save_many({"1": UserRecord(credits=100)}, {}, quiz_seen={"1": 1 << 5000 | 1})
+    store.close()
+    with open(store.log_path) as f:
+        assert len(f.readline()) < 64
+
+    store = reopen(tmp_path)
+    assert store.get_quiz_seen("1") == 1 << 5000 | 1
+    assert store.get_quiz_seen("2") == 0
+    store.checkpoint()
+    store.close()
+
+    store = reopen(tmp_path)
+    assert store.get_quiz_seen("1") == 1 << 5000 | 1
+    store.close()
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webhook import MAX_BODY_SIZE, SECRET_HEADER, WebhookServer
+
+
+async def read_response(reader):
+    """Return (status, body) of one response"""
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b"\r\n":
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+def request(method, path, body=b"", headers=None, length=None):
+    lines = [f"{method} {path} HTTP/1.1", f"Content-Length: {len(body) if length is None else length}"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+
+def serve(requests, secret_token="s3cret"):
+    """Send requests over one connection to a server with a /hook route; return the responses"""
+    received = []
+
+    async def hook(body):
+        received.append(body)
+        return 200, b"ok"
+
+    async def run():
+        server = WebhookServer("127.0.0.1", 0, {"/hook": hook}, secret_token)
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        responses = []
+        try:
+            for data in requests:
+                writer.write(data)
+                await writer.drain()
+                responses.append(await read_response(reader))
+        finally:
+            writer.close()
+            await server.stop()
+        return responses
+
+    return asyncio.run(run()), received
+
+
+def test_secret_token_and_path():
+    good = {SECRET_HEADER: "s3cret"}
+    responses, received = serve([
+        request("POST", "/hook", b"{}", good),
+        request("POST", "/hook", b"{}"),
+        request("POST", "/hook", b"{}", {SECRET_HEADER: "wrong"}),
+        request("POST", "/other", b"{}", good),
+        request("GET", "/hook", b"", good),
+        request("POST", "/hook", b"[1]", good),
+    ])
+    assert responses == [(200, b"ok"), (403, b""), (403, b""), (404, b""), (405, b""), (200, b"ok")]
+    # Only the requests that got through reach the route
+    assert received == [b"{}", b"[1]"]
+
+
+def test_no_secret_token_needed_when_unset():
+    responses, received = serve([request("POST", "/hook", b"{}")], secret_token=None)
+    assert responses == [(200, b"ok")]
+
+
+def test_oversized_body_refused():
+    responses, received = serve([request("POST", "/hook", headers={SECRET_HEADER: "s3cret"}, length=MAX_BODY_SIZE + 1)])
+    assert responses == [(413, b"")]
+    assert received == []
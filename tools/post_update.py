@@ -0,0 +1,90 @@
+"""Stand in for Telegram and POST fake updates to the bot's webhook server.
+
+Usage:
+    python tools/post_update.py [--url URL] [--secret TOKEN] [--user ID] [--count N] /dice
+    python tools/post_update.py --callback play_dice
+
+Start the bot with UPDATE_MODE=webhook (and WEBHOOK_SECRET matching --secret).
+Each update gets a fresh update_id; the HTTP status of every POST is printed.
+"""
+import argparse
+import itertools
+import json
+import time
+import urllib.error
+import urllib.request
+
+update_ids = itertools.count(int(time.time()))
+
+
+def fake_user(user_id, username):
+    return {"id": user_id, "is_bot": False, "first_name": "Test", "username": username}
+
+
+def message_update(user_id, username, text):
+    message = {
+        "message_id": next(update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": fake_user(user_id, username),
+        "text": text,
+    }
+    if text.startswith("/"):
+        command_length = len(text.split()[0])
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+    return {"update_id": next(update_ids), "message": message}
+
+
+def callback_update(user_id, username, data):
+    update_id = next(update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": fake_user(user_id, username),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "…",
+            },
+        },
+    }
+
+
+def post(url, update, secret=None):
+    """POST one update; return the HTTP status"""
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST")
+    request.add_header("Content-Type", "application/json")
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("text", nargs="?", default="/start", help="message text to send (default /start)")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/webhook")
+    parser.add_argument("--secret", help="value for the secret token header")
+    parser.add_argument("--user", type=int, default=1, help="Telegram user id to send as")
+    parser.add_argument("--username", default="tester")
+    parser.add_argument("--callback", help="send a button press with this callback_data instead")
+    parser.add_argument("--count", type=int, default=1, help="number of updates to send")
+    args = parser.parse_args()
+
+    for _ in range(args.count):
+        if args.callback:
+            update = callback_update(args.user, args.username, args.callback)
+        else:
+            update = message_update(args.user, args.username, args.text)
+        print(update["update_id"], post(args.url, update, args.secret))
+
+
+if __name__ == "__main__":
+    main()
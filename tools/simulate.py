@@ -0,0 +1,352 @@
+"""Simulate the game economy with the bot's own costs and payouts.
+
+Usage:
+    python tools/simulate.py games [--games N] [--seed N]
+    python tools/simulate.py economy [--users N] [--days N] [--report-every N] [--seed N]
+
+`games` plays N games of every game, for each player strategy and for free
+and premium players, and reports the return to player (what comes back,
+bonuses included, per credit staked), the house edge, and the mean and
+variance of each game's net result. Slots' return is also worked out
+exactly from its paytable.
+
+`economy` follows a population of users split into COHORTS through their
+days: each claims the daily reward, plays until their games for the day
+are done or they can't afford one, and may win premium. Each report shows
+every cohort's balances, its share of all credits, and how many credits
+the day created.
+
+Costs, payouts, bonuses and premium upgrades come from payouts.py, so the
+figures follow any change made there. Random draws are NumPy arrays, one
+element per game, so millions of games take seconds. Needs NumPy
+(pip install numpy).
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blackjack import VALUES
+from payouts import (
+    BLACKJACK_DECKS, BLACKJACK_PAYOUTS, BONUS_BASE, BONUS_MULTIPLIERS, DAILY_REWARDS, GAMES, LUCKY_BONUS_CHANCE,
+    LUCKY_BONUS_TENS, PREMIUM_UPGRADE_CHANCE, PREMIUM_UPGRADE_DAYS, PREMIUM_UPGRADE_WINS, SLOTS, premium_bonus,
+)
+from records import UserRecord
+from strategy import BasicStrategy
+
+# Games whose wins pay award_random_points(), and those whose wins may
+# upgrade a free user to premium, as the handlers in bot.py do
+BONUS_GAMES = {"dice", "number", "quiz"}
+UPGRADE_GAMES = BONUS_GAMES | {"rps"}
+
+# Ranges and attempts as start_dice() and start_number() set them
+GUESSING_GAMES = {"dice": (6, 3), "number": (100, 5)}
+
+# How players play. search: guess the middle of what the hints leave
+# (otherwise any number they leave); quiz_accuracy: chance of knowing the
+# answer; stand_on: blackjack total at which they stop hitting
+STRATEGIES = {
+    "casual": {"search": False, "quiz_accuracy": 0.25, "stand_on": 15},
+    "skilled": {"search": True, "quiz_accuracy": 0.8, "stand_on": 17},
+}
+
+# share: fraction of users; premium: fraction who start with premium that
+# never expires; daily: chance of claiming the daily reward each day;
+# games: games tried each day
+COHORTS = {
+    "casual": {"share": 0.7, "strategy": "casual", "premium": 0.02, "daily": 0.5, "games": 5},
+    "regular": {"share": 0.25, "strategy": "skilled", "premium": 0.1, "daily": 0.9, "games": 20},
+    "grinder": {"share": 0.05, "strategy": "skilled", "premium": 0.3, "daily": 1.0, "games": 100},
+}
+
+# The points of every card in the bot's blackjack shoe, aces as 11. Each
+# game is dealt from a freshly shuffled shoe, where the bot deals a shoe
+# down to its cut card first
+DECK = np.array([11 if value == 1 else value for value in VALUES] * 4 * BLACKJACK_DECKS, dtype=np.int8)
+
+# Games simulated at once in `games`, to keep memory bounded
+CHUNK = 250000
+
+
+def guessing_game(rng, n, high, attempts, search):
+    """Return which of n games of guessing 1..high with higher/lower hints are won
+
+    search is a bool, or an array of one for each game.
+    """
+    target = rng.integers(1, high + 1, n)
+    low = np.ones(n, dtype=np.int64)
+    top = np.full(n, high, dtype=np.int64)
+    won = np.zeros(n, dtype=bool)
+    for _ in range(attempts):
+        guess = np.where(search, (low + top) // 2, rng.integers(low, top + 1))
+        won |= guess == target
+        low = np.where(guess < target, guess + 1, low)
+        top = np.where(guess > target, guess - 1, top)
+    return won
+
+
+def add_card(total, aces, card):
+    """Add card to hands with these totals and aces counted as 11; return both"""
+    total = total + card
+    aces = aces + (card == 11)
+    # At most two aces need counting as 1 after one card
+    for _ in range(2):
+        soften = (total > 21) & (aces > 0)
+        total = np.where(soften, total - 10, total)
+        aces = np.where(soften, aces - 1, aces)
+    return total, aces
+
+
+def blackjack(rng, n, stand_on):
+    """Return the payout multiple of n blackjack games, each from a fresh shoe"""
+    stand_on = np.broadcast_to(stand_on, n)
+    # Every game's shoe, end to end
+    cards = np.tile(DECK, n)
+    position = np.zeros(n, dtype=np.int64)
+
+    def deal(games):
+        # A Fisher-Yates step for each of games, so only the cards dealt
+        # get shuffled
+        start = games * len(DECK)
+        top = start + position[games]
+        swap = start + rng.integers(position[games], len(DECK))
+        card = cards[swap]
+        cards[swap] = cards[top]
+        cards[top] = card
+        position[games] += 1
+        return card
+
+    everyone = np.arange(n)
+    zeros = np.zeros(n, dtype=np.int64)
+    player, player_aces = add_card(zeros, zeros, deal(everyone))
+    player, player_aces = add_card(player, player_aces, deal(everyone))
+    dealer, dealer_aces = add_card(zeros, zeros, deal(everyone))
+    dealer, dealer_aces = add_card(dealer, dealer_aces, deal(everyone))
+    natural = player == 21
+
+    # The player hits below stand_on; 21 stands automatically
+    hitting = np.flatnonzero(~natural & (player < stand_on))
+    while len(hitting):
+        player[hitting], player_aces[hitting] = add_card(player[hitting], player_aces[hitting], deal(hitting))
+        hitting = hitting[player[hitting] < stand_on[hitting]]
+
+    # The dealer draws to 17 unless the player has already finished
+    drawing = np.flatnonzero(~natural & (player <= 21) & (dealer < 17))
+    while len(drawing):
+        dealer[drawing], dealer_aces[drawing] = add_card(dealer[drawing], dealer_aces[drawing], deal(drawing))
+        drawing = drawing[dealer[drawing] < 17]
+
+    return np.select(
+        [natural, player > 21, (dealer > 21) | (player > dealer), player == dealer],
+        [BLACKJACK_PAYOUTS["blackjack"], BLACKJACK_PAYOUTS["lose"], BLACKJACK_PAYOUTS["win"],
+         BLACKJACK_PAYOUTS["push"]],
+        BLACKJACK_PAYOUTS["lose"],
+    )
+
+
+# The slot machine's paytable, and what each reel's stops add to every line's index into it
+SLOTS_PAYTABLE = np.array(SLOTS.paytable, dtype=np.float64)
+SLOTS_LINE_CODES = [
+    np.array([SLOTS.line_codes[line][reel] for line in range(len(SLOTS.paylines))], dtype=np.int64)
+    for reel in range(len(SLOTS.reels))
+]
+
+
+def slots(rng, n):
+    """Return the payout multiple of n spins of the bot's slot machine"""
+    codes = sum(reel_codes[:, rng.integers(0, reel_codes.shape[1], n)] for reel_codes in SLOTS_LINE_CODES)
+    return SLOTS_PAYTABLE[codes].mean(axis=0)
+
+
+def play(rng, game, stakes, premium, strategy):
+    """Play one game for each stake; return (credits paid back, won)
+
+    premium is a bool array of which players are premium. Each of
+    strategy's values is one value for every player or an array of one
+    each. What comes back includes the win bonus.
+    """
+    n = len(stakes)
+    if game in GUESSING_GAMES:
+        high, attempts = GUESSING_GAMES[game]
+        won = guessing_game(rng, n, high, attempts, strategy["search"])
+        multiple = np.where(won, GAMES[game]["payout"], 0)
+    elif game == "quiz":
+        won = rng.random(n) < strategy["quiz_accuracy"]
+        multiple = np.where(won, GAMES[game]["payout"], 0)
+    elif game == "rps":
+        # Whatever the player picks, the bot's random choice wins, draws or loses a third of the time each
+        outcome = rng.integers(0, 3, n)
+        won = outcome == 0
+        multiple = np.select([won, outcome == 1], [GAMES[game]["payout"], 1], 0)
+    elif game == "slots":
+        multiple = slots(rng, n)
+        won = multiple > 0
+    elif game == "blackjack":
+        multiple = blackjack(rng, n, strategy["stand_on"])
+        won = multiple > BLACKJACK_PAYOUTS["push"]
+    else:
+        raise ValueError(f"Unknown game {game}")
+
+    paid = (stakes * multiple).astype(np.int64)
+    if game in BONUS_GAMES:
+        paid += np.where(won, bonus(rng, n, premium), 0)
+    return paid, won
+
+
+def bonus(rng, n, premium):
+    """Draw n win bonuses the way award_random_points() does"""
+    points = BONUS_BASE * rng.integers(BONUS_MULTIPLIERS[0], BONUS_MULTIPLIERS[1] + 1, n)
+    lucky = rng.random(n) < LUCKY_BONUS_CHANCE
+    points += np.where(lucky, 10 * rng.integers(LUCKY_BONUS_TENS[0], LUCKY_BONUS_TENS[1] + 1, n), 0)
+    return points + np.where(premium, premium_bonus(points), 0)
+
+
+def report_games(args, rng):
+    print(f"{args.games} games each")
+    print(f"{'game':<10} {'strategy':<8} {'tier':<8} {'stake':>5} {'win %':>6} {'RTP':>7} {'edge':>7} "
+          f"{'mean net':>9} {'variance':>10}")
+    for game, details in GAMES.items():
+        tiers = [("premium", True)] if details.get("premium_only") else [("free", False), ("premium", True)]
+        for (strategy_name, strategy), (tier, is_premium) in itertools.product(STRATEGIES.items(), tiers):
+            stake = details["premium_cost"] if is_premium else details["cost"]
+            total = total_squares = wins = 0
+            for start in range(0, args.games, CHUNK):
+                n = min(CHUNK, args.games - start)
+                paid, won = play(rng, game, np.full(n, stake), np.full(n, is_premium), strategy)
+                net = paid - stake
+                total += int(net.sum())
+                total_squares += float(np.square(net, dtype=np.float64).sum())
+                wins += int(won.sum())
+            mean = total / args.games
+            variance = total_squares / args.games - mean * mean
+            rtp = 1 + mean / stake
+            print(f"{game:<10} {strategy_name:<8} {tier:<8} {stake:>5} {100 * wins / args.games:>6.2f} {rtp:>7.3f} "
+                  f"{1 - rtp:>+7.3f} {mean:>+9.2f} {variance:>10.1f}")
+    print(f"\nSlots exact RTP: {float(SLOTS.rtp()):.4f} from its {len(SLOTS.paytable)}-entry paytable")
+    print(f"Blackjack exact RTP with basic strategy: {BasicStrategy.solve().rtp():.4f} (infinite deck)")
+
+
+def segment_cumsum(values, first):
+    """Running totals of values, restarting at each index in first
+
+    first gives, for each element, the index where its segment starts.
+    """
+    totals = np.cumsum(values)
+    return totals - totals[first] + values[first]
+
+
+def report_economy(args, rng):
+    names = list(COHORTS)
+    shares = np.array([COHORTS[name]["share"] for name in names])
+    cohort = rng.choice(len(names), args.users, p=shares / shares.sum())
+    premium_share = np.array([COHORTS[name]["premium"] for name in names])[cohort]
+    daily_chance = np.array([COHORTS[name]["daily"] for name in names])[cohort]
+    games_per_day = np.array([COHORTS[name]["games"] for name in names])[cohort]
+    strategies = {
+        key: np.array([STRATEGIES[COHORTS[name]["strategy"]][key] for name in names])[cohort]
+        for key in STRATEGIES["casual"]
+    }
+
+    credits = np.full(args.users, UserRecord().credits, dtype=np.int64)
+    games_won = np.zeros(args.users, dtype=np.int64)
+    # Day on which premium runs out; inf for premium that never does
+    premium_until = np.where(rng.random(args.users) < premium_share, np.inf, 0.0)
+    game_names = list(GAMES)
+    free_games = np.array([index for index, game in enumerate(game_names) if not GAMES[game].get("premium_only")])
+    upgrade_games = np.array([game in UPGRADE_GAMES for game in game_names])
+
+    # A day's games are laid out user after user: owner is the user playing
+    # each one, and first the index of that user's first game
+    owner = np.repeat(np.arange(args.users), games_per_day)
+    first = (np.cumsum(games_per_day) - games_per_day)[owner]
+
+    print(f"{args.users} users over {args.days} days")
+    print(f"{'day':>4} {'cohort':<8} {'users':>7} {'premium %':>9} {'mean':>9} {'median':>8} {'supply %':>8} "
+          f"{'created/day':>12}")
+    total_created = 0
+    for day in range(args.days):
+        before = np.bincount(cohort, weights=credits, minlength=len(names))
+        premium = premium_until > day
+
+        claims = rng.random(args.users) < daily_chance
+        credits += np.where(claims, np.where(premium, DAILY_REWARDS[True], DAILY_REWARDS[False]), 0)
+
+        # Each game is picked uniformly from those open to its player
+        playing_premium = premium[owner]
+        picks = rng.random(len(owner))
+        choice = np.where(
+            playing_premium,
+            (picks * len(game_names)).astype(np.int64),
+            free_games[(picks * len(free_games)).astype(np.int64)],
+        )
+        stakes = np.zeros(len(owner), dtype=np.int64)
+        paid = np.zeros(len(owner), dtype=np.int64)
+        won = np.zeros(len(owner), dtype=bool)
+        for index, game in enumerate(game_names):
+            picked = np.flatnonzero(choice == index)
+            if not len(picked):
+                continue
+            stakes[picked] = np.where(playing_premium[picked], GAMES[game]["premium_cost"], GAMES[game]["cost"])
+            strategy = {key: values[owner[picked]] for key, values in strategies.items()}
+            paid[picked], won[picked] = play(rng, game, stakes[picked], playing_premium[picked], strategy)
+
+        # Players stop for the day at the first game they can't afford
+        net = paid - stakes
+        balance = credits[owner] + segment_cumsum(net, first) - net
+        played = segment_cumsum(balance < stakes, first) == 0
+        credits += np.bincount(owner, weights=np.where(played, net, 0), minlength=args.users).astype(np.int64)
+
+        # Premium won today starts tomorrow
+        wins = won & played
+        wins_so_far = games_won[owner] + segment_cumsum(wins, first)
+        upgrade = (wins & upgrade_games[choice] & ~playing_premium & (wins_so_far >= PREMIUM_UPGRADE_WINS)
+                   & (rng.random(len(owner)) < PREMIUM_UPGRADE_CHANCE))
+        premium_until[owner[upgrade]] = day + 1 + PREMIUM_UPGRADE_DAYS
+        games_won += np.bincount(owner, weights=wins, minlength=args.users).astype(np.int64)
+
+        after = np.bincount(cohort, weights=credits, minlength=len(names))
+        created = (after - before).astype(np.int64)
+        total_created += int(created.sum())
+        if (day + 1) % args.report_every and day + 1 != args.days:
+            continue
+        supply = after.sum()
+        for index, name in enumerate(names):
+            members = cohort == index
+            balances = credits[members]
+            print(f"{day + 1:>4} {name:<8} {members.sum():>7} {100 * premium[members].mean():>9.1f} "
+                  f"{balances.mean():>9.0f} {np.median(balances):>8.0f} {100 * after[index] / supply:>8.1f} "
+                  f"{created[index]:>+12}")
+        print(f"{day + 1:>4} {'all':<8} {args.users:>7} {100 * premium.mean():>9.1f} {credits.mean():>9.0f} "
+              f"{np.median(credits):>8.0f} {100.0:>8.1f} {created.sum():>+12}")
+    print(f"\nCredits created over {args.days} days: {total_created:+} "
+          f"({total_created / args.users / args.days:+.1f} a user a day)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, help="seed for repeatable runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    games = commands.add_parser("games", help="expected value and variance of each game")
+    games.add_argument("--games", type=int, default=1000000, help="games per game, strategy and tier")
+    economy = commands.add_parser("economy", help="credit supply over time for each cohort")
+    economy.add_argument("--users", type=int, default=100000)
+    economy.add_argument("--days", type=int, default=30)
+    economy.add_argument("--report-every", type=int, default=7, help="days between reports")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    started = time.perf_counter()
+    if args.command == "games":
+        report_games(args, rng)
+    else:
+        report_economy(args, rng)
+    print(f"Took {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Telegram sends the secret_token given to set_webhook in this header
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY_SIZE = 1 << 20
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+async def read_headers(reader):
+    """Read header lines up to the blank line; return them with lowercase names"""
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+class WebhookServer:
+    """A small HTTP/1.1 server for Telegram's webhook POSTs.
+
+    routes maps a path to a coroutine function that takes the request body
+    and returns (status, response body). Requests for any other path get
+    404, requests with another method than method get 405, and with
+    secret_token set, requests that don't carry it get 403.
+    """
+
+    def __init__(self, host, port, routes, secret_token=None, method="POST", content_type="application/json"):
+        self.host = host
+        self.port = port
+        self.routes = routes
+        self.secret_token = secret_token.encode() if secret_token else None
+        self.method = method
+        self.content_type = content_type
+        self.server = None
+        # Writer -> task serving that connection
+        self.connections = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    async def stop(self):
+        self.server.close()
+        # Idle keep-alive connections would otherwise wait for a request forever
+        for writer in self.connections:
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
+        try:
+            # Telegram keeps connections open, so serve requests until it closes
+            while await self._handle(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        """Answer one request; return whether the connection stays open"""
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        method, path, version = request_line.decode("latin-1").split()
+        headers = await read_headers(reader)
+
+        length = int(headers.get("content-length", "0"))
+        if length > MAX_BODY_SIZE:
+            self._respond(writer, 413, b"", False)
+            return False
+        body = await reader.readexactly(length)
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        status, response = await self._dispatch(method, path, headers, body)
+        self._respond(writer, status, response, keep_alive)
+        await writer.drain()
+        return keep_alive
+
+    async def _dispatch(self, method, path, headers, body):
+        route = self.routes.get(path)
+        if route is None:
+            return 404, b""
+        if method != self.method:
+            return 405, b""
+        if self.secret_token is not None:
+            token = headers.get(SECRET_HEADER, "").encode("latin-1")
+            if not hmac.compare_digest(token, self.secret_token):
+                return 403, b""
+        try:
+            return await route(body)
+        except Exception:
+            logger.exception(f"Error handling a request for {path}")
+            return 500, b""
+
+    def _respond(self, writer, status, body, keep_alive):
+        connection = "keep-alive" if keep_alive else "close"
+        content_type = f"Content-Type: {self.content_type}\r\n" if body else ""
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"{content_type}"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {connection}\r\n\r\n".encode() + body
+        )
+
+
+def queue_updates(application, max_pending):
+    """Return a route that hands each posted update to application's update processor.
+
+    At most max_pending updates may be accepted and not yet finished; past
+    that the request is answered 503 and Telegram delivers the update again
+    later, so a burst can't grow memory without limit. The count is kept
+    here because the application's update_queue never fills: with
+    concurrent updates it takes each one off straight away and starts a
+    task for it.
+    """
+    pending = 0
+
+    async def process(update):
+        nonlocal pending
+        try:
+            await application.update_processor.process_update(update, application.process_update(update))
+        finally:
+            pending -= 1
+
+    async def handle(body):
+        nonlocal pending
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, KeyError, TypeError):
+            return 400, b""
+        if update is None:
+            return 400, b""
+
+        if pending >= max_pending:
+            logger.warning(f"{pending} updates pending, asking Telegram to resend update {update.update_id}")
+            return 503, b""
+        pending += 1
+        application.create_task(process(update), update=update)
+        return 200, b""
+
+    return handle
+
+
+def stop_event():
+    """Return an event that is set on SIGINT or SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    return stop
+
+
+async def run_webhook(application, host, port, path, secret_token=None, url=None, routes=None, max_pending=1000):
+    """Run the application on webhook updates until SIGINT or SIGTERM.
+
+    Past max_pending updates in progress, new ones are refused with 503
+    (see queue_updates()). With url set, the webhook is registered with
+    Telegram first. routes adds
+    other paths to the server. Like run_polling(), this calls the
+    application's post_init hook once it is initialized and its
+    post_shutdown hook on the way out.
+    """
+    server = WebhookServer(host, port, {path: queue_updates(application, max_pending), **(routes or {})}, secret_token)
+    stop = stop_event()
+
+    async with application:
+        if application.post_init is not None:
+            await application.post_init(application)
+        if url is not None:
+            await application.bot.set_webhook(url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        await server.start()
+        logger.info(f"Listening for webhook updates on {host}:{port}{path}")
+        try:
+            await stop.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)